@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the cost of a cache hit on an @cached method, comparing the
+precompiled cache key builder against building the key with
+`inspect.getcallargs` on every call.
+"""
+
+from synapse.util.caches.descriptors import cached
+
+import argparse
+import inspect
+import timeit
+
+
+class Store(object):
+    @cached(num_args=2)
+    def get_thing(self, room_id, user_id, allow_none=False):
+        return room_id + user_id
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number", type=int, default=100000)
+    args = parser.parse_args()
+
+    store = Store()
+    store.get_thing("!room:test", "@user:test")
+
+    descriptor = Store.__dict__["get_thing"]
+    orig = descriptor.orig
+    get_cache_key = descriptor.get_cache_key
+    cache = store.get_thing.cache
+
+    def getcallargs_key():
+        arg_dict = inspect.getcallargs(orig, store, "!room:test", "@user:test")
+        return tuple(arg_dict[arg_nm] for arg_nm in ("room_id", "user_id"))
+
+    def compiled_key():
+        return get_cache_key(("!room:test", "@user:test"), {})
+
+    def compiled_keyword_key():
+        return get_cache_key(("!room:test",), {"user_id": "@user:test"})
+
+    def dict_lookup():
+        return cache.get(("!room:test", "@user:test"))
+
+    def positional_hit():
+        return store.get_thing("!room:test", "@user:test")
+
+    def keyword_hit():
+        return store.get_thing("!room:test", user_id="@user:test")
+
+    for name, func in (
+        ("key via getcallargs", getcallargs_key),
+        ("key via builder (positional)", compiled_key),
+        ("key via builder (keyword)", compiled_keyword_key),
+        ("cache.get", dict_lookup),
+        ("@cached hit (positional)", positional_hit),
+        ("@cached hit (keyword)", keyword_hit),
+    ):
+        total = timeit.timeit(func, number=args.number)
+        print "%-30s %8.2f us/call" % (name, total * 1e6 / args.number)
+
+
+if __name__ == "__main__":
+    main()
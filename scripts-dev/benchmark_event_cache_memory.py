@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures how much memory the event cache uses, by loading events the same
+way the event fetcher does (from their JSON) into an LruCache and reporting
+the growth in RSS.
+"""
+
+from synapse.events import FrozenEvent
+from synapse.util.caches.lrucache import LruCache
+
+import argparse
+import gc
+import resource
+import simplejson as json
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+
+    # ru_maxrss is in kilobytes on Linux, bytes on OS X. Near enough.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _make_event_json(i):
+    room_id = "!room%d:example.com" % (i % 100,)
+    sender = "@user%d:example.com" % (i % 1000,)
+    event = {
+        "event_id": "$%dabcdefghij:example.com" % (i,),
+        "room_id": room_id,
+        "sender": sender,
+        "origin": "example.com",
+        "origin_server_ts": 1470000000000 + i,
+        "depth": i,
+        "hashes": {"sha256": "Uz6Ug1q1ZwZ3cjUbbDS8Z0oUGAWQ62c9a4zpDPJaXTo"},
+        "signatures": {
+            "example.com": {
+                "ed25519:a_abcd": (
+                    "1rdqOIk5V9TpMiTSc0jGc2Ix0rdGSfHxdVTrMOIWy1RbFsWKyP6jdvp"
+                    "HcbnIfg4A0NOqwvNCPTn5y2KWpJvNAg"
+                ),
+            },
+        },
+        "unsigned": {"age_ts": 1470000000000 + i},
+        "prev_events": [
+            ["$%dabcdefghij:example.com" % (i - 1,), {"sha256": "abcdefgh"}],
+        ],
+        "auth_events": [
+            ["$createabcdefghij:example.com", {"sha256": "abcdefgh"}],
+            ["$powerabcdefghij:example.com", {"sha256": "abcdefgh"}],
+            ["$member%dabcdefghij:example.com" % (i % 1000,), {"sha256": "abcd"}],
+        ],
+    }
+
+    if i % 5 == 0:
+        event.update({
+            "type": "m.room.member",
+            "state_key": sender,
+            "content": {"membership": "join", "displayname": "User %d" % (i,)},
+            "prev_state": [],
+        })
+    else:
+        event.update({
+            "type": "m.room.message",
+            "content": {"msgtype": "m.text", "body": "Message number %d" % (i,)},
+        })
+
+    return json.dumps(event), json.dumps({"stream_ordering": i})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number", type=int, default=100000)
+    args = parser.parse_args()
+
+    rows = [_make_event_json(i) for i in xrange(args.number)]
+    cache = LruCache(args.number)
+
+    gc.collect()
+    before = _rss_bytes()
+
+    for js, internal_metadata in rows:
+        event = FrozenEvent(
+            json.loads(js),
+            internal_metadata_dict=json.loads(internal_metadata),
+        )
+        cache[(event.event_id,)] = event
+
+    gc.collect()
+    after = _rss_bytes()
+
+    growth = after - before
+    print "Cached %d events" % (len(cache),)
+    print "RSS growth: %.1f MiB (%.1f MiB per 100k events)" % (
+        growth / 1048576.0, growth * 100000.0 / args.number / 1048576.0,
+    )
+    print "Per event: %d bytes" % (growth / args.number,)
+
+
+if __name__ == "__main__":
+    main()
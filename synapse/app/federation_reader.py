@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import synapse
+
+from synapse.api.urls import FEDERATION_PREFIX
+from synapse.config._base import ConfigError
+from synapse.config.appservice import AppServiceConfig
+from synapse.config.database import DatabaseConfig
+from synapse.config.key import KeyConfig
+from synapse.config.logger import LoggingConfig
+from synapse.config.ratelimiting import RatelimitConfig
+from synapse.config.tls import TlsConfig
+from synapse.crypto import context_factory
+from synapse.federation.transport.server import (
+    TransportLayerServer, READ_ONLY_SERVLET_CLASSES,
+)
+from synapse.handlers.directory import DirectoryHandler
+from synapse.handlers.federation import FederationHandler
+from synapse.handlers.profile import ProfileHandler
+from synapse.http.site import SynapseSite
+from synapse.metrics.resource import MetricsResource, METRICS_PREFIX
+from synapse.replication.slave.storage._base import BaseSlavedStore
+from synapse.replication.slave.storage.appservice import SlavedApplicationServiceStore
+from synapse.replication.slave.storage.events import SlavedEventStore
+from synapse.server import HomeServer
+from synapse.storage.directory import DirectoryStore
+from synapse.storage.engines import create_engine
+from synapse.storage.keys import KeyStore
+from synapse.storage.profile import ProfileStore
+from synapse.util.async import sleep
+from synapse.util.httpresourcetree import create_resource_tree
+from synapse.util.logcontext import LoggingContext
+from synapse.util.manhole import manhole
+from synapse.util.rlimit import change_resource_limit
+from synapse.util.versionstring import get_version_string
+
+from twisted.internet import reactor, defer
+from twisted.web.resource import Resource
+
+from daemonize import Daemonize
+
+import sys
+import logging
+import gc
+
+logger = logging.getLogger("synapse.app.federation_reader")
+
+
+class FederationReaderConfig(
+    DatabaseConfig, LoggingConfig, AppServiceConfig, RatelimitConfig, TlsConfig,
+    KeyConfig,
+):
+    def read_config(self, config):
+        self.replication_url = config["replication_url"]
+        self.server_name = config["server_name"]
+        self.use_insecure_ssl_client_just_for_testing_do_not_use = config.get(
+            "use_insecure_ssl_client_just_for_testing_do_not_use", False
+        )
+        self.user_agent_suffix = None
+        self.listeners = config["listeners"]
+        self.soft_file_limit = config.get("soft_file_limit")
+        self.daemonize = config.get("daemonize")
+        self.pid_file = self.abspath(config.get("pid_file"))
+
+        # The federation reader never sends anything itself; it only answers
+        # requests from remote servers.
+        self.send_federation = False
+        self.federation_presence_flush_interval_ms = config.get(
+            "federation_presence_flush_interval_ms", 1000
+        )
+        self.federation_presence_batch_size = config.get(
+            "federation_presence_batch_size", 100
+        )
+        self.federation_max_pdus_per_transaction = config.get(
+            "federation_max_pdus_per_transaction", 50
+        )
+        self.federation_max_edus_per_transaction = config.get(
+            "federation_max_edus_per_transaction", 100
+        )
+        self.federation_queue_max_age_ms = config.get(
+            "federation_queue_max_age_ms", 3 * 24 * 60 * 60 * 1000
+        )
+        self.federation_max_queued_per_destination = config.get(
+            "federation_max_queued_per_destination", 10000
+        )
+
+        thresholds = config.get("gc_thresholds", None)
+        if thresholds is not None:
+            try:
+                assert len(thresholds) == 3
+                self.gc_thresholds = (
+                    int(thresholds[0]), int(thresholds[1]), int(thresholds[2]),
+                )
+            except:
+                raise ConfigError(
+                    "Value of `gc_threshold` must be a list of three integers if set"
+                )
+        else:
+            self.gc_thresholds = None
+
+        # We would otherwise try to use the registration shared secret as the
+        # macaroon shared secret if there was no macaroon_shared_secret, but
+        # that means pulling in RegistrationConfig too, which the federation
+        # reader doesn't need.
+        self.registration_shared_secret = None
+
+    def default_config(self, server_name, **kwargs):
+        pid_file = self.abspath("federation_reader.pid")
+        return """\
+        # Slave configuration
+
+        # The replication listener on the synapse to talk to.
+        #replication_url: https://localhost:{replication_port}/_synapse/replication
+
+        server_name: "%(server_name)s"
+
+        # The federation reader only serves the federation APIs that read from
+        # the database: /event, /state, /backfill, /query, /event_auth and
+        # /get_missing_events. All other federation requests must still be
+        # routed to the main synapse process.
+
+        listeners:
+        # Enable a federation listener on the federation reader
+        #- type: http
+        #    port: {http_port}
+        #    bind_address: ""
+        #    resources:
+        #     - names: ["federation"]
+        # Enable a ssh manhole listener on the federation reader
+        # - type: manhole
+        #   port: {manhole_port}
+        #   bind_address: 127.0.0.1
+        # Enable a metric listener on the federation reader
+        # - type: http
+        #   port: {metrics_port}
+        #   bind_address: 127.0.0.1
+        #   resources:
+        #    - names: ["metrics"]
+        #      compress: False
+
+        report_stats: False
+
+        daemonize: False
+
+        pid_file: %(pid_file)s
+        """ % locals()
+
+
+class FederationReaderSlavedStore(
+    SlavedEventStore,
+    SlavedApplicationServiceStore,
+    BaseSlavedStore,
+    KeyStore,  # After BaseSlavedStore because the constructor is different
+):
+    # The server keys we fetch while authenticating requests are written
+    # straight to the database, as the main process does. The writes are
+    # upserts, so it doesn't matter if several processes fetch the same keys.
+
+    get_association_from_room_alias = (
+        DirectoryStore.__dict__["get_association_from_room_alias"]
+    )
+    get_profile_displayname = ProfileStore.__dict__["get_profile_displayname"]
+    get_profile_avatar_url = ProfileStore.__dict__["get_profile_avatar_url"]
+
+
+class FederationReaderServer(HomeServer):
+    def get_db_conn(self, run_new_connection=True):
+        # Any param beginning with cp_ is a parameter for adbapi, and should
+        # not be passed to the database engine.
+        db_params = {
+            k: v for k, v in self.db_config.get("args", {}).items()
+            if not k.startswith("cp_")
+        }
+        db_conn = self.database_engine.module.connect(**db_params)
+
+        if run_new_connection:
+            self.database_engine.on_new_connection(db_conn)
+        return db_conn
+
+    def setup(self):
+        logger.info("Setting up.")
+        self.datastore = FederationReaderSlavedStore(self.get_db_conn(), self)
+
+        # These register themselves with the replication layer to answer the
+        # federation requests we serve. We don't want the rest of the handlers
+        # as they would try to write to the database.
+        FederationHandler(self)
+        ProfileHandler(self)
+        DirectoryHandler(self)
+        logger.info("Finished setting up.")
+
+    def _listen_http(self, listener_config):
+        port = listener_config["port"]
+        bind_address = listener_config.get("bind_address", "")
+        site_tag = listener_config.get("tag", port)
+        resources = {}
+        for res in listener_config["resources"]:
+            for name in res["names"]:
+                if name == "metrics":
+                    resources[METRICS_PREFIX] = MetricsResource(self)
+                elif name == "federation":
+                    resources[FEDERATION_PREFIX] = TransportLayerServer(
+                        self, servlet_classes=READ_ONLY_SERVLET_CLASSES,
+                    )
+
+        root_resource = create_resource_tree(resources, Resource())
+        reactor.listenTCP(
+            port,
+            SynapseSite(
+                "synapse.access.http.%s" % (site_tag,),
+                site_tag,
+                listener_config,
+                root_resource,
+            ),
+            interface=bind_address
+        )
+        logger.info("Synapse federation reader now listening on port %d", port)
+
+    def start_listening(self):
+        for listener in self.config.listeners:
+            if listener["type"] == "http":
+                self._listen_http(listener)
+            elif listener["type"] == "manhole":
+                reactor.listenTCP(
+                    listener["port"],
+                    manhole(
+                        username="matrix",
+                        password="rabbithole",
+                        globals={"hs": self},
+                    ),
+                    interface=listener.get("bind_address", '127.0.0.1')
+                )
+            else:
+                logger.warn("Unrecognized listener type: %s", listener["type"])
+
+    @defer.inlineCallbacks
+    def replicate(self):
+        http_client = self.get_simple_http_client()
+        store = self.get_datastore()
+        replication_url = self.config.replication_url
+
+        while True:
+            try:
+                args = store.stream_positions()
+                args["timeout"] = 30000
+                result = yield http_client.get_json(replication_url, args=args)
+                yield store.process_replication(result)
+            except:
+                logger.exception("Error replicating from %r", replication_url)
+                yield sleep(5)
+
+
+def setup(config_options):
+    try:
+        config = FederationReaderConfig.load_config(
+            "Synapse federation reader", config_options
+        )
+    except ConfigError as e:
+        sys.stderr.write("\n" + e.message + "\n")
+        sys.exit(1)
+
+    if not config:
+        sys.exit(0)
+
+    config.setup_logging()
+
+    database_engine = create_engine(config.database_config)
+
+    tls_server_context_factory = context_factory.ServerContextFactory(config)
+
+    ss = FederationReaderServer(
+        config.server_name,
+        db_config=config.database_config,
+        tls_server_context_factory=tls_server_context_factory,
+        config=config,
+        version_string=get_version_string("Synapse", synapse),
+        database_engine=database_engine,
+    )
+
+    ss.setup()
+    ss.start_listening()
+
+    change_resource_limit(ss.config.soft_file_limit)
+    if ss.config.gc_thresholds:
+        gc.set_threshold(*ss.config.gc_thresholds)
+
+    def start():
+        ss.get_state_handler().start_caching()
+        ss.get_datastore().start_profiling()
+        ss.replicate()
+
+    reactor.callWhenRunning(start)
+
+    return ss
+
+
+if __name__ == '__main__':
+    with LoggingContext("main"):
+        ss = setup(sys.argv[1:])
+
+        if ss.config.daemonize:
+            def run():
+                with LoggingContext("run"):
+                    change_resource_limit(ss.config.soft_file_limit)
+                    if ss.config.gc_thresholds:
+                        gc.set_threshold(*ss.config.gc_thresholds)
+                    reactor.run()
+
+            daemon = Daemonize(
+                app="synapse-federation-reader",
+                pid=ss.config.pid_file,
+                action=run,
+                auto_close_fds=False,
+                verbose=True,
+                logger=logger,
+            )
+
+            daemon.start()
+        else:
+            reactor.run()
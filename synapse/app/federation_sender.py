@@ -0,0 +1,602 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import synapse
+
+from synapse.api.constants import EventTypes, Membership, PresenceState
+from synapse.config._base import ConfigError
+from synapse.config.database import DatabaseConfig
+from synapse.config.logger import LoggingConfig
+from synapse.config.key import KeyConfig
+from synapse.config.tls import TlsConfig
+from synapse.crypto import context_factory
+from synapse.events import FrozenEvent
+from synapse.federation.transaction_queue import TransactionQueue
+from synapse.federation.transport.client import TransportLayerClient
+from synapse.federation.units import Edu
+from synapse.handlers.presence import (
+    get_interested_parties, should_notify, FEDERATION_PING_INTERVAL,
+)
+from synapse.http.site import SynapseSite
+from synapse.metrics.resource import MetricsResource, METRICS_PREFIX
+from synapse.replication.slave.storage._base import BaseSlavedStore
+from synapse.replication.slave.storage.events import SlavedEventStore
+from synapse.replication.slave.storage.presence import SlavedPresenceStore
+from synapse.replication.slave.storage.receipts import SlavedReceiptsStore
+from synapse.server import HomeServer
+from synapse.storage.engines import create_engine
+from synapse.storage.presence import PresenceStore, UserPresenceState
+from synapse.storage.transactions import TransactionStore
+from synapse.storage.util.id_generators import IdGenerator
+from synapse.types import get_domain_from_id
+from synapse.util.async import sleep
+from synapse.util.httpresourcetree import create_resource_tree
+from synapse.util.logcontext import LoggingContext, preserve_fn
+from synapse.util.manhole import manhole
+from synapse.util.rlimit import change_resource_limit
+from synapse.util.versionstring import get_version_string
+
+from twisted.internet import reactor, defer
+from twisted.web.resource import Resource
+
+from daemonize import Daemonize
+
+import sys
+import logging
+import gc
+import ujson as json
+
+logger = logging.getLogger("synapse.app.federation_sender")
+
+
+class FederationSenderConfig(DatabaseConfig, LoggingConfig, TlsConfig, KeyConfig):
+    def read_config(self, config):
+        self.replication_url = config["replication_url"]
+        self.server_name = config["server_name"]
+        self.use_insecure_ssl_client_just_for_testing_do_not_use = config.get(
+            "use_insecure_ssl_client_just_for_testing_do_not_use", False
+        )
+        self.user_agent_suffix = None
+        self.listeners = config["listeners"]
+        self.soft_file_limit = config.get("soft_file_limit")
+        self.daemonize = config.get("daemonize")
+        self.pid_file = self.abspath(config.get("pid_file"))
+
+        # This is the process that does the sending.
+        self.send_federation = True
+        self.federation_presence_flush_interval_ms = config.get(
+            "federation_presence_flush_interval_ms", 1000
+        )
+        self.federation_presence_batch_size = config.get(
+            "federation_presence_batch_size", 100
+        )
+        self.federation_max_pdus_per_transaction = config.get(
+            "federation_max_pdus_per_transaction", 50
+        )
+        self.federation_max_edus_per_transaction = config.get(
+            "federation_max_edus_per_transaction", 100
+        )
+        self.federation_queue_max_age_ms = config.get(
+            "federation_queue_max_age_ms", 3 * 24 * 60 * 60 * 1000
+        )
+        self.federation_max_queued_per_destination = config.get(
+            "federation_max_queued_per_destination", 10000
+        )
+
+        thresholds = config.get("gc_thresholds", None)
+        if thresholds is not None:
+            try:
+                assert len(thresholds) == 3
+                self.gc_thresholds = (
+                    int(thresholds[0]), int(thresholds[1]), int(thresholds[2]),
+                )
+            except:
+                raise ConfigError(
+                    "Value of `gc_threshold` must be a list of three integers if set"
+                )
+        else:
+            self.gc_thresholds = None
+
+        # We would otherwise try to use the registration shared secret as the
+        # macaroon shared secret if there was no macaroon_shared_secret, but
+        # that means pulling in RegistrationConfig too, which the federation
+        # sender doesn't need.
+        self.registration_shared_secret = None
+
+    def default_config(self, server_name, **kwargs):
+        pid_file = self.abspath("federation_sender.pid")
+        return """\
+        # Slave configuration
+
+        # The replication listener on the synapse to talk to.
+        #replication_url: https://localhost:{replication_port}/_synapse/replication
+
+        server_name: "%(server_name)s"
+
+        # The main synapse process must have `send_federation: false` so that
+        # it doesn't also send outbound federation.
+
+        listeners: []
+        # Enable a ssh manhole listener on the federation sender.
+        # - type: manhole
+        #   port: {manhole_port}
+        #   bind_address: 127.0.0.1
+        # Enable a metric listener on the federation sender.
+        # - type: http
+        #   port: {metrics_port}
+        #   bind_address: 127.0.0.1
+        #   resources:
+        #    - names: ["metrics"]
+        #      compress: False
+
+        report_stats: False
+
+        daemonize: False
+
+        pid_file: %(pid_file)s
+        """ % locals()
+
+
+class FederationSenderSlaveStore(
+    SlavedEventStore,
+    SlavedPresenceStore,
+    SlavedReceiptsStore,
+    BaseSlavedStore,
+    TransactionStore,  # After BaseSlavedStore because the constructor is different
+):
+    def __init__(self, db_conn, hs):
+        super(FederationSenderSlaveStore, self).__init__(db_conn, hs)
+
+        # The federation sender owns the outbound transaction tables, so it
+        # writes to them directly.
+        self._transaction_id_gen = IdGenerator(db_conn, "sent_transactions", "id")
+        self._federation_queue_id_gen = IdGenerator(
+            db_conn, "federation_outbound_queue", "stream_id"
+        )
+
+    # XXX: This is a bit broken because we don't persist the accepted list in a
+    # way that can be replicated. This means that we don't have a way to
+    # invalidate the cache correctly, so for now we expire it every hour.
+    BROKEN_CACHE_EXPIRY_MS = 60 * 60 * 1000
+    get_presence_list_observers_accepted = PresenceStore.__dict__[
+        "get_presence_list_observers_accepted"
+    ]
+
+
+# How often to check whether we need to resend the presence of local users to
+# remote servers, so that they don't time them out.
+PRESENCE_PING_CHECK_MS = 60 * 1000
+
+
+class FederationSenderHandler(object):
+    """Sends the events, presence, typing notifications and receipts that it
+    sees in the replication streams to the interested remote servers.
+    """
+    def __init__(self, hs):
+        self.store = hs.get_datastore()
+        self.clock = hs.get_clock()
+        self.server_name = hs.hostname
+        self.is_mine_id = hs.is_mine_id
+
+        self.transaction_queue = TransactionQueue(hs, TransportLayerClient(hs))
+
+        # The current presence of local users, and when we last sent it to
+        # remote servers.
+        self.user_to_current_state = {
+            state.user_id: state
+            for state in self.store.take_presence_startup_info()
+            if self.is_mine_id(state.user_id)
+        }
+        self.user_to_last_federation_send_ms = {
+            user_id: state.last_federation_update_ts
+            for user_id, state in self.user_to_current_state.items()
+        }
+
+        # The position in the events stream that we have sent events up to.
+        # This is persisted so that we don't miss any events if we restart,
+        # and is loaded when we first replicate.
+        self._events_position = None
+
+        # The users typing in each room, so that we can tell from the typing
+        # stream who started or stopped typing.
+        self._latest_room_serial = 0
+        self._room_typing = {}
+
+        self.clock.looping_call(self._ping_presence, PRESENCE_PING_CHECK_MS)
+
+    @defer.inlineCallbacks
+    def stream_positions(self):
+        if self._events_position is None:
+            position = yield self.store.get_federation_out_pos("events")
+            if position is None:
+                # We've never run before, so start from the current position
+                # rather than sending the whole history.
+                position = self.store.stream_positions()["events"]
+                yield self.store.update_federation_out_pos("events", position)
+            self._events_position = position
+
+        defer.returnValue({
+            "events": self._events_position,
+            "typing": self._latest_room_serial,
+        })
+
+    @defer.inlineCallbacks
+    def process_replication(self, result):
+        stream = result.get("events")
+        if stream:
+            for row in stream["rows"]:
+                internal = json.loads(row[1])
+                event_json = json.loads(row[2])
+                event = FrozenEvent(event_json, internal_metadata_dict=internal)
+                yield self._send_event(event)
+
+            # The events have been queued in the database, so we won't need
+            # to send them again.
+            self._events_position = int(stream["position"])
+            yield self.store.update_federation_out_pos(
+                "events", self._events_position,
+            )
+
+        stream = result.get("presence")
+        if stream:
+            states = []
+            for row in stream["rows"]:
+                (
+                    position, user_id, state, last_active_ts,
+                    last_federation_update_ts, last_user_sync_ts, status_msg,
+                    currently_active
+                ) = row
+                if not self.is_mine_id(user_id):
+                    continue
+                states.append(UserPresenceState(
+                    user_id, state, last_active_ts,
+                    last_federation_update_ts, last_user_sync_ts, status_msg,
+                    currently_active
+                ))
+            yield self._send_presence(self._update_presence(states))
+
+        stream = result.get("typing")
+        if stream:
+            self._latest_room_serial = int(stream["position"])
+            for row in stream["rows"]:
+                position, room_id, typing_json = row
+                yield self._send_typing(room_id, set(json.loads(typing_json)))
+
+        stream = result.get("receipts")
+        if stream:
+            for row in stream["rows"]:
+                position, room_id, receipt_type, user_id, event_id, data = row
+                if self.is_mine_id(user_id):
+                    yield self._send_receipt(
+                        room_id, receipt_type, user_id, event_id, json.loads(data),
+                    )
+
+    @defer.inlineCallbacks
+    def _send_event(self, event):
+        # We only send events that were created on this server, and those
+        # that we have been asked to send on by a remote server, e.g. joins
+        # via send_join.
+        send_on_behalf_of = event.internal_metadata.get_send_on_behalf_of()
+        if not self.is_mine_id(event.sender) and send_on_behalf_of is None:
+            return
+
+        destinations = yield self.store.get_joined_hosts_for_room(event.room_id)
+        destinations = set(destinations)
+
+        if event.type == EventTypes.Member:
+            # Make sure that e.g. users being kicked or banned hear about it.
+            if event.membership in (Membership.LEAVE, Membership.BAN):
+                destinations.add(get_domain_from_id(event.state_key))
+
+        destinations.discard(send_on_behalf_of)
+
+        # If invite, remove room_state from unsigned before sending.
+        event.unsigned.pop("invite_room_state", None)
+
+        yield self.transaction_queue.enqueue_pdu(event, destinations)
+
+        if event.type == EventTypes.Member:
+            if event.membership == Membership.JOIN:
+                yield self._send_presence_on_join(event.room_id, event.state_key)
+
+    @defer.inlineCallbacks
+    def _send_presence_on_join(self, room_id, user_id):
+        """Sends presence to servers that may not have it yet because a user
+        has joined a room, either:
+            1. the joining user is a local user and we send their presence to
+               all servers in the room.
+            2. the joining user is a remote user and so we send presence for all
+               local users in the room.
+        """
+        if self.is_mine_id(user_id):
+            state = self.user_to_current_state.get(user_id)
+            if state is None:
+                return
+
+            hosts = yield self.store.get_joined_hosts_for_room(room_id)
+            for host in hosts:
+                self.transaction_queue.send_presence(host, [state])
+        else:
+            user_ids = yield self.store.get_users_in_room(room_id)
+            states = [
+                self.user_to_current_state[u]
+                for u in user_ids
+                if u in self.user_to_current_state
+            ]
+            if states:
+                self.transaction_queue.send_presence(
+                    get_domain_from_id(user_id), states,
+                )
+
+    def _update_presence(self, states):
+        """Updates the current presence of local users.
+
+        Returns:
+            list(UserPresenceState): The states that should be sent to remote
+            servers, i.e. those that changed in a way worth notifying about,
+            or that we haven't sent for a while.
+        """
+        now = self.clock.time_msec()
+        to_send = []
+        for state in states:
+            prev_state = self.user_to_current_state.get(
+                state.user_id, UserPresenceState.default(state.user_id)
+            )
+            self.user_to_current_state[state.user_id] = state
+
+            last_send = self.user_to_last_federation_send_ms.get(state.user_id, 0)
+            if (should_notify(prev_state, state)
+                    or now - last_send > FEDERATION_PING_INTERVAL):
+                to_send.append(state)
+
+        return to_send
+
+    @defer.inlineCallbacks
+    def _send_presence(self, states):
+        if not states:
+            return
+
+        _, _, hosts_to_states = yield get_interested_parties(
+            self.store, self.is_mine_id, states,
+        )
+
+        for host, host_states in hosts_to_states.items():
+            self.transaction_queue.send_presence(host, host_states)
+
+        now = self.clock.time_msec()
+        for state in states:
+            self.user_to_last_federation_send_ms[state.user_id] = now
+
+    def _ping_presence(self):
+        """Resends the presence of online local users that we haven't sent
+        for a while, so that remote servers don't time them out.
+        """
+        now = self.clock.time_msec()
+        states = [
+            state for user_id, state in self.user_to_current_state.items()
+            if state.state != PresenceState.OFFLINE
+            and now - self.user_to_last_federation_send_ms.get(user_id, 0)
+            > FEDERATION_PING_INTERVAL
+        ]
+        preserve_fn(self._send_presence)(states)
+
+    @defer.inlineCallbacks
+    def _send_typing(self, room_id, typing):
+        prev_typing = self._room_typing.get(room_id, set())
+        self._room_typing[room_id] = typing
+
+        updates = [
+            (user_id, True) for user_id in typing - prev_typing
+        ] + [
+            (user_id, False) for user_id in prev_typing - typing
+        ]
+        updates = [u for u in updates if self.is_mine_id(u[0])]
+        if not updates:
+            return
+
+        hosts = yield self.store.get_joined_hosts_for_room(room_id)
+        for host in hosts:
+            for user_id, is_typing in updates:
+                self.transaction_queue.enqueue_edu(Edu(
+                    origin=self.server_name,
+                    destination=host,
+                    edu_type="m.typing",
+                    content={
+                        "room_id": room_id,
+                        "user_id": user_id,
+                        "typing": is_typing,
+                    },
+                ))
+
+    @defer.inlineCallbacks
+    def _send_receipt(self, room_id, receipt_type, user_id, event_id, data):
+        hosts = yield self.store.get_joined_hosts_for_room(room_id)
+        for host in hosts:
+            self.transaction_queue.enqueue_edu(Edu(
+                origin=self.server_name,
+                destination=host,
+                edu_type="m.receipt",
+                content={
+                    room_id: {
+                        receipt_type: {
+                            user_id: {
+                                "event_ids": [event_id],
+                                "data": data,
+                            }
+                        }
+                    },
+                },
+            ))
+
+
+class FederationSenderServer(HomeServer):
+    def get_db_conn(self, run_new_connection=True):
+        # Any param beginning with cp_ is a parameter for adbapi, and should
+        # not be passed to the database engine.
+        db_params = {
+            k: v for k, v in self.db_config.get("args", {}).items()
+            if not k.startswith("cp_")
+        }
+        db_conn = self.database_engine.module.connect(**db_params)
+
+        if run_new_connection:
+            self.database_engine.on_new_connection(db_conn)
+        return db_conn
+
+    def setup(self):
+        logger.info("Setting up.")
+        self.datastore = FederationSenderSlaveStore(self.get_db_conn(), self)
+        logger.info("Finished setting up.")
+
+    def _listen_http(self, listener_config):
+        port = listener_config["port"]
+        bind_address = listener_config.get("bind_address", "")
+        site_tag = listener_config.get("tag", port)
+        resources = {}
+        for res in listener_config["resources"]:
+            for name in res["names"]:
+                if name == "metrics":
+                    resources[METRICS_PREFIX] = MetricsResource(self)
+
+        root_resource = create_resource_tree(resources, Resource())
+        reactor.listenTCP(
+            port,
+            SynapseSite(
+                "synapse.access.http.%s" % (site_tag,),
+                site_tag,
+                listener_config,
+                root_resource,
+            ),
+            interface=bind_address
+        )
+        logger.info("Synapse federation_sender now listening on port %d", port)
+
+    def start_listening(self):
+        for listener in self.config.listeners:
+            if listener["type"] == "http":
+                self._listen_http(listener)
+            elif listener["type"] == "manhole":
+                reactor.listenTCP(
+                    listener["port"],
+                    manhole(
+                        username="matrix",
+                        password="rabbithole",
+                        globals={"hs": self},
+                    ),
+                    interface=listener.get("bind_address", '127.0.0.1')
+                )
+            else:
+                logger.warn("Unrecognized listener type: %s", listener["type"])
+
+    @defer.inlineCallbacks
+    def replicate(self):
+        http_client = self.get_simple_http_client()
+        store = self.get_datastore()
+        replication_url = self.config.replication_url
+        clock = self.get_clock()
+        sender = FederationSenderHandler(self)
+
+        def expire_broken_caches():
+            store.get_presence_list_observers_accepted.invalidate_all()
+
+        next_expire_broken_caches_ms = 0
+        while True:
+            try:
+                args = store.stream_positions()
+                sender_positions = yield sender.stream_positions()
+                args.update(sender_positions)
+                args["timeout"] = 30000
+                result = yield http_client.get_json(replication_url, args=args)
+                now_ms = clock.time_msec()
+                if now_ms > next_expire_broken_caches_ms:
+                    expire_broken_caches()
+                    next_expire_broken_caches_ms = (
+                        now_ms + store.BROKEN_CACHE_EXPIRY_MS
+                    )
+                yield store.process_replication(result)
+                yield sender.process_replication(result)
+            except:
+                logger.exception("Error replicating from %r", replication_url)
+                yield sleep(5)
+
+
+def setup(config_options):
+    try:
+        config = FederationSenderConfig.load_config(
+            "Synapse federation sender", config_options
+        )
+    except ConfigError as e:
+        sys.stderr.write("\n" + e.message + "\n")
+        sys.exit(1)
+
+    if not config:
+        sys.exit(0)
+
+    config.setup_logging()
+
+    database_engine = create_engine(config.database_config)
+
+    tls_server_context_factory = context_factory.ServerContextFactory(config)
+
+    ss = FederationSenderServer(
+        config.server_name,
+        db_config=config.database_config,
+        tls_server_context_factory=tls_server_context_factory,
+        config=config,
+        version_string=get_version_string("Synapse", synapse),
+        database_engine=database_engine,
+    )
+
+    ss.setup()
+    ss.start_listening()
+
+    change_resource_limit(ss.config.soft_file_limit)
+    if ss.config.gc_thresholds:
+        gc.set_threshold(*ss.config.gc_thresholds)
+
+    def start():
+        ss.get_datastore().start_profiling()
+        ss.replicate()
+
+    reactor.callWhenRunning(start)
+
+    return ss
+
+
+if __name__ == '__main__':
+    with LoggingContext("main"):
+        ss = setup(sys.argv[1:])
+
+        if ss.config.daemonize:
+            def run():
+                with LoggingContext("run"):
+                    change_resource_limit(ss.config.soft_file_limit)
+                    if ss.config.gc_thresholds:
+                        gc.set_threshold(*ss.config.gc_thresholds)
+                    reactor.run()
+
+            daemon = Daemonize(
+                app="synapse-federation-sender",
+                pid=ss.config.pid_file,
+                action=run,
+                auto_close_fds=False,
+                verbose=True,
+                logger=logger,
+            )
+
+            daemon.start()
+        else:
+            reactor.run()
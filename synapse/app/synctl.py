@@ -71,6 +71,11 @@ def main():
     if cache_factor:
         os.environ["SYNAPSE_CACHE_FACTOR"] = str(cache_factor)
 
+    cache_memory_budget = config.get("synctl_cache_memory_budget", None)
+
+    if cache_memory_budget:
+        os.environ["SYNAPSE_CACHE_MEMORY_BUDGET"] = str(cache_memory_budget)
+
     action = sys.argv[1] if sys.argv[1:] else "usage"
     if action == "start":
         start(configfile)
@@ -70,6 +70,11 @@ class ContentRepositoryConfig(Config):
         self.max_upload_size = self.parse_size(config["max_upload_size"])
         self.max_image_pixels = self.parse_size(config["max_image_pixels"])
         self.max_spider_size = self.parse_size(config["max_spider_size"])
+        self.max_remote_media_cache_size = config.get("max_remote_media_cache_size")
+        if self.max_remote_media_cache_size is not None:
+            self.max_remote_media_cache_size = self.parse_size(
+                self.max_remote_media_cache_size
+            )
         self.media_store_path = self.ensure_directory(config["media_store_path"])
         self.uploads_path = self.ensure_directory(config["uploads_path"])
         self.dynamic_thumbnails = config["dynamic_thumbnails"]
@@ -121,6 +126,11 @@ class ContentRepositoryConfig(Config):
         # The largest allowed upload size in bytes
         max_upload_size: "10M"
 
+        # The largest amount of disk space used to cache media (and thumbnails)
+        # from other servers. When the cache grows beyond this the least
+        # recently used media are removed. Defaults to no limit.
+        # max_remote_media_cache_size: "10G"
+
         # Maximum number of pixels that will be thumbnailed
         max_image_pixels: "32M"
 
@@ -31,6 +31,39 @@ class ServerConfig(Config):
         self.public_baseurl = config.get("public_baseurl")
         self.secondary_directory_servers = config.get("secondary_directory_servers", [])
 
+        # Whether this process should send outbound federation traffic. This
+        # is turned off when a federation_sender worker does the sending.
+        self.send_federation = config.get("send_federation", True)
+
+        # Outbound presence updates to each server are coalesced and sent at
+        # most once per interval, unless there are updates for at least
+        # `federation_presence_batch_size` users pending.
+        self.federation_presence_flush_interval_ms = config.get(
+            "federation_presence_flush_interval_ms", 1000
+        )
+        self.federation_presence_batch_size = config.get(
+            "federation_presence_batch_size", 100
+        )
+
+        # Outbound transactions are capped at this many PDUs and EDUs, with
+        # any backlog for a server being sent in subsequent transactions.
+        self.federation_max_pdus_per_transaction = config.get(
+            "federation_max_pdus_per_transaction", 50
+        )
+        self.federation_max_edus_per_transaction = config.get(
+            "federation_max_edus_per_transaction", 100
+        )
+
+        # Queued PDUs and EDUs are dropped once they are this old, or once a
+        # server has more than this many queued, so that the queues of
+        # servers that have gone away don't grow forever.
+        self.federation_queue_max_age_ms = config.get(
+            "federation_queue_max_age_ms", 3 * 24 * 60 * 60 * 1000
+        )
+        self.federation_max_queued_per_destination = config.get(
+            "federation_max_queued_per_destination", 10000
+        )
+
         if self.public_baseurl is not None:
             if self.public_baseurl[-1] != '/':
                 self.public_baseurl += '/'
@@ -183,6 +216,33 @@ class ServerConfig(Config):
         #     - matrix.org
         #     - vector.im
 
+        # Presence updates sent to other servers are coalesced so that only
+        # the latest presence of each user is sent. Pending updates for a
+        # server are sent after this many milliseconds (or sooner, if there is
+        # another transaction to send to it). Set to 0 to send immediately.
+        # federation_presence_flush_interval_ms: 1000
+
+        # Send pending presence updates to a server straight away once there
+        # are updates for this many users.
+        # federation_presence_batch_size: 100
+
+        # The maximum number of PDUs and EDUs to include in a single outbound
+        # transaction. Anything else queued for the server, e.g. a backlog
+        # built up while it was unreachable, is sent in later transactions.
+        # federation_max_pdus_per_transaction: 50
+        # federation_max_edus_per_transaction: 100
+
+        # Queued PDUs and EDUs that still haven't been sent after this long
+        # (three days), or once more than this many are queued for a server,
+        # are dropped. Servers that have been down for longer than that will
+        # miss the dropped events until they next fetch them.
+        # federation_queue_max_age_ms: 259200000
+        # federation_max_queued_per_destination: 10000
+
+        # Set to false if outbound federation is sent by a separate
+        # federation_sender worker, rather than by this process.
+        # send_federation: true
+
         # List of ports that Synapse should listen on, their purpose and their
         # configuration.
         listeners:
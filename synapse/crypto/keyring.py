@@ -18,12 +18,13 @@ from synapse.api.errors import SynapseError, Codes
 from synapse.util.retryutils import get_retry_limiter
 from synapse.util import unwrapFirstError
 from synapse.util.async import ObservableDeferred
+from synapse.util.caches import CACHE_SIZE_FACTOR
+from synapse.util.caches.lrucache import LruCache
 from synapse.util.logcontext import (
-    preserve_context_over_deferred, preserve_context_over_fn, PreserveLoggingContext,
-    preserve_fn
+    preserve_context_over_deferred, PreserveLoggingContext, preserve_fn
 )
 
-from twisted.internet import defer
+from twisted.internet import defer, threads
 
 from signedjson.sign import (
     verify_signed_json, signature_ids, sign_json, encode_canonical_json
@@ -44,6 +45,10 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# The number of verified signatures to remember.
+VERIFIED_SIGNATURES_CACHE_SIZE = int(100000 * CACHE_SIZE_FACTOR)
+
+
 KeyGroup = namedtuple("KeyGroup", ("server_name", "group_id", "key_ids"))
 
 
@@ -58,6 +63,11 @@ class Keyring(object):
 
         self.key_downloads = {}
 
+        # Signatures that we've already checked, so that repeatedly fetching
+        # the same events (e.g. via /state or /backfill) doesn't mean
+        # verifying them all again.
+        self._verified_signatures = LruCache(VERIFIED_SIGNATURES_CACHE_SIZE)
+
     def verify_json_for_server(self, server_name, json_object):
         return self.verify_json_objects_for_server(
             [(server_name, json_object)]
@@ -128,18 +138,7 @@ class Keyring(object):
                     Codes.UNAUTHORIZED,
                 )
 
-            json_object = group_id_to_json[group.group_id]
-
-            try:
-                verify_signed_json(json_object, server_name, verify_key)
-            except:
-                raise SynapseError(
-                    401,
-                    "Invalid signature for server %s with key %s:%s" % (
-                        server_name, verify_key.alg, verify_key.version
-                    ),
-                    Codes.UNAUTHORIZED,
-                )
+            defer.returnValue(verify_key)
 
         server_to_deferred = {
             server_name: defer.Deferred()
@@ -178,17 +177,140 @@ class Keyring(object):
                 server_to_gids.setdefault(server_name, set()).add(g_id)
                 deferred.addBoth(remove_deferreds, server_name, g_id)
 
-        # Pass those keys to handle_key_deferred so that the json object
-        # signatures can be verified
-        return [
-            preserve_context_over_fn(
-                handle_key_deferred,
-                group_id_to_group[g_id],
-                deferreds[g_id],
+        # Pass those keys to handle_key_deferred, and then verify all the
+        # json object signatures together once we have their keys.
+        with PreserveLoggingContext():
+            key_deferreds = [
+                handle_key_deferred(group_id_to_group[g_id], deferreds[g_id])
+                for g_id in group_ids
+            ]
+
+        return self._verify_signatures_in_batch(
+            [
+                (group_id_to_group[g_id].server_name, group_id_to_json[g_id])
+                for g_id in group_ids
+            ],
+            key_deferreds,
+        )
+
+    def _verify_signatures_in_batch(self, server_and_json, key_deferreds):
+        """Waits for the verify keys of the json objects and then checks their
+        signatures in batches on a background thread, so that canonicalising
+        and verifying large numbers of objects doesn't block the reactor.
+
+        The objects are batched by server, and each batch is checked as soon
+        as that server's keys arrive, so a slow key fetch for one server
+        doesn't hold up the objects from the others.
+
+        Args:
+            server_and_json (list): List of pairs of (server_name, json_object)
+            key_deferreds (list): List of deferreds, one per json object, that
+                resolve to the verify key to check that object with.
+
+        Returns:
+            list of deferreds indicating success or failure to verify each
+            json object's signature for the given server_name.
+        """
+        result_deferreds = [defer.Deferred() for _ in key_deferreds]
+
+        server_to_indices = {}
+        for i, (server_name, _) in enumerate(server_and_json):
+            server_to_indices.setdefault(server_name, []).append(i)
+
+        @defer.inlineCallbacks
+        def verify_batch(indices):
+            key_results = yield defer.DeferredList(
+                [key_deferreds[i] for i in indices], consumeErrors=True,
             )
-            for g_id in group_ids
+
+            to_verify = []
+            to_verify_indices = []
+            for i, (success, res) in zip(indices, key_results):
+                if success:
+                    server_name, json_object = server_and_json[i]
+                    to_verify.append((server_name, json_object, res))
+                    to_verify_indices.append(i)
+                else:
+                    result_deferreds[i].errback(res)
+
+            if not to_verify:
+                return
+
+            errors = yield threads.deferToThread(
+                self._verify_signed_json_objects, to_verify,
+            )
+
+            for i, error in zip(to_verify_indices, errors):
+                if error:
+                    result_deferreds[i].errback(error)
+                else:
+                    result_deferreds[i].callback(None)
+
+        def on_err(err, indices):
+            for i in indices:
+                if not result_deferreds[i].called:
+                    result_deferreds[i].errback(err)
+
+        with PreserveLoggingContext():
+            for indices in server_to_indices.values():
+                verify_batch(indices).addErrback(on_err, indices)
+
+        return [
+            preserve_context_over_deferred(d) for d in result_deferreds
         ]
 
+    def _verify_signed_json_objects(self, server_json_and_keys):
+        """Checks the signatures on a list of json objects. This is run on a
+        background thread.
+
+        Objects whose signatures we have already verified are skipped. They are
+        identified by the canonical json of the object, rather than by e.g. an
+        event_id, so that a server can't slip us modified content by reusing
+        the event_id of an event we have previously checked.
+
+        Args:
+            server_json_and_keys (list): List of tuples of
+                (server_name, json_object, verify_key)
+
+        Returns:
+            list: A SynapseError for each object that failed verification, or
+            None if the signature was valid.
+        """
+        results = []
+        for server_name, json_object, verify_key in server_json_and_keys:
+            key_id = "%s:%s" % (verify_key.alg, verify_key.version)
+            try:
+                signature_b64 = json_object["signatures"][server_name][key_id]
+
+                json_object_copy = dict(json_object)
+                del json_object_copy["signatures"]
+                json_object_copy.pop("unsigned", None)
+                message = encode_canonical_json(json_object_copy)
+
+                cache_key = (
+                    server_name, key_id, signature_b64,
+                    hashlib.sha256(message).digest(),
+                )
+                if self._verified_signatures.get(cache_key):
+                    results.append(None)
+                    continue
+
+                verify_key.verify(message, decode_base64(signature_b64))
+            except:
+                results.append(SynapseError(
+                    401,
+                    "Invalid signature for server %s with key %s:%s" % (
+                        server_name, verify_key.alg, verify_key.version
+                    ),
+                    Codes.UNAUTHORIZED,
+                ))
+                continue
+
+            self._verified_signatures.set(cache_key, True)
+            results.append(None)
+
+        return results
+
     @defer.inlineCallbacks
     def wait_for_previous_lookups(self, server_names, server_to_deferred):
         """Waits for any previous key lookups for the given servers to finish.
@@ -275,14 +397,15 @@ class Keyring(object):
                     for server_name, groups in missing_groups.items()
                 }
 
-            for group in missing_groups.values():
-                group_id_to_deferred[group.group_id].errback(SynapseError(
-                    401,
-                    "No key for %s with id %s" % (
-                        group.server_name, group.key_ids,
-                    ),
-                    Codes.UNAUTHORIZED,
-                ))
+            for groups in missing_groups.values():
+                for group in groups:
+                    group_id_to_deferred[group.group_id].errback(SynapseError(
+                        401,
+                        "No key for %s with id %s" % (
+                            group.server_name, group.key_ids,
+                        ),
+                        Codes.UNAUTHORIZED,
+                    ))
 
         def on_err(err):
             for deferred in group_id_to_deferred.values():
@@ -14,7 +14,8 @@
 # limitations under the License.
 
 from synapse.util.frozenutils import freeze
-from synapse.util.caches import intern_dict
+from synapse.util.caches import intern_dict, CACHE_SIZE_FACTOR
+from synapse.util.caches.lrucache import LruCache
 
 
 # Whether we should use frozen_dict in FrozenEvent. Using frozen_dicts prevents
@@ -24,11 +25,37 @@ USE_FROZEN_DICTS = True
 
 
 class _EventInternalMetadata(object):
+    __slots__ = ["_dict"]
+
     def __init__(self, internal_metadata_dict):
-        self.__dict__ = dict(internal_metadata_dict)
+        object.__setattr__(self, "_dict", dict(internal_metadata_dict))
+
+    def __getattr__(self, name):
+        # Only called for attributes that aren't slots or methods
+        if name == "_dict":
+            raise AttributeError(name)
+        try:
+            return self._dict[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self._dict[name] = value
+
+    def __delattr__(self, name):
+        try:
+            del self._dict[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getstate__(self):
+        return self._dict
+
+    def __setstate__(self, state):
+        object.__setattr__(self, "_dict", dict(state))
 
     def get_dict(self):
-        return dict(self.__dict__)
+        return dict(self._dict)
 
     def is_outlier(self):
         return getattr(self, "outlier", False)
@@ -36,6 +63,13 @@ class _EventInternalMetadata(object):
     def is_invite_from_remote(self):
         return getattr(self, "invite_from_remote", False)
 
+    def get_send_on_behalf_of(self):
+        """If this is a remote server's event that we should send on to the
+        other servers in the room (e.g. a join via send_join), returns the
+        server it came from. Otherwise returns None.
+        """
+        return getattr(self, "send_on_behalf_of", None)
+
 
 def _event_dict_property(key):
     def getter(self):
@@ -55,6 +89,11 @@ def _event_dict_property(key):
 
 
 class EventBase(object):
+    __slots__ = [
+        "signatures", "unsigned", "rejected_reason", "_event_dict",
+        "internal_metadata",
+    ]
+
     def __init__(self, event_dict, signatures={}, unsigned={},
                  internal_metadata_dict={}, rejected_reason=None):
         self.signatures = signatures
@@ -91,7 +130,7 @@ class EventBase(object):
         return hasattr(self, "state_key") and self.state_key is not None
 
     def get_dict(self):
-        d = dict(self._event_dict)
+        d = self._get_event_dict()
         d.update({
             "signatures": self.signatures,
             "unsigned": dict(self.unsigned),
@@ -128,17 +167,105 @@ class EventBase(object):
         return field in self._event_dict
 
     def items(self):
-        return self._event_dict.items()
+        return self._get_event_dict().items()
+
+    def _get_event_dict(self):
+        return dict(self._event_dict)
+
+
+def _ascii(s):
+    """Turns ASCII-only unicode strings into byte strings"""
+    if type(s) is unicode:
+        try:
+            return s.encode("ascii")
+        except UnicodeEncodeError:
+            pass
+    return s
+
+
+# The fields FrozenEvents store in slots rather than in their event dict. Small
+# dicts are much cheaper than large ones, so this saves a lot of memory.
+_SLOTTED_FIELDS = (
+    "depth", "event_id", "origin", "origin_server_ts", "room_id", "sender",
+    "state_key", "type",
+)
+
+_ABSENT = object()
+
+
+def _slotted_field_property(key):
+    slot = "_" + key
+
+    def getter(self):
+        try:
+            return getattr(self, slot)
+        except AttributeError:
+            raise KeyError(key)
+
+    return property(getter)
+
+
+# Maps (event_id, hashes) -> frozen event reference, as found in prev_events and
+# auth_events. The same events are referenced by lots of other events (e.g.
+# the create and power levels events in auth_events), so we share references.
+_event_reference_cache = LruCache(int(10000 * CACHE_SIZE_FACTOR))
+
+
+def _intern_event_references(frozen_dict):
+    """Replaces the references to other events in a frozen event dict with
+    shared copies.
+    """
+    replacements = {}
+    for key in ("auth_events", "prev_events", "prev_state"):
+        refs = frozen_dict.get(key)
+        if not refs or type(refs) is not tuple:
+            continue
+
+        interned = []
+        for ref in refs:
+            try:
+                event_id, hashes = ref
+                cache_key = (event_id, tuple(hashes.items()))
+            except (TypeError, ValueError, AttributeError):
+                # Not a well formed reference, so leave it be.
+                interned.append(ref)
+                continue
+
+            interned.append(_event_reference_cache.setdefault(cache_key, ref))
+
+        replacements[key] = tuple(interned)
+
+    if not replacements:
+        return frozen_dict
+
+    d = dict(frozen_dict)
+    d.update(replacements)
+    return type(frozen_dict)(d)
 
 
 class FrozenEvent(EventBase):
+    # FrozenEvents are the bulk of the event cache, so we don't want a
+    # __dict__ per event.
+    __slots__ = ["_" + key for key in _SLOTTED_FIELDS]
+
+    depth = _slotted_field_property("depth")
+    event_id = _slotted_field_property("event_id")
+    origin = _slotted_field_property("origin")
+    origin_server_ts = _slotted_field_property("origin_server_ts")
+    room_id = _slotted_field_property("room_id")
+    sender = _slotted_field_property("sender")
+    state_key = _slotted_field_property("state_key")
+    type = _slotted_field_property("type")
+    user_id = _slotted_field_property("sender")
+
     def __init__(self, event_dict, internal_metadata_dict={}, rejected_reason=None):
         event_dict = dict(event_dict)
 
         # Signatures is a dict of dicts, and this is faster than doing a
-        # copy.deepcopy
+        # copy.deepcopy. The names, key ids and signatures are all ASCII, so we
+        # store them as (smaller) byte strings.
         signatures = {
-            name: {sig_id: sig for sig_id, sig in sigs.items()}
+            _ascii(name): {_ascii(sig_id): _ascii(sig) for sig_id, sig in sigs.items()}
             for name, sigs in event_dict.pop("signatures", {}).items()
         }
 
@@ -148,8 +275,16 @@ class FrozenEvent(EventBase):
         # caching).
         event_dict = intern_dict(event_dict)
 
+        for key in _SLOTTED_FIELDS:
+            value = event_dict.pop(key, _ABSENT)
+            if value is not _ABSENT:
+                if USE_FROZEN_DICTS:
+                    value = freeze(value)
+                setattr(self, "_" + key, value)
+
         if USE_FROZEN_DICTS:
             frozen_dict = freeze(event_dict)
+            frozen_dict = _intern_event_references(frozen_dict)
         else:
             frozen_dict = event_dict
 
@@ -161,6 +296,28 @@ class FrozenEvent(EventBase):
             rejected_reason=rejected_reason,
         )
 
+    def get(self, key, default):
+        if key in _SLOTTED_FIELDS:
+            return getattr(self, "_" + key, default)
+        return self._event_dict.get(key, default)
+
+    def __getitem__(self, field):
+        value = self.get(field, _ABSENT)
+        if value is _ABSENT:
+            raise KeyError(field)
+        return value
+
+    def __contains__(self, field):
+        return self.get(field, _ABSENT) is not _ABSENT
+
+    def _get_event_dict(self):
+        d = dict(self._event_dict)
+        for key in _SLOTTED_FIELDS:
+            value = getattr(self, "_" + key, _ABSENT)
+            if value is not _ABSENT:
+                d[key] = value
+        return d
+
     @staticmethod
     def from_event(event):
         e = FrozenEvent(
@@ -15,9 +15,24 @@
 
 
 class EventContext(object):
+    """
+    Attributes:
+        current_state (dict): (type, state_key) -> event, the state of the
+            room before the event.
+        state_group (int|None): The state group the event should be assigned,
+            if its state matches an existing state group.
+        prev_group (int|None): If a new state group needs to be created then
+            this is an existing state group that the new group can be stored as
+            a delta against.
+        delta_ids (dict|None): (type, state_key) -> event_id, the difference
+            between `prev_group` and the state group being created (including
+            the event itself, if it is a state event).
+    """
 
     def __init__(self, current_state=None):
         self.current_state = current_state
         self.state_group = None
+        self.prev_group = None
+        self.delta_ids = None
         self.rejected = False
         self.push_actions = []
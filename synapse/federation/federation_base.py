@@ -14,7 +14,7 @@
 # limitations under the License.
 
 
-from twisted.internet import defer
+from twisted.internet import defer, threads
 
 from synapse.events.utils import prune_event
 
@@ -23,6 +23,8 @@ from synapse.crypto.event_signing import check_event_content_hash
 from synapse.api.errors import SynapseError
 
 from synapse.util import unwrapFirstError
+from synapse.util.async import ObservableDeferred
+from synapse.util.logcontext import preserve_context_over_fn
 
 import logging
 
@@ -131,8 +133,25 @@ class FederationBase(object):
             for p in redacted_pdus
         ])
 
-        def callback(_, pdu, redacted):
-            if not check_event_content_hash(pdu):
+        # Check all the content hashes in one go on a background thread, while
+        # the signatures are being checked.
+        content_hash_results = ObservableDeferred(
+            preserve_context_over_fn(
+                threads.deferToThread, _check_event_content_hashes, pdus,
+            ),
+            consumeErrors=True,
+        )
+
+        def check_content_hash(_, idx):
+            d = content_hash_results.observe()
+            d.addCallback(lambda results: results[idx])
+            return d
+
+        def callback(result, pdu, redacted):
+            if isinstance(result, Exception):
+                raise result
+
+            if not result:
                 logger.warn(
                     "Event content has been tampered, redacting %s: %s",
                     pdu.event_id, pdu.get_pdu_json()
@@ -148,11 +167,30 @@ class FederationBase(object):
             )
             return failure
 
-        for deferred, pdu, redacted in zip(deferreds, pdus, redacted_pdus):
+        for idx, (deferred, pdu, redacted) in enumerate(
+            zip(deferreds, pdus, redacted_pdus)
+        ):
             deferred.addCallbacks(
-                callback, errback,
-                callbackArgs=[pdu, redacted],
+                check_content_hash, errback,
+                callbackArgs=[idx],
                 errbackArgs=[pdu],
-            )
+            ).addCallback(callback, pdu, redacted)
 
         return deferreds
+
+
+def _check_event_content_hashes(pdus):
+    """Checks the content hashes of a list of PDUs. This is run on a
+    background thread.
+
+    Returns:
+        list: For each PDU, whether its content hash matched, or the
+        SynapseError raised while checking it.
+    """
+    results = []
+    for pdu in pdus:
+        try:
+            results.append(check_event_content_hash(pdu))
+        except SynapseError as e:
+            results.append(e)
+    return results
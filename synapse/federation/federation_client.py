@@ -78,15 +78,12 @@ class FederationClient(FederationBase):
             Deferred: Completes when we have successfully processed the PDU
             and replicated it to any interested remote home servers.
         """
-        order = self._order
-        self._order += 1
-
         sent_pdus_destination_dist.inc_by(len(destinations))
 
         logger.debug("[%s] transaction_layer.enqueue_pdu... ", pdu.event_id)
 
         # TODO, add errback, etc.
-        self._transaction_queue.enqueue_pdu(pdu, destinations, order)
+        self._transaction_queue.enqueue_pdu(pdu, destinations)
 
         logger.debug(
             "[%s] transaction_layer.enqueue_pdu... done",
@@ -108,6 +105,16 @@ class FederationClient(FederationBase):
         self._transaction_queue.enqueue_edu(edu)
         return defer.succeed(None)
 
+    def send_presence(self, destination, states):
+        """Sends presence updates to the destination, coalescing them with
+        any other pending updates for that destination.
+
+        Args:
+            destination (str)
+            states (list(UserPresenceState))
+        """
+        self._transaction_queue.send_presence(destination, states)
+
     @log_function
     def send_failure(self, failure, destination):
         self._transaction_queue.enqueue_failure(failure, destination)
@@ -19,6 +19,7 @@ from twisted.internet import defer
 from .federation_base import FederationBase
 from .units import Transaction, Edu
 
+from synapse.util.async import concurrently_execute
 from synapse.util.logutils import log_function
 from synapse.events import FrozenEvent
 import synapse.metrics
@@ -123,18 +124,34 @@ class FederationServer(FederationBase):
 
         logger.debug("[%s] Transaction is new", transaction.transaction_id)
 
-        results = []
-
+        # We process the PDUs for each room in order, but process different
+        # rooms concurrently so that one slow room doesn't hold up the rest.
+        pdus_by_room = {}
         for pdu in pdu_list:
-            try:
-                yield self._handle_new_pdu(transaction.origin, pdu)
-                results.append({})
-            except FederationError as e:
-                self.send_failure(e, transaction.origin)
-                results.append({"error": str(e)})
-            except Exception as e:
-                results.append({"error": str(e)})
-                logger.exception("Failed to handle PDU")
+            pdus_by_room.setdefault(pdu.room_id, []).append(pdu)
+
+        pdu_results = {}
+
+        @defer.inlineCallbacks
+        def process_pdus_for_room(room_id):
+            with (yield self._origin_pdu_limiter.queue(transaction.origin)):
+                with (yield self._pdu_limiter.queue(None)):
+                    for pdu in pdus_by_room[room_id]:
+                        try:
+                            yield self._handle_new_pdu(transaction.origin, pdu)
+                            pdu_results[pdu.event_id] = {}
+                        except FederationError as e:
+                            self.send_failure(e, transaction.origin)
+                            pdu_results[pdu.event_id] = {"error": str(e)}
+                        except Exception as e:
+                            pdu_results[pdu.event_id] = {"error": str(e)}
+                            logger.exception("Failed to handle PDU")
+
+        yield concurrently_execute(
+            process_pdus_for_room, pdus_by_room.keys(), len(pdus_by_room),
+        )
+
+        results = [pdu_results[p.event_id] for p in pdu_list]
 
         if hasattr(transaction, "edus"):
             for edu in (Edu(**x) for x in transaction.edus):
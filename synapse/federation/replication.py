@@ -24,11 +24,18 @@ from .transaction_queue import TransactionQueue
 
 from .persistence import TransactionActions
 
+from synapse.util.async import Limiter
+
 import logging
 
 
 logger = logging.getLogger(__name__)
 
+# The maximum number of rooms we handle incoming PDUs for concurrently, from
+# each origin server and in total.
+MAX_CONCURRENT_ROOMS_PER_ORIGIN = 10
+MAX_CONCURRENT_ROOMS = 100
+
 
 class ReplicationLayer(FederationClient, FederationServer):
     """This layer is responsible for replicating with remote home servers over
@@ -68,7 +75,10 @@ class ReplicationLayer(FederationClient, FederationServer):
         self.transaction_actions = TransactionActions(self.store)
         self._transaction_queue = TransactionQueue(hs, transport_layer)
 
-        self._order = 0
+        # Limits how many rooms' worth of incoming PDUs we process at once,
+        # both from each origin server and in total.
+        self._origin_pdu_limiter = Limiter(MAX_CONCURRENT_ROOMS_PER_ORIGIN)
+        self._pdu_limiter = Limiter(MAX_CONCURRENT_ROOMS)
 
         self.hs = hs
 
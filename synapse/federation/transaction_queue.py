@@ -17,17 +17,19 @@
 from twisted.internet import defer
 
 from .persistence import TransactionActions
-from .units import Transaction
+from .units import Transaction, Edu
 
 from synapse.api.errors import HttpResponseException
+from synapse.handlers.presence import format_user_presence_state
 from synapse.util.async import run_on_reactor
 from synapse.util.logutils import log_function
-from synapse.util.logcontext import PreserveLoggingContext
+from synapse.util.logcontext import PreserveLoggingContext, preserve_fn
 from synapse.util.retryutils import (
     get_retry_limiter, NotRetryingDestination,
 )
 import synapse.metrics
 
+import itertools
 import logging
 
 
@@ -35,12 +37,23 @@ logger = logging.getLogger(__name__)
 
 metrics = synapse.metrics.get_metrics_for(__name__)
 
+# How often to retry destinations that failed with PDUs or EDUs still queued.
+RETRY_QUEUED_DESTINATIONS_INTERVAL_MS = 60 * 1000
+
+# How often to drop PDUs and EDUs that have been queued for too long.
+PRUNE_QUEUE_INTERVAL_MS = 60 * 60 * 1000
+
 
 class TransactionQueue(object):
     """This class makes sure we only have one transaction in flight at
     a time for a given destination.
 
-    It batches pending PDUs into single transactions.
+    It batches pending PDUs into single transactions. PDUs and EDUs are queued
+    in the database, so that they survive restarts, and are sent to each
+    destination in order, at most `federation_max_pdus_per_transaction` PDUs
+    and `federation_max_edus_per_transaction` EDUs at a time. Presence and
+    typing notifications are only kept in memory, as they are soon out of
+    date anyway.
     """
 
     def __init__(self, hs, transport_layer):
@@ -63,33 +76,82 @@ class TransactionQueue(object):
             lambda: len(self.pending_transactions),
         )
 
-        # Is a mapping from destination -> list of
-        # tuple(pending pdus, deferred, order)
-        self.pending_pdus_by_dest = pdus = {}
-        # destination -> list of tuple(edu, deferred)
-        self.pending_edus_by_dest = edus = {}
+        # Destinations that may have PDUs or EDUs queued in the database.
+        self.destinations_with_queue = queued = set()
+
+        metrics.register_callback(
+            "queued_destinations",
+            lambda: len(queued),
+        )
+
+        # Destinations that we failed to send queued PDUs and EDUs to, which
+        # are periodically retried.
+        self._destinations_to_retry = set()
+
+        self._queue_max_age_ms = hs.config.federation_queue_max_age_ms
+        self._max_queued_per_destination = (
+            hs.config.federation_max_queued_per_destination
+        )
+
+        self._max_pdus_per_transaction = (
+            hs.config.federation_max_pdus_per_transaction
+        )
+        self._max_edus_per_transaction = (
+            hs.config.federation_max_edus_per_transaction
+        )
+
+        # destination -> user_id -> UserPresenceState. Only the latest
+        # presence of each user is kept, and is sent as a single EDU.
+        self.pending_presence_by_dest = presence = {}
 
         metrics.register_callback(
-            "pending_pdus",
-            lambda: sum(map(len, pdus.values())),
+            "pending_presence",
+            lambda: sum(map(len, presence.values())),
         )
+
+        # destination -> (room_id, user_id) -> content of the latest m.typing
+        # EDU for the user in the room.
+        self.pending_typing_by_dest = typing = {}
+
         metrics.register_callback(
-            "pending_edus",
-            lambda: sum(map(len, edus.values())),
+            "pending_typing",
+            lambda: sum(map(len, typing.values())),
         )
 
         # destination -> list of tuple(failure, deferred)
         self.pending_failures_by_dest = {}
 
+        self._presence_flush_interval_ms = (
+            hs.config.federation_presence_flush_interval_ms
+        )
+        self._presence_batch_size = hs.config.federation_presence_batch_size
+        self._presence_flush_timer = None
+
         # HACK to get unique tx id
         self._next_txn_id = int(self._clock.time_msec())
 
+        # If false then a federation_sender worker sends everything instead,
+        # so this process doesn't send anything.
+        self._send_federation = hs.config.send_federation
+
+        # Pick up anything that was queued before we restarted, and then
+        # periodically retry destinations that we failed to send to, e.g.
+        # because they were down.
+        if self._send_federation:
+            self._clock.looping_call(
+                self._retry_queued_destinations,
+                RETRY_QUEUED_DESTINATIONS_INTERVAL_MS,
+            )
+            self._clock.looping_call(self._prune_queue, PRUNE_QUEUE_INTERVAL_MS)
+            self._load_queued_destinations()
+
     def can_send_to(self, destination):
         """Can we send messages to the given server?
 
         We can't send messages to ourselves. If we are running on localhost
         then we can only federation with other servers running on localhost.
-        Otherwise we only federate with servers on a public domain.
+        Otherwise we only federate with servers on a public domain. We don't
+        send anything if a federation_sender worker is sending for us.
 
         Args:
             destination(str): The server we are possibly trying to send to.
@@ -97,6 +159,9 @@ class TransactionQueue(object):
             bool: True if we can send to the server.
         """
 
+        if not self._send_federation:
+            return False
+
         if destination == self.server_name:
             return False
         if self.server_name.startswith("localhost"):
@@ -104,11 +169,7 @@ class TransactionQueue(object):
         else:
             return not destination.startswith("localhost")
 
-    def enqueue_pdu(self, pdu, destinations, order):
-        # We loop through all destinations to see whether we already have
-        # a transaction in progress. If we do, stick it in the pending_pdus
-        # table and we'll get back to it later.
-
+    def enqueue_pdu(self, pdu, destinations):
         destinations = set(destinations)
         destinations = set(
             dest for dest in destinations if self.can_send_to(dest)
@@ -119,53 +180,131 @@ class TransactionQueue(object):
         if not destinations:
             return
 
-        deferreds = []
+        return preserve_fn(self._queue_pdu)(pdu, destinations)
 
-        for destination in destinations:
-            deferred = defer.Deferred()
-            self.pending_pdus_by_dest.setdefault(destination, []).append(
-                (pdu, deferred, order)
+    @defer.inlineCallbacks
+    def _queue_pdu(self, pdu, destinations):
+        try:
+            yield self.store.add_pdu_to_federation_queue(
+                pdu.event_id, destinations,
             )
+        except Exception:
+            logger.exception("Failed to queue pdu %s", pdu.event_id)
+            return
 
-            def chain(failure):
-                if not deferred.called:
-                    deferred.errback(failure)
-
-            def log_failure(f):
-                logger.warn("Failed to send pdu to %s: %s", destination, f.value)
-
-            deferred.addErrback(log_failure)
-
-            with PreserveLoggingContext():
-                self._attempt_new_transaction(destination).addErrback(chain)
-
-            deferreds.append(deferred)
+        for destination in destinations:
+            self._start_sending(destination)
 
-    # NO inlineCallbacks
     def enqueue_edu(self, edu):
         destination = edu.destination
 
         if not self.can_send_to(destination):
             return
 
-        deferred = defer.Deferred()
-        self.pending_edus_by_dest.setdefault(destination, []).append(
-            (edu, deferred)
-        )
+        if edu.edu_type == "m.typing":
+            # Only the latest typing notification of each user in each room
+            # is worth sending.
+            pending = self.pending_typing_by_dest.setdefault(destination, {})
+            pending[(edu.content["room_id"], edu.content["user_id"])] = (
+                edu.content
+            )
 
-        def chain(failure):
-            if not deferred.called:
-                deferred.errback(failure)
+            with PreserveLoggingContext():
+                self._attempt_new_transaction(destination)
+            return
 
-        def log_failure(f):
-            logger.warn("Failed to send edu to %s: %s", destination, f.value)
+        return preserve_fn(self._queue_edu)(edu)
 
-        deferred.addErrback(log_failure)
+    @defer.inlineCallbacks
+    def _queue_edu(self, edu):
+        try:
+            yield self.store.add_edu_to_federation_queue(
+                edu.destination, edu.edu_type, edu.content,
+            )
+        except Exception:
+            logger.exception("Failed to queue edu for %s", edu.destination)
+            return
+
+        self._start_sending(edu.destination)
+
+    def _start_sending(self, destination):
+        """Notes that the destination has PDUs or EDUs queued and starts a
+        transaction to it if there isn't already one in progress.
+        """
+        self.destinations_with_queue.add(destination)
 
         with PreserveLoggingContext():
-            self._attempt_new_transaction(destination).addErrback(chain)
+            self._attempt_new_transaction(destination)
+
+    @defer.inlineCallbacks
+    def _load_queued_destinations(self):
+        """Starts sending to the destinations that had PDUs or EDUs queued
+        before we restarted.
+        """
+        try:
+            destinations = yield self.store.get_destinations_with_federation_queue()
 
-        return deferred
+            for destination in destinations:
+                self._start_sending(destination)
+        except Exception:
+            logger.exception("Failed to load destinations with queued federation")
+
+    def _retry_queued_destinations(self):
+        destinations = self._destinations_to_retry
+        self._destinations_to_retry = set()
+
+        for destination in destinations:
+            self._start_sending(destination)
+
+    @defer.inlineCallbacks
+    def _prune_queue(self):
+        try:
+            pruned = yield self.store.prune_federation_queue(
+                self._queue_max_age_ms, self._max_queued_per_destination,
+            )
+            if pruned:
+                logger.info(
+                    "Dropped %d PDUs and EDUs from the outbound federation queue",
+                    pruned,
+                )
+        except Exception:
+            logger.exception("Failed to prune outbound federation queue")
+
+    def send_presence(self, destination, states):
+        """Queue presence updates to be sent to the given destination.
+
+        Updates are coalesced so that only the latest presence of each user
+        is sent. Pending updates are sent with the next transaction to the
+        destination, or after `federation_presence_flush_interval_ms` if
+        there isn't one, or straight away once there are updates for
+        `federation_presence_batch_size` users.
+
+        Args:
+            destination (str)
+            states (list(UserPresenceState))
+        """
+        if not self.can_send_to(destination):
+            return
+
+        pending = self.pending_presence_by_dest.setdefault(destination, {})
+        pending.update((state.user_id, state) for state in states)
+
+        if (not self._presence_flush_interval_ms
+                or len(pending) >= self._presence_batch_size):
+            with PreserveLoggingContext():
+                self._attempt_new_transaction(destination)
+        elif self._presence_flush_timer is None:
+            self._presence_flush_timer = self._clock.call_later(
+                self._presence_flush_interval_ms / 1000., self._flush_presence
+            )
+
+    def _flush_presence(self):
+        """Starts transactions for all destinations with pending presence.
+        """
+        self._presence_flush_timer = None
+        for destination in self.pending_presence_by_dest.keys():
+            with PreserveLoggingContext():
+                self._attempt_new_transaction(destination)
 
     @defer.inlineCallbacks
     def enqueue_failure(self, failure, destination):
@@ -202,10 +341,10 @@ class TransactionQueue(object):
     def _attempt_new_transaction(self, destination):
         yield run_on_reactor()
 
-        # list of (pending_pdu, deferred, order)
         if destination in self.pending_transactions:
             # XXX: pending_transactions can get stuck on by a never-ending
-            # request at which point pending_pdus_by_dest just keeps growing.
+            # request at which point the queue for the destination just keeps
+            # growing.
             # we need application-layer timeouts of some flavour of these
             # requests
             logger.debug(
@@ -214,48 +353,112 @@ class TransactionQueue(object):
             )
             return
 
-        pending_pdus = self.pending_pdus_by_dest.pop(destination, [])
-        pending_edus = self.pending_edus_by_dest.pop(destination, [])
         pending_failures = self.pending_failures_by_dest.pop(destination, [])
-
-        if pending_pdus:
-            logger.debug("TX [%s] len(pending_pdus_by_dest[dest]) = %d",
-                         destination, len(pending_pdus))
-
-        if not pending_pdus and not pending_edus and not pending_failures:
+        pending_presence = self.pending_presence_by_dest.pop(destination, {})
+        pending_typing = self.pending_typing_by_dest.pop(destination, {})
+
+        # We're about to read everything queued for the destination so far.
+        # Anything queued while the transaction is in flight will re-add it.
+        has_queue = destination in self.destinations_with_queue
+        self.destinations_with_queue.discard(destination)
+        if has_queue:
+            self._destinations_to_retry.discard(destination)
+
+        if (not has_queue and not pending_failures and not pending_presence
+                and not pending_typing):
             logger.debug("TX [%s] Nothing to send", destination)
             return
 
+        deferreds = [x[1] for x in pending_failures]
+
         try:
             self.pending_transactions[destination] = 1
 
             logger.debug("TX [%s] _attempt_new_transaction", destination)
 
-            # Sort based on the order field
-            pending_pdus.sort(key=lambda t: t[2])
-
-            pdus = [x[0] for x in pending_pdus]
-            edus = [x[0] for x in pending_edus]
-            failures = [x[0].get_dict() for x in pending_failures]
-            deferreds = [
-                x[1]
-                for x in pending_pdus + pending_edus + pending_failures
-            ]
-
-            txn_id = str(self._next_txn_id)
-
+            # Check whether we can send to the destination before we read its
+            # queue, so that we don't keep reading the queues of servers that
+            # are down.
             limiter = yield get_retry_limiter(
                 destination,
                 self._clock,
                 self.store,
             )
 
+            pdu_rows, edu_rows = [], []
+            if has_queue:
+                pdu_rows, edu_rows = yield (
+                    self.store.get_federation_queue_for_destination(
+                        destination,
+                        self._max_pdus_per_transaction,
+                        self._max_edus_per_transaction,
+                    )
+                )
+
+            if (not pdu_rows and not edu_rows and not pending_failures
+                    and not pending_presence and not pending_typing):
+                logger.debug("TX [%s] Nothing to send", destination)
+                return
+
+            if pdu_rows:
+                logger.debug("TX [%s] len(pdu_rows) = %d",
+                             destination, len(pdu_rows))
+
+            stream_ids = [
+                row[0] for row in itertools.chain(pdu_rows, edu_rows)
+            ]
+
+            pdus = []
+            if pdu_rows:
+                event_map = yield self.store.get_events(
+                    [event_id for _, event_id in pdu_rows]
+                )
+                pdus = [
+                    event_map[event_id]
+                    for _, event_id in pdu_rows
+                    if event_id in event_map
+                ]
+            edus = [
+                Edu(
+                    origin=self.server_name,
+                    destination=destination,
+                    edu_type=edu_type,
+                    content=content,
+                )
+                for _, edu_type, content in edu_rows
+            ]
+            edus.extend(
+                Edu(
+                    origin=self.server_name,
+                    destination=destination,
+                    edu_type="m.typing",
+                    content=content,
+                )
+                for content in pending_typing.values()
+            )
+            if pending_presence:
+                now = self._clock.time_msec()
+                edus.append(Edu(
+                    origin=self.server_name,
+                    destination=destination,
+                    edu_type="m.presence",
+                    content={
+                        "push": [
+                            format_user_presence_state(state, now)
+                            for state in pending_presence.values()
+                        ],
+                    },
+                ))
+            failures = [x[0].get_dict() for x in pending_failures]
+
+            txn_id = str(self._next_txn_id)
+
             logger.debug(
                 "TX [%s] {%s} Attempting new transaction"
                 " (pdus: %d, edus: %d, failures: %d)",
                 destination, txn_id,
-                len(pending_pdus),
-                len(pending_edus),
+                len(pdus),
+                len(edus),
                 len(pending_failures)
             )
 
@@ -281,8 +484,8 @@ class TransactionQueue(object):
                 " (PDUs: %d, EDUs: %d, failures: %d)",
                 destination, txn_id,
                 transaction.transaction_id,
-                len(pending_pdus),
-                len(pending_edus),
+                len(pdus),
+                len(edus),
                 len(pending_failures),
             )
 
@@ -333,6 +536,24 @@ class TransactionQueue(object):
 
             logger.debug("TX [%s] Marked as delivered", destination)
 
+            if code != 200:
+                logger.warn(
+                    "TX [%s] {%s} Dropping %d queued PDUs and EDUs after"
+                    " %d response",
+                    destination, txn_id, len(stream_ids), code,
+                )
+
+            if stream_ids:
+                yield self.store.remove_from_federation_queue(
+                    destination, stream_ids,
+                )
+
+            # If we sent a full transaction there may be more queued, which
+            # will be picked up by the attempt below.
+            if (len(pdu_rows) >= self._max_pdus_per_transaction
+                    or len(edu_rows) >= self._max_edus_per_transaction):
+                self.destinations_with_queue.add(destination)
+
             logger.debug("TX [%s] Yielding to callbacks...", destination)
 
             for deferred in deferreds:
@@ -355,6 +576,8 @@ class TransactionQueue(object):
                 "dropping transaction for now",
                 destination,
             )
+            if has_queue:
+                self._destinations_to_retry.add(destination)
         except RuntimeError as e:
             # We capture this here as there as nothing actually listens
             # for this finishing functions deferred.
@@ -363,6 +586,8 @@ class TransactionQueue(object):
                 destination,
                 e,
             )
+            if has_queue:
+                self._destinations_to_retry.add(destination)
         except Exception as e:
             # We capture this here as there as nothing actually listens
             # for this finishing functions deferred.
@@ -371,6 +596,8 @@ class TransactionQueue(object):
                 destination,
                 e,
             )
+            if has_queue:
+                self._destinations_to_retry.add(destination)
 
             for deferred in deferreds:
                 if not deferred.called:
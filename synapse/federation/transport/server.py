@@ -33,9 +33,10 @@ logger = logging.getLogger(__name__)
 class TransportLayerServer(JsonResource):
     """Handles incoming federation HTTP requests"""
 
-    def __init__(self, hs):
+    def __init__(self, hs, servlet_classes=None):
         self.hs = hs
         self.clock = hs.get_clock()
+        self.servlet_classes = servlet_classes or SERVLET_CLASSES
 
         super(TransportLayerServer, self).__init__(hs)
 
@@ -57,6 +58,7 @@ class TransportLayerServer(JsonResource):
             resource=self,
             ratelimiter=self.ratelimiter,
             authenticator=self.authenticator,
+            servlet_classes=self.servlet_classes,
         )
 
 
@@ -562,13 +564,31 @@ SERVLET_CLASSES = (
     PublicRoomList,
 )
 
+# The servlets that only read from the database, and so can be served by a
+# federation_reader worker rather than by the main process.
+READ_ONLY_SERVLET_CLASSES = (
+    FederationEventServlet,
+    FederationStateServlet,
+    FederationBackfillServlet,
+    FederationQueryServlet,
+    FederationEventAuthServlet,
+    FederationGetMissingEventsServlet,
+)
+
+
+def register_servlets(hs, resource, authenticator, ratelimiter,
+                      servlet_classes=SERVLET_CLASSES):
+    # The room list handler polls remote servers for their room lists, so we
+    # only create it if we're going to serve the public room list.
+    room_list_handler = None
+    if PublicRoomList in servlet_classes:
+        room_list_handler = hs.get_room_list_handler()
 
-def register_servlets(hs, resource, authenticator, ratelimiter):
-    for servletclass in SERVLET_CLASSES:
+    for servletclass in servlet_classes:
         servletclass(
             handler=hs.get_replication_layer(),
             authenticator=authenticator,
             ratelimiter=ratelimiter,
             server_name=hs.hostname,
-            room_list_handler=hs.get_room_list_handler(),
+            room_list_handler=room_list_handler,
         ).register(resource)
@@ -39,7 +39,6 @@ from synapse.events.utils import prune_event
 
 from synapse.util.retryutils import NotRetryingDestination
 
-from synapse.push.action_generator import ActionGenerator
 from synapse.util.distributor import user_joined_room
 
 from twisted.internet import defer
@@ -71,6 +70,11 @@ class FederationHandler(BaseHandler):
         self.state_handler = hs.get_state_handler()
         self.server_name = hs.hostname
         self.keyring = hs.get_keyring()
+        self.action_generator = hs.get_action_generator()
+
+        # If false then a federation_sender worker sends events to other
+        # servers, based on the events it sees in the replication stream.
+        self.send_federation = hs.config.send_federation
 
         self.replication_layer.set_handler(self)
 
@@ -90,6 +94,8 @@ class FederationHandler(BaseHandler):
             Deferred: Resolved when it has successfully been queued for
             processing.
         """
+        if not self.send_federation:
+            return
 
         return self.replication_layer.send_pdu(event, destinations)
 
@@ -705,6 +711,9 @@ class FederationHandler(BaseHandler):
         )
 
         event.internal_metadata.outlier = False
+        # Send this event on to the other servers in the room, as the origin
+        # won't do it itself.
+        event.internal_metadata.send_on_behalf_of = origin
 
         context, event_stream_id, max_stream_id = yield self._handle_new_event(
             origin, event
@@ -754,7 +763,8 @@ class FederationHandler(BaseHandler):
             event.signatures,
         )
 
-        self.replication_layer.send_pdu(new_pdu, destinations)
+        if self.send_federation:
+            self.replication_layer.send_pdu(new_pdu, destinations)
 
         state_ids = [e.event_id for e in context.current_state.values()]
         auth_chain = yield self.store.get_auth_chain(set(
@@ -936,6 +946,9 @@ class FederationHandler(BaseHandler):
         )
 
         event.internal_metadata.outlier = False
+        # Send this event on to the other servers in the room, as the origin
+        # won't do it itself.
+        event.internal_metadata.send_on_behalf_of = origin
 
         context, event_stream_id, max_stream_id = yield self._handle_new_event(
             origin, event
@@ -980,7 +993,8 @@ class FederationHandler(BaseHandler):
             event.signatures,
         )
 
-        self.replication_layer.send_pdu(new_pdu, destinations)
+        if self.send_federation:
+            self.replication_layer.send_pdu(new_pdu, destinations)
 
         defer.returnValue(None)
 
@@ -1098,8 +1112,7 @@ class FederationHandler(BaseHandler):
         )
 
         if not event.internal_metadata.is_outlier():
-            action_generator = ActionGenerator(self.hs)
-            yield action_generator.handle_push_actions_for_event(
+            yield self.action_generator.handle_push_actions_for_event(
                 event, context
             )
 
@@ -1423,6 +1436,8 @@ class FederationHandler(BaseHandler):
 
                 context.current_state.update(auth_events)
                 context.state_group = None
+                context.prev_group = None
+                context.delta_ids = None
 
         if different_auth and not event.internal_metadata.is_outlier():
             logger.info("Different auth after resolution: %s", different_auth)
@@ -1502,6 +1517,8 @@ class FederationHandler(BaseHandler):
 
                 context.current_state.update(auth_events)
                 context.state_group = None
+                context.prev_group = None
+                context.delta_ids = None
 
         try:
             self.auth.check(event, auth_events=auth_events)
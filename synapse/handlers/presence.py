@@ -29,6 +29,7 @@ from synapse.api.errors import SynapseError
 from synapse.api.constants import PresenceState
 from synapse.storage.presence import UserPresenceState
 
+from synapse.util.async import run_on_reactor
 from synapse.util.logcontext import preserve_fn
 from synapse.util.logutils import log_function
 from synapse.util.metrics import Measure
@@ -74,6 +75,10 @@ FEDERATION_PING_INTERVAL = 25 * 60 * 1000
 # are dead.
 EXTERNAL_PROCESS_EXPIRY = 5 * 60 * 1000
 
+# The maximum number of presence updates or timeouts to process before yielding
+# back to the reactor. Each batch is persisted and notified separately.
+PRESENCE_BATCH_SIZE = 500
+
 assert LAST_ACTIVE_GRANULARITY < IDLE_TIMER
 
 
@@ -87,6 +92,7 @@ class PresenceHandler(object):
         self.wheel_timer = WheelTimer()
         self.notifier = hs.get_notifier()
         self.federation = hs.get_replication_layer()
+        self.send_federation = hs.config.send_federation
 
         self.federation.register_edu_handler(
             "m.presence", self.incoming_presence
@@ -219,6 +225,20 @@ class PresenceHandler(object):
         """Updates presence of users. Sets the appropriate timeouts. Pokes
         the notifier and federation if and only if the changed presence state
         should be sent to clients/servers.
+
+        Large numbers of updates (e.g. when a remote server comes back after
+        an outage) are processed in batches of PRESENCE_BATCH_SIZE, yielding
+        to the reactor between each batch.
+        """
+        new_states = list(new_states)
+        for i in xrange(0, len(new_states), PRESENCE_BATCH_SIZE):
+            if i:
+                yield run_on_reactor()
+            yield self._update_states_batch(new_states[i:i + PRESENCE_BATCH_SIZE])
+
+    @defer.inlineCallbacks
+    def _update_states_batch(self, new_states):
+        """Updates presence of a batch of users, see `_update_states`.
         """
         now = self.clock.time_msec()
 
@@ -270,7 +290,7 @@ class PresenceHandler(object):
                 user_id: state for user_id, state in to_federation_ping.items()
                 if user_id not in to_notify
             }
-            if to_federation_ping:
+            if to_federation_ping and self.send_federation:
                 federation_presence_out_counter.inc_by(len(to_federation_ping))
 
                 _, _, hosts_to_states = yield self._get_interested_parties(
@@ -287,44 +307,63 @@ class PresenceHandler(object):
         now = self.clock.time_msec()
 
         try:
-            with Measure(self.clock, "presence_handle_timeouts"):
-                # Fetch the list of users that *may* have timed out. Things may have
-                # changed since the timeout was set, so we won't necessarily have to
-                # take any action.
-                users_to_check = set(self.wheel_timer.fetch(now))
-
-                # Check whether the lists of syncing processes from an external
-                # process have expired.
-                expired_process_ids = [
-                    process_id for process_id, last_update
-                    in self.external_process_last_updated_ms.items()
-                    if now - last_update > EXTERNAL_PROCESS_EXPIRY
-                ]
-                for process_id in expired_process_ids:
-                    users_to_check.update(
-                        self.external_process_last_updated_ms.pop(process_id, ())
-                    )
-                    self.external_process_last_update.pop(process_id)
+            # Fetch the list of users that *may* have timed out. Things may have
+            # changed since the timeout was set, so we won't necessarily have to
+            # take any action.
+            users_to_check = set(self.wheel_timer.fetch(now))
+
+            # Check whether the lists of syncing processes from an external
+            # process have expired.
+            expired_process_ids = [
+                process_id for process_id, last_update
+                in self.external_process_last_updated_ms.items()
+                if now - last_update > EXTERNAL_PROCESS_EXPIRY
+            ]
+            for process_id in expired_process_ids:
+                users_to_check.update(
+                    self.external_process_to_current_syncs.pop(process_id, ())
+                )
+                self.external_process_last_updated_ms.pop(process_id)
 
-                states = [
-                    self.user_to_current_state.get(
-                        user_id, UserPresenceState.default(user_id)
-                    )
-                    for user_id in users_to_check
-                ]
+            timers_fired_counter.inc_by(len(users_to_check))
 
-                timers_fired_counter.inc_by(len(states))
+            preserve_fn(self._handle_timeouts_for_users)(list(users_to_check))
+        except:
+            logger.exception("Exception in _handle_timeouts loop")
 
-                changes = handle_timeouts(
-                    states,
-                    is_mine_fn=self.is_mine_id,
-                    syncing_user_ids=self.get_currently_syncing_users(),
-                    now=now,
-                )
+    @defer.inlineCallbacks
+    def _handle_timeouts_for_users(self, user_ids):
+        """Applies any timeouts to the presence of the given users, in batches
+        of PRESENCE_BATCH_SIZE.
+
+        The timeouts for each batch are calculated just before that batch is
+        applied, so that we don't clobber any updates that happened while we
+        were processing earlier batches.
+        """
+        try:
+            for i in xrange(0, len(user_ids), PRESENCE_BATCH_SIZE):
+                if i:
+                    yield run_on_reactor()
+
+                with Measure(self.clock, "presence_handle_timeouts"):
+                    states = [
+                        self.user_to_current_state.get(
+                            user_id, UserPresenceState.default(user_id)
+                        )
+                        for user_id in user_ids[i:i + PRESENCE_BATCH_SIZE]
+                    ]
+
+                    changes = handle_timeouts(
+                        states,
+                        is_mine_fn=self.is_mine_id,
+                        syncing_user_ids=self.get_currently_syncing_users(),
+                        now=self.clock.time_msec(),
+                    )
 
-            preserve_fn(self._update_states)(changes)
+                if changes:
+                    yield self._update_states_batch(changes)
         except:
-            logger.exception("Exception in _handle_timeouts loop")
+            logger.exception("Exception handling presence timeouts")
 
     @defer.inlineCallbacks
     def bump_presence_active_time(self, user):
@@ -502,51 +541,11 @@ class PresenceHandler(object):
 
         defer.returnValue(states)
 
-    @defer.inlineCallbacks
     def _get_interested_parties(self, states):
         """Given a list of states return which entities (rooms, users, servers)
-        are interested in the given states.
-
-        Returns:
-            3-tuple: `(room_ids_to_states, users_to_states, hosts_to_states)`,
-            with each item being a dict of `entity_name` -> `[UserPresenceState]`
+        are interested in the given states. See `get_interested_parties`.
         """
-        room_ids_to_states = {}
-        users_to_states = {}
-        for state in states:
-            events = yield self.store.get_rooms_for_user(state.user_id)
-            for e in events:
-                room_ids_to_states.setdefault(e.room_id, []).append(state)
-
-            plist = yield self.store.get_presence_list_observers_accepted(state.user_id)
-            for u in plist:
-                users_to_states.setdefault(u, []).append(state)
-
-            # Always notify self
-            users_to_states.setdefault(state.user_id, []).append(state)
-
-        hosts_to_states = {}
-        for room_id, states in room_ids_to_states.items():
-            local_states = filter(lambda s: self.is_mine_id(s.user_id), states)
-            if not local_states:
-                continue
-
-            hosts = yield self.store.get_joined_hosts_for_room(room_id)
-            for host in hosts:
-                hosts_to_states.setdefault(host, []).extend(local_states)
-
-        for user_id, states in users_to_states.items():
-            local_states = filter(lambda s: self.is_mine_id(s.user_id), states)
-            if not local_states:
-                continue
-
-            host = get_domain_from_id(user_id)
-            hosts_to_states.setdefault(host, []).extend(local_states)
-
-        # TODO: de-dup hosts_to_states, as a single host might have multiple
-        # of same presence
-
-        defer.returnValue((room_ids_to_states, users_to_states, hosts_to_states))
+        return get_interested_parties(self.store, self.is_mine_id, states)
 
     @defer.inlineCallbacks
     def _persist_and_notify(self, states):
@@ -571,18 +570,13 @@ class PresenceHandler(object):
         Args:
             hosts_to_states (dict): Mapping `server_name` -> `[UserPresenceState]`
         """
-        now = self.clock.time_msec()
+        if not self.send_federation:
+            # The federation_sender worker sends presence to remote servers,
+            # based on the presence stream.
+            return
+
         for host, states in hosts_to_states.items():
-            self.federation.send_edu(
-                destination=host,
-                edu_type="m.presence",
-                content={
-                    "push": [
-                        _format_user_presence_state(state, now)
-                        for state in states
-                    ]
-                }
-            )
+            self.federation.send_presence(host, states)
 
     @defer.inlineCallbacks
     def incoming_presence(self, origin, content):
@@ -662,13 +656,13 @@ class PresenceHandler(object):
             defer.returnValue([
                 {
                     "type": "m.presence",
-                    "content": _format_user_presence_state(state, now),
+                    "content": format_user_presence_state(state, now),
                 }
                 for state in updates
             ])
         else:
             defer.returnValue([
-                _format_user_presence_state(state, now) for state in updates
+                format_user_presence_state(state, now) for state in updates
             ])
 
     @defer.inlineCallbacks
@@ -711,6 +705,10 @@ class PresenceHandler(object):
         # don't need to send to local clients here, as that is done as part
         # of the event stream/sync.
         # TODO: Only send to servers not already in the room.
+        if not self.send_federation:
+            # The federation_sender worker does this when it sees the join.
+            return
+
         if self.is_mine(user):
             state = yield self.current_state_for_user(user.to_string())
 
@@ -914,7 +912,59 @@ def should_notify(old_state, new_state):
     return False
 
 
-def _format_user_presence_state(state, now):
+@defer.inlineCallbacks
+def get_interested_parties(store, is_mine_id, states):
+    """Given a list of states return which entities (rooms, users, servers)
+    are interested in the given states.
+
+    Args:
+        store (DataStore)
+        is_mine_id (func): Returns whether a user_id is for a local user.
+        states (list(UserPresenceState))
+
+    Returns:
+        3-tuple: `(room_ids_to_states, users_to_states, hosts_to_states)`,
+        with each item being a dict of `entity_name` -> `[UserPresenceState]`
+    """
+    room_ids_to_states = {}
+    users_to_states = {}
+    for state in states:
+        room_ids = yield store.get_joined_room_ids_for_user(state.user_id)
+        for room_id in room_ids:
+            room_ids_to_states.setdefault(room_id, []).append(state)
+
+        plist = yield store.get_presence_list_observers_accepted(state.user_id)
+        for u in plist:
+            users_to_states.setdefault(u, []).append(state)
+
+        # Always notify self
+        users_to_states.setdefault(state.user_id, []).append(state)
+
+    hosts_to_states = {}
+    for room_id, states in room_ids_to_states.items():
+        local_states = filter(lambda s: is_mine_id(s.user_id), states)
+        if not local_states:
+            continue
+
+        hosts = yield store.get_joined_hosts_for_room(room_id)
+        for host in hosts:
+            hosts_to_states.setdefault(host, []).extend(local_states)
+
+    for user_id, states in users_to_states.items():
+        local_states = filter(lambda s: is_mine_id(s.user_id), states)
+        if not local_states:
+            continue
+
+        host = get_domain_from_id(user_id)
+        hosts_to_states.setdefault(host, []).extend(local_states)
+
+    # TODO: de-dup hosts_to_states, as a single host might have multiple
+    # of same presence
+
+    defer.returnValue((room_ids_to_states, users_to_states, hosts_to_states))
+
+
+def format_user_presence_state(state, now):
     """Convert UserPresenceState to a format that can be sent down to clients
     and to other servers.
     """
@@ -968,8 +1018,7 @@ class PresenceEventSource(object):
             stream_change_cache = self.store.presence_stream_cache
 
             if not room_ids:
-                rooms = yield self.store.get_rooms_for_user(user_id)
-                room_ids = set(e.room_id for e in rooms)
+                room_ids = yield self.store.get_joined_room_ids_for_user(user_id)
             else:
                 room_ids = set(room_ids)
 
@@ -979,31 +1028,53 @@ class PresenceEventSource(object):
             friends = set(row["observed_user_id"] for row in plist)
             friends.add(user_id)  # So that we receive our own presence
 
-            user_ids_changed = set()
+            user_ids_changed = None
             changed = None
             if from_key:
                 changed = stream_change_cache.get_all_entities_changed(from_key)
 
-            if changed is not None and len(changed) < 500:
-                # For small deltas, its quicker to get all changes and then
-                # work out if we share a room or they're in our presence list
-                get_updates_counter.inc("stream")
+            if changed is not None:
+                # Check whether we share a room with each of the users whose
+                # presence has changed. Users in the room membership index
+                # can be checked without hitting the store, so this scales
+                # with the number of changes rather than the number of users
+                # we can see.
+                user_ids_changed = set()
+                not_indexed = []
+                membership_index = self.store.room_membership_index
                 for other_user_id in changed:
                     if other_user_id in friends:
                         user_ids_changed.add(other_user_id)
                         continue
-                    other_rooms = yield self.store.get_rooms_for_user(other_user_id)
-                    if room_ids.intersection(e.room_id for e in other_rooms):
+                    shares_room = membership_index.is_user_in_any_room(
+                        other_user_id, room_ids,
+                    )
+                    if shares_room is None:
+                        not_indexed.append(other_user_id)
+                    elif shares_room:
                         user_ids_changed.add(other_user_id)
-                        continue
-            else:
-                # Too many possible updates. Find all users we can see and check
-                # if any of them have changed.
+
+                if len(not_indexed) < 500:
+                    get_updates_counter.inc("stream")
+                    for other_user_id in not_indexed:
+                        other_room_ids = yield self.store.get_joined_room_ids_for_user(
+                            other_user_id
+                        )
+                        if not room_ids.isdisjoint(other_room_ids):
+                            user_ids_changed.add(other_user_id)
+                else:
+                    # Too many users to look up, fall back to checking
+                    # everyone we can see.
+                    user_ids_changed = None
+
+            if user_ids_changed is None:
+                # Find all users we can see and check if any of them have
+                # changed.
                 get_updates_counter.inc("full")
 
                 user_ids_to_check = set()
                 for room_id in room_ids:
-                    users = yield self.store.get_users_in_room(room_id)
+                    users = yield self.store.get_joined_user_ids_for_room(room_id)
                     user_ids_to_check.update(users)
 
                 user_ids_to_check.update(friends)
@@ -1026,7 +1097,7 @@ class PresenceEventSource(object):
         defer.returnValue(([
             {
                 "type": "m.presence",
-                "content": _format_user_presence_state(s, now),
+                "content": format_user_presence_state(s, now),
             }
             for s in updates.values()
             if include_offline or s.state != PresenceState.OFFLINE
@@ -33,6 +33,7 @@ class ReceiptsHandler(BaseHandler):
         self.store = hs.get_datastore()
         self.hs = hs
         self.federation = hs.get_replication_layer()
+        self.send_federation = hs.config.send_federation
         self.federation.register_edu_handler(
             "m.receipt", self._received_remote_receipt
         )
@@ -56,7 +57,7 @@ class ReceiptsHandler(BaseHandler):
 
         is_new = yield self._handle_new_receipts([receipt])
 
-        if is_new:
+        if is_new and self.send_federation:
             self._push_remotes([receipt])
 
     @defer.inlineCallbacks
@@ -144,6 +144,7 @@ class SearchHandler(BaseHandler):
             })
 
         rank_map = {}  # event_id -> rank of event
+        results_map = {}  # event_id -> search result
         allowed_events = []
         room_groups = {}  # Holds result of grouping by room, if applicable
         sender_group = {}  # Holds result of grouping by sender, if applicable
@@ -156,29 +157,45 @@ class SearchHandler(BaseHandler):
         count = None
 
         if order_by == "rank":
-            search_result = yield self.store.search_msgs(
-                room_ids, search_term, keys
-            )
+            pagination_token = batch_token
+
+            # We keep looping and we keep filtering until we reach the limit
+            # or we run out of things, as for "recent" below. Later pages come
+            # from the ranked results the store has cached for this search.
+            i = 0
+            while len(allowed_events) < search_filter.limit() and i < 5:
+                i += 1
+                search_result = yield self.store.search_msgs(
+                    room_ids, search_term, keys, search_filter.limit() * 2,
+                    pagination_token=pagination_token,
+                )
 
-            count = search_result["count"]
+                count = search_result["count"]
 
-            if search_result["highlights"]:
-                highlights.update(search_result["highlights"])
+                if search_result["highlights"]:
+                    highlights.update(search_result["highlights"])
 
-            results = search_result["results"]
+                results = search_result["results"]
 
-            results_map = {r["event"].event_id: r for r in results}
+                results_map.update({r["event"].event_id: r for r in results})
 
-            rank_map.update({r["event"].event_id: r["rank"] for r in results})
+                rank_map.update({r["event"].event_id: r["rank"] for r in results})
 
-            filtered_events = search_filter.filter([r["event"] for r in results])
+                filtered_events = search_filter.filter([r["event"] for r in results])
 
-            events = yield filter_events_for_client(
-                self.store, user.to_string(), filtered_events
-            )
+                events = yield filter_events_for_client(
+                    self.store, user.to_string(), filtered_events
+                )
 
-            events.sort(key=lambda e: -rank_map[e.event_id])
-            allowed_events = events[:search_filter.limit()]
+                events.sort(key=lambda e: -rank_map[e.event_id])
+                allowed_events.extend(events)
+                allowed_events = allowed_events[:search_filter.limit()]
+
+                if len(results) < search_filter.limit() * 2:
+                    pagination_token = None
+                    break
+                else:
+                    pagination_token = results[-1]["pagination_token"]
 
             for e in allowed_events:
                 rm = room_groups.setdefault(e.room_id, {
@@ -193,6 +210,22 @@ class SearchHandler(BaseHandler):
                 })
                 s["results"].append(e.event_id)
 
+            if allowed_events and len(allowed_events) >= search_filter.limit():
+                last_event_id = allowed_events[-1].event_id
+                pagination_token = results_map[last_event_id]["pagination_token"]
+
+                # The pagination token is only valid for the set of rooms it
+                # was generated for, so we don't return a next_batch for each
+                # group.
+                if batch_group and batch_group_key:
+                    global_next_batch = encode_base64("%s\n%s\n%s" % (
+                        batch_group, batch_group_key, pagination_token
+                    ))
+                else:
+                    global_next_batch = encode_base64("%s\n%s\n%s" % (
+                        "all", "", pagination_token
+                    ))
+
         elif order_by == "recent":
             room_events = []
             i = 0
@@ -14,15 +14,19 @@
 # limitations under the License.
 
 from synapse.api.constants import Membership, EventTypes
-from synapse.util.async import concurrently_execute
-from synapse.util.logcontext import LoggingContext
+from synapse.util.async import concurrently_execute, ObservableDeferred
+from synapse.util.logcontext import LoggingContext, preserve_context_over_deferred
 from synapse.util.metrics import Measure
+from synapse.util.caches import CACHE_SIZE_FACTOR, register_cache
+from synapse.util.caches.lrucache import LruCache
 from synapse.util.caches.response_cache import ResponseCache
 from synapse.push.clientformat import format_push_rules_for_user
 from synapse.visibility import filter_events_for_client
 
 from twisted.internet import defer
 
+from canonicaljson import encode_canonical_json
+
 import collections
 import logging
 import itertools
@@ -30,6 +34,11 @@ import itertools
 logger = logging.getLogger(__name__)
 
 
+# The number of per room sync results to keep around, so that they can be
+# shared between a user's devices.
+ROOM_SYNC_CACHE_SIZE = int(10000 * CACHE_SIZE_FACTOR)
+
+
 SyncConfig = collections.namedtuple("SyncConfig", [
     "user",
     "filter_collection",
@@ -140,6 +149,19 @@ class SyncHandler(object):
         self.clock = hs.get_clock()
         self.response_cache = ResponseCache()
 
+        # Sync computations that are in flight, keyed on everything that
+        # determines their result. This lets different requests (e.g. from
+        # the user's different devices, or waking up after the same event)
+        # share a single computation.
+        self.sync_computation_cache = ResponseCache()
+
+        # Caches the timeline and state delta computed for a room in a sync,
+        # keyed by user, room, stream positions and filter. Devices of the same
+        # user syncing from the same point share these. Values are
+        # ObservableDeferreds so that concurrent requests share the work.
+        self._room_sync_cache = LruCache(ROOM_SYNC_CACHE_SIZE)
+        register_cache("sync_room_cache", self._room_sync_cache)
+
     def wait_for_sync_for_user(self, sync_config, since_token=None, timeout=0,
                                full_state=False):
         """Get the sync for a client if we have new data for it now. Otherwise
@@ -173,13 +195,16 @@ class SyncHandler(object):
         if timeout == 0 or since_token is None or full_state:
             # we are going to return immediately, so don't bother calling
             # notifier.wait_for_events.
-            result = yield self.current_sync_for_user(
-                sync_config, since_token, full_state=full_state,
+            current_token = yield self.event_sources.get_current_token()
+            result = yield self._shared_sync_for_user(
+                sync_config, since_token, current_token, full_state=full_state,
             )
             defer.returnValue(result)
         else:
             def current_sync_callback(before_token, after_token):
-                return self.current_sync_for_user(sync_config, since_token)
+                return self._shared_sync_for_user(
+                    sync_config, since_token, after_token,
+                )
 
             result = yield self.notifier.wait_for_events(
                 sync_config.user.to_string(), timeout, current_sync_callback,
@@ -187,6 +212,42 @@ class SyncHandler(object):
             )
             defer.returnValue(result)
 
+    def _shared_sync_for_user(self, sync_config, since_token, current_token,
+                              full_state=False):
+        """Get the sync for the client, sharing the computation with any other
+        in flight request for the same user, filter and since token that was
+        started when the server was at the same `current_token`.
+
+        Args:
+            sync_config (SyncConfig)
+            since_token (StreamToken|None)
+            current_token (StreamToken): The position of the server when the
+                request was made. Requests only share a computation if they
+                were made at the same position, so that none of them miss
+                events that arrived after the computation started.
+            full_state (bool)
+
+        Returns:
+            A Deferred SyncResult.
+        """
+        key = (
+            sync_config.user.to_string(),
+            encode_canonical_json(sync_config.filter_collection.get_filter_json()),
+            since_token,
+            current_token,
+            full_state,
+        )
+
+        result = self.sync_computation_cache.get(key)
+        if not result:
+            result = self.sync_computation_cache.set(
+                key,
+                self.current_sync_for_user(
+                    sync_config, since_token, full_state=full_state,
+                )
+            )
+        return result
+
     def current_sync_for_user(self, sync_config, since_token=None,
                               full_state=False):
         """Get the sync for client needed to match what the server has now.
@@ -690,6 +751,21 @@ class SyncHandler(object):
 
             tags_by_room = yield self.store.get_tags_for_user(user_id)
 
+        if not sync_result_builder.full_state:
+            # Only rooms that have changed since the last sync need any further
+            # work, so drop the others now.
+            room_entries = [
+                room_entry for room_entry in room_entries
+                if (
+                    room_entry.events != []
+                    or room_entry.full_state
+                    or room_entry.newly_joined
+                    or room_entry.room_id in ephemeral_by_room
+                    or room_entry.room_id in tags_by_room
+                    or account_data_by_room.get(room_entry.room_id)
+                )
+            ]
+
         def handle_room_entries(room_entry):
             return self._generate_room_entry(
                 sync_result_builder,
@@ -958,20 +1034,12 @@ class SyncHandler(object):
             if events == [] and tags is None:
                 return
 
-        since_token = sync_result_builder.since_token
-        now_token = sync_result_builder.now_token
         sync_config = sync_result_builder.sync_config
 
         room_id = room_builder.room_id
-        since_token = room_builder.since_token
-        upto_token = room_builder.upto_token
 
-        batch = yield self._load_filtered_recents(
-            room_id, sync_config,
-            now_token=upto_token,
-            since_token=since_token,
-            recents=events,
-            newly_joined_room=newly_joined,
+        batch, state = yield self._get_room_timeline_and_state(
+            sync_result_builder, ignored_users, room_builder, full_state,
         )
 
         account_data_events = []
@@ -996,11 +1064,6 @@ class SyncHandler(object):
         if not (always_include or batch or account_data or ephemeral or full_state):
             return
 
-        state = yield self.compute_state_delta(
-            room_id, batch, sync_config, since_token, now_token,
-            full_state=full_state
-        )
-
         if room_builder.rtype == "joined":
             unread_notifications = {}
             room_sync = JoinedSyncResult(
@@ -1034,6 +1097,97 @@ class SyncHandler(object):
         else:
             raise Exception("Unrecognized rtype: %r", room_builder.rtype)
 
+    def _get_room_timeline_and_state(self, sync_result_builder, ignored_users,
+                                     room_builder, full_state):
+        """Gets the timeline batch and state delta for a room, reusing the
+        result of an identical computation for another of the user's devices if
+        there is one.
+
+        Args:
+            sync_result_builder(SyncResultBuilder)
+            ignored_users(set(str)): Set of users ignored by user.
+            room_builder(RoomSyncResultBuilder)
+            full_state(bool): Whether to return the full state of the room.
+
+        Returns:
+            Deferred(tuple): `(TimelineBatch, dict)` of the timeline and the
+            state delta.
+        """
+        sync_config = sync_result_builder.sync_config
+        since_token = room_builder.since_token
+        upto_token = room_builder.upto_token
+        now_token = sync_result_builder.now_token
+
+        key = (
+            sync_config.user.to_string(),
+            room_builder.room_id,
+            room_builder.rtype,
+            room_builder.newly_joined,
+            full_state,
+            since_token.room_key if since_token else None,
+            upto_token.room_key,
+            # upto_token is the position *before* the new events for joined
+            # rooms, so include the last of them to avoid returning a batch
+            # that misses events persisted since it was computed.
+            (
+                room_builder.events[-1].internal_metadata.stream_ordering
+                if room_builder.events else None
+            ),
+            # The state delta for a full state sync may be calculated at the
+            # current position.
+            now_token.room_key if full_state else None,
+            sync_result_builder.filter_key,
+            frozenset(ignored_users),
+        )
+
+        result = self._room_sync_cache.get(key)
+        if result is None:
+            d = self._compute_room_timeline_and_state(
+                sync_config, room_builder, now_token, full_state,
+            )
+
+            def on_err(f):
+                self._room_sync_cache.pop(key, None)
+                return f
+            d.addErrback(on_err)
+
+            result = ObservableDeferred(d, consumeErrors=True)
+            if not result.has_called() or result.has_succeeded():
+                self._room_sync_cache[key] = result
+
+        def replace_prev_batch(res):
+            # Other devices may have different positions in the non-room
+            # streams, so swap them into the prev_batch token.
+            batch, state = res
+            batch = batch._replace(prev_batch=upto_token.copy_and_replace(
+                "room_key", batch.prev_batch.room_key,
+            ))
+            return batch, state
+
+        d = result.observe()
+        d.addCallback(replace_prev_batch)
+        return preserve_context_over_deferred(d)
+
+    @defer.inlineCallbacks
+    def _compute_room_timeline_and_state(self, sync_config, room_builder,
+                                         now_token, full_state):
+        since_token = room_builder.since_token
+
+        batch = yield self._load_filtered_recents(
+            room_builder.room_id, sync_config,
+            now_token=room_builder.upto_token,
+            since_token=since_token,
+            recents=room_builder.events,
+            newly_joined_room=room_builder.newly_joined,
+        )
+
+        state = yield self.compute_state_delta(
+            room_builder.room_id, batch, sync_config, since_token, now_token,
+            full_state=full_state
+        )
+
+        defer.returnValue((batch, state))
+
 
 def _action_has_highlight(actions):
     for action in actions:
@@ -1098,6 +1252,11 @@ class SyncResultBuilder(object):
         self.since_token = since_token
         self.now_token = now_token
 
+        # Identifies the filter being used, for use in cache keys.
+        self.filter_key = encode_canonical_json(
+            sync_config.filter_collection.get_filter_json()
+        )
+
         self.presence = []
         self.account_data = []
         self.joined = []
@@ -44,6 +44,7 @@ class TypingHandler(object):
         self.clock = hs.get_clock()
 
         self.federation = hs.get_replication_layer()
+        self.send_federation = hs.config.send_federation
 
         self.federation.register_edu_handler("m.typing", self._recv_edu)
 
@@ -174,7 +175,7 @@ class TypingHandler(object):
                     user_id=user_id,
                     typing=typing
                 )
-            else:
+            elif self.send_federation:
                 deferreds.append(self.federation.send_edu(
                     destination=domain,
                     edu_type="m.typing",
@@ -126,9 +126,11 @@ class DistributionMetric(object):
 
 
 class CacheMetric(object):
-    __slots__ = ("name", "cache_name", "hits", "misses", "size_callback")
+    __slots__ = (
+        "name", "cache_name", "hits", "misses", "size_callback", "bytes_callback",
+    )
 
-    def __init__(self, name, size_callback, cache_name):
+    def __init__(self, name, size_callback, cache_name, bytes_callback=None):
         self.name = name
         self.cache_name = cache_name
 
@@ -136,6 +138,7 @@ class CacheMetric(object):
         self.misses = 0
 
         self.size_callback = size_callback
+        self.bytes_callback = bytes_callback
 
     def inc_hits(self):
         self.hits += 1
@@ -148,8 +151,17 @@ class CacheMetric(object):
         hits = self.hits
         total = self.misses + self.hits
 
-        return [
+        lines = [
             """%s:hits{name="%s"} %d""" % (self.name, self.cache_name, hits),
             """%s:total{name="%s"} %d""" % (self.name, self.cache_name, total),
             """%s:size{name="%s"} %d""" % (self.name, self.cache_name, size),
         ]
+
+        if self.bytes_callback is not None:
+            size_bytes = self.bytes_callback()
+            if size_bytes is not None:
+                lines.append("""%s:size_bytes{name="%s"} %d""" % (
+                    self.name, self.cache_name, size_bytes,
+                ))
+
+        return lines
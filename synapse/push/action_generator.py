@@ -15,8 +15,10 @@
 
 from twisted.internet import defer
 
-from .bulk_push_rule_evaluator import evaluator_for_event
+from .bulk_push_rule_evaluator import evaluator_for_event, RulesForRoom
 
+from synapse.util.caches import CACHE_SIZE_FACTOR, register_cache
+from synapse.util.caches.lrucache import LruCache
 from synapse.util.metrics import Measure
 
 import logging
@@ -24,6 +26,9 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+RULES_FOR_ROOM_CACHE_SIZE = int(5000 * CACHE_SIZE_FACTOR)
+
+
 class ActionGenerator:
     def __init__(self, hs):
         self.hs = hs
@@ -36,11 +41,20 @@ class ActionGenerator:
         # event stream, so we just run the rules for a client with no profile
         # tag (ie. we just need all the users).
 
+        # room_id -> RulesForRoom
+        self._rules_for_room_cache = LruCache(RULES_FOR_ROOM_CACHE_SIZE)
+        register_cache("push_rules_for_room", self._rules_for_room_cache)
+
     @defer.inlineCallbacks
     def handle_push_actions_for_event(self, event, context):
         with Measure(self.clock, "handle_push_actions_for_event"):
+            rules_for_room = self._rules_for_room_cache.get(event.room_id)
+            if rules_for_room is None:
+                rules_for_room = RulesForRoom(self.hs, event.room_id)
+                self._rules_for_room_cache[event.room_id] = rules_for_room
+
             bulk_evaluator = yield evaluator_for_event(
-                event, self.hs, self.store, context.current_state
+                event, self.hs, self.store, context, rules_for_room
             )
 
             actions_by_user = yield bulk_evaluator.action_for_event_by_user(
@@ -17,9 +17,10 @@ import logging
 
 from twisted.internet import defer
 
-from .push_rule_evaluator import PushRuleEvaluatorForEvent
+from .push_rule_evaluator import PushRuleEvaluatorForEvent, compile_push_rules
 
 from synapse.api.constants import EventTypes, Membership
+from synapse.util.async import Linearizer
 from synapse.visibility import filter_events_for_clients
 
 
@@ -27,43 +28,20 @@ logger = logging.getLogger(__name__)
 
 
 @defer.inlineCallbacks
-def _get_rules(room_id, user_ids, store):
-    rules_by_user = yield store.bulk_get_push_rules(user_ids)
-
-    rules_by_user = {k: v for k, v in rules_by_user.items() if v is not None}
-
-    defer.returnValue(rules_by_user)
-
-
-@defer.inlineCallbacks
-def evaluator_for_event(event, hs, store, current_state):
-    room_id = event.room_id
-    # We also will want to generate notifs for other people in the room so
-    # their unread countss are correct in the event stream, but to avoid
-    # generating them for bot / AS users etc, we only do so for people who've
-    # sent a read receipt into the room.
-
-    local_users_in_room = set(
-        e.state_key for e in current_state.values()
-        if e.type == EventTypes.Member and e.membership == Membership.JOIN
-        and hs.is_mine_id(e.state_key)
-    )
-
-    # users in the room who have pushers need to get push rules run because
-    # that's how their pushers work
-    if_users_with_pushers = yield store.get_if_users_have_pushers(
-        local_users_in_room
-    )
-    user_ids = set(
-        uid for uid, have_pusher in if_users_with_pushers.items() if have_pusher
-    )
-
-    users_with_receipts = yield store.get_users_with_read_receipts_in_room(room_id)
-
-    # any users with pushers must be ours: they have pushers
-    for uid in users_with_receipts:
-        if uid in local_users_in_room:
-            user_ids.add(uid)
+def evaluator_for_event(event, hs, store, context, rules_for_room):
+    """Returns a BulkPushRuleEvaluator for the event.
+
+    Args:
+        event (FrozenEvent)
+        hs (HomeServer)
+        store (DataStore)
+        context (EventContext)
+        rules_for_room (RulesForRoom): The cached rules for the event's room.
+
+    Returns:
+        Deferred[BulkPushRuleEvaluator]
+    """
+    rules_by_user = yield rules_for_room.get_rules(context)
 
     # if this event is an invite event, we may need to run rules for the user
     # who's been invited, otherwise they won't get told they've been invited
@@ -72,29 +50,184 @@ def evaluator_for_event(event, hs, store, current_state):
         if invited_user and hs.is_mine_id(invited_user):
             has_pusher = yield store.user_has_pusher(invited_user)
             if has_pusher:
-                user_ids.add(invited_user)
-
-    rules_by_user = yield _get_rules(room_id, user_ids, store)
+                rules_by_user = dict(rules_by_user)
+                invited_rules = yield store.get_push_rules_for_user(invited_user)
+                rules_by_user[invited_user] = invited_rules
 
     defer.returnValue(BulkPushRuleEvaluator(
-        room_id, rules_by_user, user_ids, store
+        event.room_id, rules_by_user, store,
+        rules_for_room.display_names, rules_for_room.joined_member_count,
     ))
 
 
+class RulesForRoom(object):
+    """Caches the push rules of the users in a room that push rules need to be
+    run for, along with the display names and member count of the room.
+
+    This is only recalculated when the membership of the room, the push rules,
+    the set of pushers or the set of users with read receipts in the room
+    change, rather than for every event sent to the room.
+    """
+
+    def __init__(self, hs, room_id):
+        self.hs = hs
+        self.room_id = room_id
+        self.store = hs.get_datastore()
+        self.linearizer = Linearizer()
+
+        # The state group and the member events the membership below was
+        # calculated from.
+        self.state_group = None
+        self.member_event_ids = None
+
+        self.local_users = set()
+        self.display_names = {}
+        self.joined_member_count = 0
+
+        # The local users with pushers, as of `pushers_token`
+        self.pushers_token = None
+        self.users_with_pushers = set()
+
+        # The set of users with read receipts that `rules_by_user` was
+        # calculated from. The store caches the set, so we can compare by
+        # identity.
+        self.users_with_receipts = None
+
+        # user_id -> push rules, for users we need to run push rules for, as
+        # of `push_rules_token`.
+        self.push_rules_token = None
+        self.rules_by_user = {}
+
+    @defer.inlineCallbacks
+    def get_rules(self, context):
+        """Returns the push rules of the users push rules should be run for.
+
+        Args:
+            context (EventContext): The context of the event being sent.
+
+        Returns:
+            Deferred[dict]: user_id -> list of push rules. The dict must not be
+            modified.
+        """
+        with (yield self.linearizer.queue(())):
+            # We also will want to generate notifs for other people in the
+            # room so their unread countss are correct in the event stream,
+            # but to avoid generating them for bot / AS users etc, we only do
+            # so for people who've sent a read receipt into the room.
+            membership_changed = self._update_membership(context)
+
+            # users in the room who have pushers need to get push rules run
+            # because that's how their pushers work
+            pushers_token = self.store.get_pushers_stream_token()
+            if membership_changed or pushers_token != self.pushers_token:
+                if_users_with_pushers = yield self.store.get_if_users_have_pushers(
+                    self.local_users
+                )
+                self.users_with_pushers = set(
+                    uid for uid, have_pusher in if_users_with_pushers.items()
+                    if have_pusher
+                )
+                self.pushers_token = pushers_token
+                membership_changed = True
+
+            push_rules_token = self.store.get_push_rules_stream_token()[0]
+            if push_rules_token != self.push_rules_token:
+                self.rules_by_user = {}
+                self.push_rules_token = push_rules_token
+                membership_changed = True
+
+            users_with_receipts = yield self.store.get_users_with_read_receipts_in_room(
+                self.room_id
+            )
+
+            if membership_changed or users_with_receipts is not self.users_with_receipts:
+                user_ids = set(self.users_with_pushers)
+
+                # any users with pushers must be ours: they have pushers
+                user_ids.update(users_with_receipts & self.local_users)
+
+                missing = [u for u in user_ids if u not in self.rules_by_user]
+                rules_by_user = {
+                    u: rules for u, rules in self.rules_by_user.items()
+                    if u in user_ids
+                }
+
+                if missing:
+                    fetched = yield self.store.bulk_get_push_rules(missing)
+                    rules_by_user.update(
+                        (u, rules) for u, rules in fetched.items()
+                        if rules is not None
+                    )
+
+                self.rules_by_user = rules_by_user
+                self.users_with_receipts = users_with_receipts
+
+        defer.returnValue(self.rules_by_user)
+
+    def _update_membership(self, context):
+        """Updates the local users, display names and member count from the
+        state of the event, if its membership differs from the last event's.
+
+        Returns:
+            bool: Whether the membership changed.
+        """
+        if context.state_group is not None and context.state_group == self.state_group:
+            return False
+
+        self.state_group = context.state_group
+
+        current_state = context.current_state
+        member_event_ids = {
+            state_key: ev.event_id
+            for (etype, state_key), ev in current_state.items()
+            if etype == EventTypes.Member
+        }
+
+        if member_event_ids == self.member_event_ids:
+            return False
+
+        self.member_event_ids = member_event_ids
+
+        local_users = set()
+        display_names = {}
+        joined_member_count = 0
+        for state_key in member_event_ids:
+            ev = current_state[(EventTypes.Member, state_key)]
+
+            nm = ev.content.get("displayname", None)
+            if nm:
+                display_names[state_key] = nm
+
+            if ev.membership == Membership.JOIN:
+                joined_member_count += 1
+                if self.hs.is_mine_id(state_key):
+                    local_users.add(state_key)
+
+        self.local_users = local_users
+        self.display_names = display_names
+        self.joined_member_count = joined_member_count
+
+        return True
+
+
 class BulkPushRuleEvaluator:
     """
     Runs push rules for all users in a room.
     This is faster than running PushRuleEvaluator for each user because it
     fetches all the rules for all the users in one (batched) db query
-    rather than doing multiple queries per-user. It currently uses
-    the same logic to run the actual rules, but could be optimised further
-    (see https://matrix.org/jira/browse/SYN-562)
+    rather than doing multiple queries per-user.
+
+    The rules are compiled (see compile_push_rules) so that users with the
+    same rules share a rule set, and conditions that don't depend on the user
+    are evaluated once per event, rather than once per user.
     """
-    def __init__(self, room_id, rules_by_user, users_in_room, store):
+    def __init__(self, room_id, rules_by_user, store, display_names,
+                 room_member_count):
         self.room_id = room_id
         self.rules_by_user = rules_by_user
-        self.users_in_room = users_in_room
         self.store = store
+        self.display_names = display_names
+        self.room_member_count = room_member_count
 
     @defer.inlineCallbacks
     def action_for_event_by_user(self, event, current_state):
@@ -111,23 +244,13 @@ class BulkPushRuleEvaluator:
             self.store, user_tuples, [event], {event.event_id: current_state}
         )
 
-        room_members = set(
-            e.state_key for e in current_state.values()
-            if e.type == EventTypes.Member and e.membership == Membership.JOIN
-        )
-
-        evaluator = PushRuleEvaluatorForEvent(event, len(room_members))
-
-        condition_cache = {}
+        evaluator = PushRuleEvaluatorForEvent(event, self.room_member_count)
 
-        display_names = {}
-        for ev in current_state.values():
-            nm = ev.content.get("displayname", None)
-            if nm and ev.type == EventTypes.Member:
-                display_names[ev.state_key] = nm
+        # CompiledPushRuleSet -> rules whose user independent conditions match
+        candidates_by_rule_set = {}
 
         for uid, rules in self.rules_by_user.items():
-            display_name = display_names.get(uid, None)
+            display_name = self.display_names.get(uid, None)
 
             filtered = filtered_by_user[uid]
             if len(filtered) == 0:
@@ -136,36 +259,16 @@ class BulkPushRuleEvaluator:
             if filtered[0].sender == uid:
                 continue
 
-            for rule in rules:
-                if 'enabled' in rule and not rule['enabled']:
-                    continue
+            rule_set = compile_push_rules(rules)
+            candidates = candidates_by_rule_set.get(rule_set)
+            if candidates is None:
+                candidates = rule_set.candidate_rules(evaluator)
+                candidates_by_rule_set[rule_set] = candidates
 
-                matches = _condition_checker(
-                    evaluator, rule['conditions'], uid, display_name, condition_cache
-                )
-                if matches:
-                    actions = [x for x in rule['actions'] if x != 'dont_notify']
+            for rule in candidates:
+                if rule.matches_user(evaluator, uid, display_name):
+                    actions = [x for x in rule.actions if x != 'dont_notify']
                     if actions and 'notify' in actions:
                         actions_by_user[uid] = actions
                     break
         defer.returnValue(actions_by_user)
-
-
-def _condition_checker(evaluator, conditions, uid, display_name, cache):
-    for cond in conditions:
-        _id = cond.get("_id", None)
-        if _id:
-            res = cache.get(_id, None)
-            if res is False:
-                return False
-            elif res is True:
-                continue
-
-        res = evaluator.matches(cond, uid, display_name)
-        if _id:
-            cache[_id] = bool(res)
-
-        if not res:
-            return False
-
-    return True
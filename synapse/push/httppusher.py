@@ -50,6 +50,7 @@ class HttpPusher(object):
         self.failing_since = pusherdict['failing_since']
         self.timed_call = None
         self.processing = False
+        self.badge_counter = push_tools.BadgeCounter(self.store, self.user_id)
 
         # This is the highest stream ordering we know it's safe to process.
         # When new events arrive, we'll be given a window of new events: we
@@ -97,9 +98,7 @@ class HttpPusher(object):
         # but currently that's the only type of receipt anyway...
         with LoggingContext("push.on_new_receipts"):
             with Measure(self.clock, "push.on_new_receipts"):
-                badge = yield push_tools.get_badge_count(
-                    self.hs.get_datastore(), self.user_id
-                )
+                badge = yield self.badge_counter.get_badge_count()
             yield self._send_badge(badge)
 
     @defer.inlineCallbacks
@@ -144,62 +143,81 @@ class HttpPusher(object):
             self.user_id, self.last_stream_ordering, self.max_stream_ordering
         )
 
-        for push_action in unprocessed:
-            processed = yield self._process_one(push_action)
-            if processed:
-                self.backoff_delay = HttpPusher.INITIAL_BACKOFF_SEC
-                self.last_stream_ordering = push_action['stream_ordering']
-                yield self.store.update_pusher_last_stream_ordering_and_success(
-                    self.app_id, self.pushkey, self.user_id,
-                    self.last_stream_ordering,
-                    self.clock.time_msec()
-                )
-                if self.failing_since:
-                    self.failing_since = None
-                    yield self.store.update_pusher_failing_since(
-                        self.app_id, self.pushkey, self.user_id,
-                        self.failing_since
-                    )
-            else:
-                if not self.failing_since:
-                    self.failing_since = self.clock.time_msec()
-                    yield self.store.update_pusher_failing_since(
-                        self.app_id, self.pushkey, self.user_id,
-                        self.failing_since
-                    )
+        # We only write our position to the database once for the whole
+        # batch, rather than after every notification.
+        last_success_stream_ordering = None
 
-                if (
-                    self.failing_since and
-                    self.failing_since <
-                    self.clock.time_msec() - HttpPusher.GIVE_UP_AFTER_MS
-                ):
-                    # we really only give up so that if the URL gets
-                    # fixed, we don't suddenly deliver a load
-                    # of old notifications.
-                    logger.warn("Giving up on a notification to user %s, "
-                                "pushkey %s",
-                                self.user_id, self.pushkey)
+        try:
+            for push_action in unprocessed:
+                processed = yield self._process_one(push_action)
+                if processed:
                     self.backoff_delay = HttpPusher.INITIAL_BACKOFF_SEC
                     self.last_stream_ordering = push_action['stream_ordering']
-                    yield self.store.update_pusher_last_stream_ordering(
-                        self.app_id,
-                        self.pushkey,
-                        self.user_id,
-                        self.last_stream_ordering
-                    )
-
-                    self.failing_since = None
-                    yield self.store.update_pusher_failing_since(
-                        self.app_id,
-                        self.pushkey,
-                        self.user_id,
-                        self.failing_since
-                    )
+                    last_success_stream_ordering = self.last_stream_ordering
+                    if self.failing_since:
+                        self.failing_since = None
+                        yield self.store.update_pusher_failing_since(
+                            self.app_id, self.pushkey, self.user_id,
+                            self.failing_since
+                        )
                 else:
-                    logger.info("Push failed: delaying for %ds", self.backoff_delay)
-                    self.timed_call = reactor.callLater(self.backoff_delay, self.on_timer)
-                    self.backoff_delay = min(self.backoff_delay * 2, self.MAX_BACKOFF_SEC)
-                    break
+                    if last_success_stream_ordering is not None:
+                        yield self._update_last_stream_ordering_and_success()
+                        last_success_stream_ordering = None
+
+                    if not self.failing_since:
+                        self.failing_since = self.clock.time_msec()
+                        yield self.store.update_pusher_failing_since(
+                            self.app_id, self.pushkey, self.user_id,
+                            self.failing_since
+                        )
+
+                    if (
+                        self.failing_since and
+                        self.failing_since <
+                        self.clock.time_msec() - HttpPusher.GIVE_UP_AFTER_MS
+                    ):
+                        # we really only give up so that if the URL gets
+                        # fixed, we don't suddenly deliver a load
+                        # of old notifications.
+                        logger.warn("Giving up on a notification to user %s, "
+                                    "pushkey %s",
+                                    self.user_id, self.pushkey)
+                        self.backoff_delay = HttpPusher.INITIAL_BACKOFF_SEC
+                        self.last_stream_ordering = push_action['stream_ordering']
+                        yield self.store.update_pusher_last_stream_ordering(
+                            self.app_id,
+                            self.pushkey,
+                            self.user_id,
+                            self.last_stream_ordering
+                        )
+
+                        self.failing_since = None
+                        yield self.store.update_pusher_failing_since(
+                            self.app_id,
+                            self.pushkey,
+                            self.user_id,
+                            self.failing_since
+                        )
+                    else:
+                        logger.info("Push failed: delaying for %ds", self.backoff_delay)
+                        self.timed_call = reactor.callLater(
+                            self.backoff_delay, self.on_timer
+                        )
+                        self.backoff_delay = min(
+                            self.backoff_delay * 2, self.MAX_BACKOFF_SEC
+                        )
+                        break
+        finally:
+            if last_success_stream_ordering is not None:
+                yield self._update_last_stream_ordering_and_success()
+
+    def _update_last_stream_ordering_and_success(self):
+        return self.store.update_pusher_last_stream_ordering_and_success(
+            self.app_id, self.pushkey, self.user_id,
+            self.last_stream_ordering,
+            self.clock.time_msec()
+        )
 
     @defer.inlineCallbacks
     def _process_one(self, push_action):
@@ -207,7 +225,8 @@ class HttpPusher(object):
             defer.returnValue(True)
 
         tweaks = push_rule_evaluator.tweaks_for_actions(push_action['actions'])
-        badge = yield push_tools.get_badge_count(self.hs.get_datastore(), self.user_id)
+        self.badge_counter.on_notification(push_action['room_id'])
+        badge = yield self.badge_counter.get_badge_count()
 
         event = yield self.store.get_event(push_action['event_id'], allow_none=True)
         if event is None:
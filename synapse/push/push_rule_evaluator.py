@@ -15,6 +15,7 @@
 
 import logging
 import re
+import simplejson as json
 
 from synapse.types import UserID
 from synapse.util.caches.lrucache import LruCache
@@ -28,29 +29,40 @@ INEQUALITY_EXPR = re.compile("^([=<>]*)([0-9]*)$")
 
 
 def _room_member_count(ev, condition, room_member_count):
-    if 'is' not in condition:
-        return False
-    m = INEQUALITY_EXPR.match(condition['is'])
+    return _compile_member_count(condition.get('is'))(room_member_count)
+
+
+def _compile_member_count(is_expr):
+    """Turns the `is` field of a room_member_count condition into a function
+    that takes the room member count and returns whether it matches.
+    """
+    if is_expr is None:
+        return _never_matches
+    m = INEQUALITY_EXPR.match(is_expr)
     if not m:
-        return False
+        return _never_matches
     ineq = m.group(1)
     rhs = m.group(2)
     if not rhs.isdigit():
-        return False
+        return _never_matches
     rhs = int(rhs)
 
     if ineq == '' or ineq == '==':
-        return room_member_count == rhs
+        return lambda count: count == rhs
     elif ineq == '<':
-        return room_member_count < rhs
+        return lambda count: count < rhs
     elif ineq == '>':
-        return room_member_count > rhs
+        return lambda count: count > rhs
     elif ineq == '>=':
-        return room_member_count >= rhs
+        return lambda count: count >= rhs
     elif ineq == '<=':
-        return room_member_count <= rhs
+        return lambda count: count <= rhs
     else:
-        return False
+        return _never_matches
+
+
+def _never_matches(*args):
+    return False
 
 
 def tweaks_for_actions(actions):
@@ -71,58 +83,246 @@ class PushRuleEvaluatorForEvent(object):
         # Maps strings of e.g. 'content.body' -> event["content"]["body"]
         self._value_cache = _flatten_dict(event)
 
+        # Maps user independent CompiledConditions -> bool, so that
+        # conditions shared by many users' rules are only evaluated once.
+        self._condition_cache = {}
+
     def matches(self, condition, user_id, display_name):
-        if condition['kind'] == 'event_match':
-            return self._event_match(condition, user_id)
-        elif condition['kind'] == 'contains_display_name':
-            return self._contains_display_name(display_name)
-        elif condition['kind'] == 'room_member_count':
-            return _room_member_count(
-                self._event, condition, self._room_member_count
-            )
+        return compile_condition(condition).matches(self, user_id, display_name)
+
+    def _get_value(self, dotted_key):
+        return self._value_cache.get(dotted_key, None)
+
+
+class CompiledCondition(object):
+    """A push rule condition with its patterns compiled.
+
+    Identical conditions are interned by compile_condition, so instances are
+    shared between all the rules (and users) that use them.
+
+    Attributes:
+        user_dependent (bool): Whether the result depends on the user the rule
+            is being evaluated for, rather than just on the event.
+    """
+    __slots__ = (
+        "kind", "key", "pattern", "pattern_type", "user_dependent", "_matcher",
+    )
+
+    def __init__(self, condition):
+        self.kind = condition['kind']
+        self.key = condition.get('key')
+        self.pattern = condition.get('pattern')
+        self.pattern_type = condition.get('pattern_type')
+        self.user_dependent = False
+        self._matcher = None
+
+        if self.kind == 'event_match':
+            word_boundary = self.key == 'content.body'
+            if self.pattern:
+                self._matcher = _compile_glob(self.pattern, word_boundary)
+            elif self.pattern_type in ("user_id", "user_localpart"):
+                self.user_dependent = True
+            else:
+                self._matcher = _never_matches
+        elif self.kind == 'contains_display_name':
+            self.user_dependent = True
+        elif self.kind == 'room_member_count':
+            self._matcher = _compile_member_count(condition.get('is'))
+
+    def matches(self, evaluator, user_id, display_name):
+        if self.user_dependent:
+            return self._matches_for_user(evaluator, user_id, display_name)
+
+        res = evaluator._condition_cache.get(self)
+        if res is None:
+            res = self._matches_for_event(evaluator)
+            evaluator._condition_cache[self] = res
+        return res
+
+    def _matches_for_event(self, evaluator):
+        if self.kind == 'event_match':
+            return self._match_value(evaluator, self._matcher)
+        elif self.kind == 'room_member_count':
+            return self._matcher(evaluator._room_member_count)
         else:
             return True
 
-    def _event_match(self, condition, user_id):
-        pattern = condition.get('pattern', None)
+    def _matches_for_user(self, evaluator, user_id, display_name):
+        if self.kind == 'contains_display_name':
+            if not display_name:
+                return False
+            body = evaluator._event["content"].get("body", None)
+            if not body:
+                return False
+            return _compile_glob(display_name, True)(body)
 
-        if not pattern:
-            pattern_type = condition.get('pattern_type', None)
-            if pattern_type == "user_id":
-                pattern = user_id
-            elif pattern_type == "user_localpart":
-                pattern = UserID.from_string(user_id).localpart
+        if self.pattern_type == "user_id":
+            pattern = user_id
+        else:
+            pattern = UserID.from_string(user_id).localpart
 
         if not pattern:
             logger.warn("event_match condition with no pattern")
             return False
 
-        # XXX: optimisation: cache our pattern regexps
-        if condition['key'] == 'content.body':
-            body = self._event["content"].get("body", None)
-            if not body:
-                return False
+        return self._match_value(
+            evaluator, _compile_glob(pattern, self.key == 'content.body'),
+        )
 
-            return _glob_matches(pattern, body, word_boundary=True)
+    def _match_value(self, evaluator, matcher):
+        if self.key == 'content.body':
+            value = evaluator._event["content"].get("body", None)
+            if not value:
+                return False
         else:
-            haystack = self._get_value(condition['key'])
-            if haystack is None:
+            value = evaluator._get_value(self.key)
+            if value is None:
                 return False
+        return matcher(value)
 
-            return _glob_matches(pattern, haystack)
 
-    def _contains_display_name(self, display_name):
-        if not display_name:
-            return False
+class CompiledPushRule(object):
+    """A push rule with its conditions compiled and split into those that
+    only depend on the event and those that also depend on the user.
 
-        body = self._event["content"].get("body", None)
-        if not body:
-            return False
+    Attributes:
+        event_type (str|None): If the rule can only match events of a single
+            type then the (lower cased) type, otherwise None.
+    """
+    __slots__ = ("actions", "event_conditions", "user_conditions", "event_type")
 
-        return _glob_matches(display_name, body, word_boundary=True)
+    def __init__(self, conditions, actions):
+        self.actions = actions
 
-    def _get_value(self, dotted_key):
-        return self._value_cache.get(dotted_key, None)
+        self.event_conditions = tuple(
+            c for c in conditions if not c.user_dependent
+        )
+        self.user_conditions = tuple(c for c in conditions if c.user_dependent)
+
+        self.event_type = None
+        for c in self.event_conditions:
+            if c.kind == 'event_match' and c.key == 'type':
+                if c.pattern and not IS_GLOB.search(c.pattern):
+                    self.event_type = c.pattern.lower()
+
+    def matches_event(self, evaluator):
+        for c in self.event_conditions:
+            if not c.matches(evaluator, None, None):
+                return False
+        return True
+
+    def matches_user(self, evaluator, user_id, display_name):
+        for c in self.user_conditions:
+            if not c.matches(evaluator, user_id, display_name):
+                return False
+        return True
+
+
+class CompiledPushRuleSet(object):
+    """A user's list of enabled push rules, in priority order, compiled and
+    indexed by the event type they can apply to.
+
+    Users whose rules are the same (e.g. those who only have the base rules)
+    share a single instance, see compile_push_rules.
+    """
+
+    def __init__(self, rules):
+        self.rules = tuple(rules)
+
+        # Rules that aren't restricted to a single event type
+        self._untyped_rules = tuple(r for r in self.rules if r.event_type is None)
+
+        # event type -> rules that could match an event of that type
+        self._rules_by_event_type = {
+            event_type: tuple(
+                r for r in self.rules
+                if r.event_type is None or r.event_type == event_type
+            )
+            for event_type in set(r.event_type for r in self.rules)
+            if event_type is not None
+        }
+
+    def rules_for_event_type(self, event_type):
+        return self._rules_by_event_type.get(
+            event_type.lower(), self._untyped_rules
+        )
+
+    def candidate_rules(self, evaluator):
+        """Returns the rules whose user independent conditions match the
+        event. Only the user dependent conditions of these rules then need
+        checking for each user, and the first rule that matches is the one to
+        apply.
+
+        The returned list stops after the first rule that has no user
+        dependent conditions, as that rule matches for every user.
+        """
+        candidates = []
+        for rule in self.rules_for_event_type(evaluator._event.type):
+            if rule.matches_event(evaluator):
+                candidates.append(rule)
+                if not rule.user_conditions:
+                    break
+        return candidates
+
+
+def compile_condition(condition):
+    """Returns the interned CompiledCondition for the given condition dict.
+    """
+    key = (
+        condition.get('kind'), condition.get('key'), condition.get('pattern'),
+        condition.get('pattern_type'), condition.get('is'),
+    )
+    compiled = _compiled_conditions.get(key, None)
+    if compiled is None:
+        compiled = CompiledCondition(condition)
+        _compiled_conditions[key] = compiled
+    return compiled
+
+
+def compile_push_rule(rule):
+    """Returns the interned CompiledPushRule for a rule dict, so that rules
+    with the same conditions and actions (e.g. every user's copy of the base
+    rules) share a CompiledPushRule.
+    """
+    conditions = [compile_condition(c) for c in rule['conditions']]
+
+    # The compiled rule references its conditions, so their ids can't be
+    # reused while it is in the cache.
+    key = (
+        tuple(id(c) for c in conditions),
+        json.dumps(rule['actions'], sort_keys=True),
+    )
+    compiled = _compiled_rules.get(key, None)
+    if compiled is None:
+        compiled = CompiledPushRule(conditions, rule['actions'])
+        _compiled_rules[key] = compiled
+    return compiled
+
+
+def compile_push_rules(rules):
+    """Returns the CompiledPushRuleSet for a user's list of push rules.
+
+    The result is cached against the identity of the list, which the storage
+    layer replaces whenever the user's rules change, so rules are compiled
+    once per version of a user's rule set.
+    """
+    cached = _compiled_rule_lists.get(id(rules), None)
+    if cached and cached[0] is rules:
+        return cached[1]
+
+    compiled_rules = [
+        compile_push_rule(r) for r in rules if r.get('enabled', True)
+    ]
+
+    # As above, the rule set references its rules so their ids can't be reused
+    signature = tuple(id(r) for r in compiled_rules)
+    rule_set = _compiled_rule_sets.get(signature, None)
+    if rule_set is None:
+        rule_set = CompiledPushRuleSet(compiled_rules)
+        _compiled_rule_sets[signature] = rule_set
+
+    _compiled_rule_lists[id(rules)] = (rules, rule_set)
+    return rule_set
 
 
 def _glob_matches(glob, value, word_boundary=False):
@@ -137,6 +337,23 @@ def _glob_matches(glob, value, word_boundary=False):
     Returns:
         bool
     """
+    return _compile_glob(glob, word_boundary)(value)
+
+
+def _compile_glob(glob, word_boundary):
+    """Returns a function that takes a string and returns whether it matches
+    the glob. The functions are cached, so the glob only gets turned into a
+    regex once.
+    """
+    key = (glob, word_boundary)
+    matcher = _glob_cache.get(key, None)
+    if matcher is None:
+        matcher = _glob_to_matcher(glob, word_boundary)
+        _glob_cache[key] = matcher
+    return matcher
+
+
+def _glob_to_matcher(glob, word_boundary):
     try:
         if IS_GLOB.search(glob):
             r = re.escape(glob)
@@ -155,29 +372,25 @@ def _glob_matches(glob, value, word_boundary=False):
                 r,
             )
             if word_boundary:
-                r = r"\b%s\b" % (r,)
-                r = _compile_regex(r)
-
-                return r.search(value)
+                r = re.compile(r"\b%s\b" % (r,), flags=re.IGNORECASE)
+                return lambda value: bool(r.search(value))
             else:
-                r = r + "$"
-                r = _compile_regex(r)
-
-                return r.match(value)
+                r = re.compile(r + "$", flags=re.IGNORECASE)
+                return lambda value: bool(r.match(value))
         elif word_boundary:
-            r = re.escape(glob)
-            r = r"\b%s\b" % (r,)
-            r = _compile_regex(r)
-
-            return r.search(value)
+            r = re.compile(r"\b%s\b" % (re.escape(glob),), flags=re.IGNORECASE)
+            return lambda value: bool(r.search(value))
         else:
-            return value.lower() == glob.lower()
+            glob = glob.lower()
+            return lambda value: value.lower() == glob
     except re.error:
         logger.warn("Failed to parse glob to regex: %r", glob)
-        return False
+        return _never_matches
 
 
-def _flatten_dict(d, prefix=[], result={}):
+def _flatten_dict(d, prefix=[], result=None):
+    if result is None:
+        result = {}
     for key, value in d.items():
         if isinstance(value, basestring):
             result[".".join(prefix + [key])] = value.lower()
@@ -187,14 +400,17 @@ def _flatten_dict(d, prefix=[], result={}):
     return result
 
 
-regex_cache = LruCache(5000)
+# Maps (glob, word_boundary) -> function testing whether a string matches
+_glob_cache = LruCache(5000)
+
+# Interned CompiledConditions, keyed by the condition's fields
+_compiled_conditions = LruCache(5000)
 
+# Interned CompiledPushRules, keyed by their conditions and actions
+_compiled_rules = LruCache(5000)
 
-def _compile_regex(regex_str):
-    r = regex_cache.get(regex_str, None)
-    if r:
-        return r
+# id(list of rule dicts) -> (list of rule dicts, CompiledPushRuleSet)
+_compiled_rule_lists = LruCache(50000)
 
-    r = re.compile(regex_str, flags=re.IGNORECASE)
-    regex_cache[regex_str] = r
-    return r
+# Interned CompiledPushRuleSets, keyed by the ids of their CompiledPushRules
+_compiled_rule_sets = LruCache(5000)
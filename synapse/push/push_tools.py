@@ -16,32 +16,78 @@
 from twisted.internet import defer
 
 
-@defer.inlineCallbacks
-def get_badge_count(store, user_id):
-    invites, joins = yield defer.gatherResults([
-        store.get_invited_rooms_for_user(user_id),
-        store.get_rooms_for_user(user_id),
-    ], consumeErrors=True)
-
-    my_receipts_by_room = yield store.get_receipts_for_user(
-        user_id, "m.read",
-    )
+class BadgeCounter(object):
+    """Keeps track of a user's badge count: the number of rooms they've been
+    invited to, plus the number of joined rooms with unread notifications.
+
+    Which rooms have unread notifications is maintained incrementally: rooms
+    are only rechecked when the user's read receipt in them changes (or they
+    join them), and are marked as unread as new notifications are sent.
+    """
+
+    def __init__(self, store, user_id):
+        self.store = store
+        self.user_id = user_id
+
+        # room_id -> the read receipt event_id we last checked the room's
+        # unread notifications against.
+        self._checked_receipts = {}
+
+        # The set of room_ids with unread notifications.
+        self._unread_room_ids = set()
+
+    def on_notification(self, room_id):
+        """Called when we have sent a notification for an event in the room.
+        """
+        # We only count rooms the user has read receipts in, as a room they
+        # have never read isn't necessarily one they care about.
+        if self._checked_receipts.get(room_id) is not None:
+            self._unread_room_ids.add(room_id)
 
-    badge = len(invites)
+    @defer.inlineCallbacks
+    def get_badge_count(self):
+        invites, joins = yield defer.gatherResults([
+            self.store.get_invited_rooms_for_user(self.user_id),
+            self.store.get_rooms_for_user(self.user_id),
+        ], consumeErrors=True)
 
-    for r in joins:
-        if r.room_id in my_receipts_by_room:
-            last_unread_event_id = my_receipts_by_room[r.room_id]
+        my_receipts_by_room = yield self.store.get_receipts_for_user(
+            self.user_id, "m.read",
+        )
+
+        joined_room_ids = set(r.room_id for r in joins)
+
+        for room_id in joined_room_ids:
+            last_unread_event_id = my_receipts_by_room.get(room_id)
+            if room_id in self._checked_receipts:
+                if self._checked_receipts[room_id] == last_unread_event_id:
+                    continue
+
+            self._checked_receipts[room_id] = last_unread_event_id
+
+            if last_unread_event_id is None:
+                self._unread_room_ids.discard(room_id)
+                continue
 
             notifs = yield (
-                store.get_unread_event_push_actions_by_room_for_user(
-                    r.room_id, user_id, last_unread_event_id
+                self.store.get_unread_event_push_actions_by_room_for_user(
+                    room_id, self.user_id, last_unread_event_id
                 )
             )
             # return one badge count per conversation, as count per
             # message is so noisy as to be almost useless
-            badge += 1 if notifs["notify_count"] else 0
-    defer.returnValue(badge)
+            if notifs["notify_count"]:
+                self._unread_room_ids.add(room_id)
+            else:
+                self._unread_room_ids.discard(room_id)
+
+        # Forget about rooms the user has left.
+        for room_id in self._checked_receipts.keys():
+            if room_id not in joined_room_ids:
+                del self._checked_receipts[room_id]
+                self._unread_room_ids.discard(room_id)
+
+        defer.returnValue(len(invites) + len(self._unread_room_ids))
 
 
 @defer.inlineCallbacks
@@ -26,5 +26,6 @@ class SlavedApplicationServiceStore(BaseSlavedStore):
             hs.config.app_service_config_files
         )
 
+    get_app_services = DataStore.get_app_services.__func__
     get_app_service_by_token = DataStore.get_app_service_by_token.__func__
     get_app_service_by_user_id = DataStore.get_app_service_by_user_id.__func__
@@ -15,7 +15,7 @@
 from ._base import BaseSlavedStore
 from ._slaved_id_tracker import SlavedIdTracker
 
-from synapse.api.constants import EventTypes
+from synapse.api.constants import EventTypes, Membership
 from synapse.events import FrozenEvent
 from synapse.storage import DataStore
 from synapse.storage.room import RoomStore
@@ -24,6 +24,7 @@ from synapse.storage.event_federation import EventFederationStore
 from synapse.storage.event_push_actions import EventPushActionsStore
 from synapse.storage.state import StateStore
 from synapse.storage.stream import StreamStore
+from synapse.util.caches.room_membership_index import RoomMembershipIndex
 from synapse.util.caches.stream_change_cache import StreamChangeCache
 
 import ujson as json
@@ -61,12 +62,14 @@ class SlavedEventStore(BaseSlavedStore):
         self._membership_stream_cache = StreamChangeCache(
             "MembershipStreamChangeCache", events_max,
         )
+        self.room_membership_index = RoomMembershipIndex("RoomMembershipIndex")
 
     # Cached functions can't be accessed through a class instance so we need
     # to reach inside the __dict__ to extract them.
     get_room_name_and_aliases = RoomStore.__dict__["get_room_name_and_aliases"]
     get_rooms_for_user = RoomMemberStore.__dict__["get_rooms_for_user"]
     get_users_in_room = RoomMemberStore.__dict__["get_users_in_room"]
+    get_joined_hosts_for_room = RoomMemberStore.__dict__["get_joined_hosts_for_room"]
     get_latest_event_ids_in_room = EventFederationStore.__dict__[
         "get_latest_event_ids_in_room"
     ]
@@ -111,6 +114,12 @@ class SlavedEventStore(BaseSlavedStore):
     get_membership_changes_for_user = (
         DataStore.get_membership_changes_for_user.__func__
     )
+    get_joined_room_ids_for_user = (
+        DataStore.get_joined_room_ids_for_user.__func__
+    )
+    get_joined_user_ids_for_room = (
+        DataStore.get_joined_user_ids_for_room.__func__
+    )
     get_room_events_max_id = DataStore.get_room_events_max_id.__func__
     get_room_events_stream_for_room = (
         DataStore.get_room_events_stream_for_room.__func__
@@ -124,6 +133,10 @@ class SlavedEventStore(BaseSlavedStore):
         DataStore.get_room_events_stream_for_rooms.__func__
     )
     get_stream_token_for_event = DataStore.get_stream_token_for_event.__func__
+    get_auth_chain = DataStore.get_auth_chain.__func__
+    get_auth_chain_ids = DataStore.get_auth_chain_ids.__func__
+    get_backfill_events = DataStore.get_backfill_events.__func__
+    get_missing_events = DataStore.get_missing_events.__func__
 
     _set_before_and_after = staticmethod(DataStore._set_before_and_after)
 
@@ -134,7 +147,11 @@ class SlavedEventStore(BaseSlavedStore):
     _enqueue_events = DataStore._enqueue_events.__func__
     _do_fetch = DataStore._do_fetch.__func__
     _fetch_event_rows = DataStore._fetch_event_rows.__func__
-    _get_event_from_row = DataStore._get_event_from_row.__func__
+    _decode_event_rows = DataStore._decode_event_rows.__func__
+    _get_event_cache_entry = DataStore._get_event_cache_entry.__func__
+    _get_redacted_event_cache_entry = (
+        DataStore._get_redacted_event_cache_entry.__func__
+    )
     _get_rooms_for_user_where_membership_is_txn = (
         DataStore._get_rooms_for_user_where_membership_is_txn.__func__
     )
@@ -143,6 +160,17 @@ class SlavedEventStore(BaseSlavedStore):
     _get_all_state_from_cache = DataStore._get_all_state_from_cache.__func__
     _get_events_around_txn = DataStore._get_events_around_txn.__func__
     _get_some_state_from_cache = DataStore._get_some_state_from_cache.__func__
+    _get_state_groups_from_groups_txn = (
+        DataStore._get_state_groups_from_groups_txn.__func__
+    )
+    _get_auth_chain_ids_txn = DataStore._get_auth_chain_ids_txn.__func__
+    _get_indexed_auth_chains_txn = DataStore._get_indexed_auth_chains_txn.__func__
+    _walk_auth_chain_ids_txn = DataStore._walk_auth_chain_ids_txn.__func__
+    _get_backfill_events = DataStore._get_backfill_events.__func__
+    _get_missing_events = DataStore._get_missing_events.__func__
+    _count_push_actions_after_txn = (
+        DataStore._count_push_actions_after_txn.__func__
+    )
 
     def stream_positions(self):
         result = super(SlavedEventStore, self).stream_positions()
@@ -201,8 +229,9 @@ class SlavedEventStore(BaseSlavedStore):
             self._get_current_state_for_key.invalidate_all()
             self.get_rooms_for_user.invalidate_all()
             self.get_users_in_room.invalidate((event.room_id,))
-            # self.get_joined_hosts_for_room.invalidate((event.room_id,))
+            self.get_joined_hosts_for_room.invalidate((event.room_id,))
             self.get_room_name_and_aliases.invalidate((event.room_id,))
+            self.room_membership_index.invalidate_room(event.room_id)
 
         self._invalidate_get_event_cache(event.event_id)
 
@@ -226,13 +255,19 @@ class SlavedEventStore(BaseSlavedStore):
 
         if event.type == EventTypes.Member:
             self.get_rooms_for_user.invalidate((event.state_key,))
-            # self.get_joined_hosts_for_room.invalidate((event.room_id,))
+            self.get_joined_hosts_for_room.invalidate((event.room_id,))
             self.get_users_in_room.invalidate((event.room_id,))
             self._membership_stream_cache.entity_has_changed(
                 event.state_key, event.internal_metadata.stream_ordering
             )
             self.get_invited_rooms_for_user.invalidate((event.state_key,))
 
+            if not backfilled and not event.internal_metadata.is_outlier():
+                self.room_membership_index.membership_changed(
+                    event.room_id, event.state_key,
+                    event.membership == Membership.JOIN,
+                )
+
         if not event.is_state():
             return
 
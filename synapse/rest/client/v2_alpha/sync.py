@@ -26,6 +26,7 @@ from synapse.events.utils import (
 from synapse.api.filtering import FilterCollection, DEFAULT_FILTER_COLLECTION
 from synapse.api.errors import SynapseError
 from synapse.api.constants import PresenceState
+from synapse.util.caches.lrucache import LruCache
 from ._base import client_v2_patterns
 
 import copy
@@ -84,6 +85,12 @@ class SyncRestServlet(RestServlet):
         self.filtering = hs.get_filtering()
         self.presence_handler = hs.get_presence_handler()
 
+        # Sync results may be shared between requests (see
+        # SyncHandler.wait_for_sync_for_user), in which case requests using the
+        # same access token can also share the serialized response. Maps
+        # (id(sync_result), token_id) -> (sync_result, response_content).
+        self._serialized_cache = LruCache(100)
+
     @defer.inlineCallbacks
     def on_GET(self, request):
         if "from" in request.args:
@@ -157,6 +164,11 @@ class SyncRestServlet(RestServlet):
                 full_state=full_state
             )
 
+        cache_key = (id(sync_result), requester.access_token_id)
+        cached = self._serialized_cache.get(cache_key)
+        if cached and cached[0] is sync_result:
+            defer.returnValue((200, cached[1]))
+
         time_now = self.clock.time_msec()
 
         joined = self.encode_joined(
@@ -184,6 +196,10 @@ class SyncRestServlet(RestServlet):
             "next_batch": sync_result.next_batch.to_string(),
         }
 
+        # We keep a reference to the sync result so that its id can't be
+        # reused while it is in the cache.
+        self._serialized_cache[cache_key] = (sync_result, response_content)
+
         defer.returnValue((200, response_content))
 
     def encode_presence(self, events, time_now):
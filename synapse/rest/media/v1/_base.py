@@ -25,6 +25,7 @@ from synapse.util.stringutils import is_ascii
 
 import os
 
+import hashlib
 import logging
 import urllib
 import urlparse
@@ -65,10 +66,44 @@ def respond_404(request):
 
 @defer.inlineCallbacks
 def respond_with_file(request, media_type, file_path,
-                      file_size=None, upload_name=None):
+                      file_size=None, upload_name=None, etag=None):
+    """Responds to the request with the file, honouring If-None-Match and
+    (single) byte Range requests.
+
+    Args:
+        request (twisted.web.http.Request)
+        media_type (str): The content type of the file
+        file_path (str): The path of the file to send
+        file_size (int): The size of the file, if known
+        upload_name (str): The name to give the file in the
+            Content-Disposition header, if any
+        etag (str): The ETag of the file. Media files never change, so this
+            defaults to one derived from the file's path (which includes the
+            media id).
+    """
     logger.debug("Responding with %r", file_path)
 
     if os.path.isfile(file_path):
+        if etag is None:
+            etag = hashlib.sha1(file_path).hexdigest()
+        etag = b'"%s"' % (etag.encode("ascii"),)
+
+        # cache for at least a day.
+        # XXX: we might want to turn this off for data we don't want to
+        # recommend caching as it's sensitive or private - or at least
+        # select private. don't bother setting Expires as all our
+        # clients are smart enough to be happy with Cache-Control
+        request.setHeader(
+            b"Cache-Control", b"public,max-age=86400,s-maxage=86400"
+        )
+        request.setHeader(b"ETag", etag)
+        request.setHeader(b"Accept-Ranges", b"bytes")
+
+        if _etag_matches(request.getHeader(b"If-None-Match"), etag):
+            request.setResponseCode(304)
+            finish_request(request)
+            return
+
         request.setHeader(b"Content-Type", media_type.encode("UTF-8"))
         if upload_name:
             if is_ascii(upload_name):
@@ -86,25 +121,128 @@ def respond_with_file(request, media_type, file_path,
                     ),
                 )
 
-        # cache for at least a day.
-        # XXX: we might want to turn this off for data we don't want to
-        # recommend caching as it's sensitive or private - or at least
-        # select private. don't bother setting Expires as all our
-        # clients are smart enough to be happy with Cache-Control
-        request.setHeader(
-            b"Cache-Control", b"public,max-age=86400,s-maxage=86400"
-        )
         if file_size is None:
             stat = os.stat(file_path)
             file_size = stat.st_size
+        file_size = int(file_size)
+
+        byte_range = None
+        if_range = request.getHeader(b"If-Range")
+        if if_range is None or if_range == etag:
+            try:
+                byte_range = _parse_range(request.getHeader(b"Range"), file_size)
+            except _UnsatisfiableRange:
+                request.setResponseCode(416)
+                request.setHeader(b"Content-Range", b"bytes */%d" % (file_size,))
+                request.setHeader(b"Content-Length", b"0")
+                finish_request(request)
+                return
+
+        if byte_range:
+            start, end = byte_range
+            request.setResponseCode(206)
+            request.setHeader(
+                b"Content-Range", b"bytes %d-%d/%d" % (start, end, file_size),
+            )
+        else:
+            start, end = 0, file_size - 1
 
         request.setHeader(
-            b"Content-Length", b"%d" % (file_size,)
+            b"Content-Length", b"%d" % (end - start + 1,)
         )
 
         with open(file_path, "rb") as f:
-            yield FileSender().beginFileTransfer(f, request)
+            if start:
+                f.seek(start)
+            yield FileSender().beginFileTransfer(
+                _BoundedReader(f, end - start + 1), request
+            )
 
         finish_request(request)
     else:
         respond_404(request)
+
+
+def _etag_matches(if_none_match, etag):
+    """Checks whether an If-None-Match header matches the ETag"""
+    if not if_none_match:
+        return False
+
+    for tag in if_none_match.split(b","):
+        tag = tag.strip()
+        if tag.startswith(b"W/"):
+            tag = tag[2:]
+        if tag == b"*" or tag == etag:
+            return True
+    return False
+
+
+class _UnsatisfiableRange(Exception):
+    pass
+
+
+def _parse_range(range_header, file_size):
+    """Parses a Range header.
+
+    Only single byte ranges are supported. Anything else (including malformed
+    headers) is ignored, which means the whole file is sent.
+
+    Args:
+        range_header (str|None): The Range header of the request.
+        file_size (int): The size of the file being requested.
+
+    Returns:
+        tuple(int, int)|None: The first and last (inclusive) bytes requested,
+        or None if the whole file should be sent.
+
+    Raises:
+        _UnsatisfiableRange if the range doesn't overlap the file.
+    """
+    if not range_header:
+        return None
+
+    unit, _, spec = range_header.partition(b"=")
+    if unit.strip().lower() != b"bytes" or b"," in spec:
+        return None
+
+    first, _, last = spec.strip().partition(b"-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else file_size - 1
+            if start >= file_size:
+                raise _UnsatisfiableRange()
+            if end < start:
+                return None
+        elif last:
+            # A suffix range, i.e. the last N bytes.
+            length = int(last)
+            if length == 0:
+                raise _UnsatisfiableRange()
+            start = max(file_size - length, 0)
+            end = file_size - 1
+        else:
+            return None
+    except ValueError:
+        return None
+
+    if start >= file_size:
+        raise _UnsatisfiableRange()
+
+    return start, min(end, file_size - 1)
+
+
+class _BoundedReader(object):
+    """Wraps a file so that at most `length` bytes are read from it. Used to
+    only send the requested part of the file with a FileSender.
+    """
+    def __init__(self, f, length):
+        self._file = f
+        self._remaining = length
+
+    def read(self, size):
+        if self._remaining <= 0:
+            return b""
+        data = self._file.read(min(size, self._remaining))
+        self._remaining -= len(data)
+        return data
@@ -68,6 +68,7 @@ class DownloadResource(Resource):
         yield respond_with_file(
             request, media_type, file_path, media_length,
             upload_name=upload_name,
+            etag="%s/%s" % (self.server_name, media_id),
         )
 
     @defer.inlineCallbacks
@@ -86,4 +87,5 @@ class DownloadResource(Resource):
         yield respond_with_file(
             request, media_type, file_path, media_length,
             upload_name=upload_name,
+            etag="%s/%s" % (server_name, media_id),
         )
@@ -38,6 +38,19 @@ class MediaFilePaths(object):
             media_id[0:2], media_id[2:4], media_id[4:]
         )
 
+    def local_media_content_filepath(self, content_hash):
+        """The path where local media with the given (hex encoded) sha256
+        content hash is stored. Each uploaded media_id is a hard link to one
+        of these files, so identical uploads share the same file on disk.
+        """
+        return os.path.join(
+            self.base_path, "local_content_hashes",
+            content_hash[0:2], content_hash[2:4], content_hash[4:]
+        )
+
+    def upload_temp_dir(self):
+        return os.path.join(self.base_path, "upload_temp")
+
     def local_media_thumbnail(self, media_id, width, height, content_type,
                               method):
         top_level_type, sub_type = content_type.split("/")
@@ -60,8 +73,13 @@ class MediaFilePaths(object):
                                content_type, method):
         top_level_type, sub_type = content_type.split("/")
         file_name = "%i-%i-%s-%s" % (width, height, top_level_type, sub_type)
+        return os.path.join(
+            self.remote_media_thumbnail_dir(server_name, file_id),
+            file_name
+        )
+
+    def remote_media_thumbnail_dir(self, server_name, file_id):
         return os.path.join(
             self.base_path, "remote_thumbnail", server_name,
             file_id[0:2], file_id[2:4], file_id[4:],
-            file_name
         )
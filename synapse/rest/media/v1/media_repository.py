@@ -31,16 +31,41 @@ from twisted.internet import defer, threads
 
 from synapse.util.async import ObservableDeferred
 from synapse.util.stringutils import is_ascii
-from synapse.util.logcontext import preserve_context_over_fn
+from synapse.util.logcontext import (
+    PreserveLoggingContext, preserve_context_over_deferred,
+    preserve_context_over_fn, preserve_fn,
+)
+
+from collections import OrderedDict
 
 import os
 
 import cgi
+import errno
+import hashlib
 import logging
+import shutil
+import tempfile
 import urlparse
 
 logger = logging.getLogger(__name__)
 
+# How many bytes of an upload to read into memory at a time.
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# The number of thumbnail jobs to run concurrently. Thumbnails are generated
+# on the reactor's thread pool, and PIL releases the GIL while decoding and
+# resizing images, so they don't hold up the reactor.
+MAX_CONCURRENT_THUMBNAIL_JOBS = 4
+
+# How often to write the access times of remote media to the database.
+UPDATE_RECENTLY_ACCESSED_REMOTES_MS = 60 * 1000
+
+# How often to check whether the remote media cache is too large, and the
+# number of media to consider evicting at a time.
+EVICT_REMOTE_MEDIA_INTERVAL_MS = 10 * 60 * 1000
+EVICT_REMOTE_MEDIA_BATCH_SIZE = 100
+
 
 class MediaRepository(object):
     def __init__(self, hs, filepaths):
@@ -56,6 +81,32 @@ class MediaRepository(object):
         self.dynamic_thumbnails = hs.config.dynamic_thumbnails
         self.thumbnail_requirements = hs.config.thumbnail_requirements
 
+        # (server_name, media_id) -> ObservableDeferred that resolves once the
+        # thumbnails for the media have been generated. server_name is None
+        # for local media.
+        self._thumbnail_jobs = {}
+
+        # (server_name, media_id) -> (deferred, function, args) of thumbnail
+        # jobs waiting for one of the running jobs to finish.
+        self._queued_thumbnail_jobs = OrderedDict()
+        self._running_thumbnail_jobs = 0
+
+        self.max_remote_media_cache_size = hs.config.max_remote_media_cache_size
+
+        # (server_name, media_id) of remote media that have been accessed
+        # since we last wrote their access times to the database.
+        self.recently_accessed_remotes = set()
+
+        self.clock.looping_call(
+            self._update_recently_accessed_remotes,
+            UPDATE_RECENTLY_ACCESSED_REMOTES_MS,
+        )
+
+        if self.max_remote_media_cache_size:
+            self.clock.looping_call(
+                self._evict_remote_media, EVICT_REMOTE_MEDIA_INTERVAL_MS,
+            )
+
     @staticmethod
     def _makedirs(filepath):
         dirname = os.path.dirname(filepath)
@@ -65,15 +116,26 @@ class MediaRepository(object):
     @defer.inlineCallbacks
     def create_content(self, media_type, upload_name, content, content_length,
                        auth_user):
+        """Store uploaded content for a local user and return the mxc URL
+
+        Args:
+            media_type(str): The content type of the file
+            upload_name(str): The name of the file
+            content: A file like object that is the content to store
+            content_length(int): The length of the content
+            auth_user(str): The user_id of the uploader
+
+        Returns:
+            Deferred[str]: The mxc url of the stored content
+        """
         media_id = random_string(24)
 
         fname = self.filepaths.local_media_filepath(media_id)
         self._makedirs(fname)
 
-        # This shouldn't block for very long because the content will have
-        # already been uploaded at this point.
-        with open(fname, "wb") as f:
-            f.write(content)
+        content_length = yield preserve_context_over_fn(
+            threads.deferToThread, self._write_local_content, content, fname
+        )
 
         yield self.store.store_local_media(
             media_id=media_id,
@@ -88,12 +150,74 @@ class MediaRepository(object):
             "media_length": content_length,
         }
 
-        yield self._generate_local_thumbnails(media_id, media_info)
+        self._queue_thumbnail_job(
+            None, media_id, self._generate_local_thumbnails, media_id, media_info
+        )
 
         defer.returnValue("mxc://%s/%s" % (self.server_name, media_id))
 
+    def _write_local_content(self, content, fname):
+        """Streams the content to disk, in chunks, and links it into place at
+        `fname`.
+
+        The content is stored under its sha256 hash, so that if the same file
+        has been uploaded before we just link to the existing copy.
+
+        Args:
+            content: A file like object to read the content from
+            fname (str): The path to store the content at
+
+        Returns:
+            int: The length of the content
+        """
+        temp_dir = self.filepaths.upload_temp_dir()
+        if not os.path.exists(temp_dir):
+            os.makedirs(temp_dir)
+
+        content_hash = hashlib.sha256()
+        length = 0
+
+        fd, temp_fname = tempfile.mkstemp(dir=temp_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    chunk = content.read(UPLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    content_hash.update(chunk)
+                    f.write(chunk)
+                    length += len(chunk)
+
+            hash_fname = self.filepaths.local_media_content_filepath(
+                content_hash.hexdigest()
+            )
+            self._makedirs(hash_fname)
+
+            if os.path.exists(hash_fname):
+                logger.info(
+                    "Deduplicating upload with existing content %s",
+                    content_hash.hexdigest(),
+                )
+            else:
+                os.rename(temp_fname, hash_fname)
+        finally:
+            if os.path.exists(temp_fname):
+                os.remove(temp_fname)
+
+        try:
+            os.link(hash_fname, fname)
+        except OSError as e:
+            # Hard links aren't supported everywhere (or the media store might
+            # span file systems), so fall back to a copy.
+            logger.warn("Failed to link %s to %s: %s", hash_fname, fname, e)
+            shutil.copyfile(hash_fname, fname)
+
+        return length
+
     def get_remote_media(self, server_name, media_id):
         key = (server_name, media_id)
+        self.recently_accessed_remotes.add(key)
+
         download = self.downloads.get(key)
         if download is None:
             download = self._get_remote_media_impl(server_name, media_id)
@@ -109,6 +233,81 @@ class MediaRepository(object):
                 return media_info
         return download.observe()
 
+    @defer.inlineCallbacks
+    def _update_recently_accessed_remotes(self):
+        media = self.recently_accessed_remotes
+        if not media:
+            return
+        self.recently_accessed_remotes = set()
+
+        try:
+            yield self.store.update_cached_last_access_time(
+                media, self.clock.time_msec()
+            )
+        except Exception:
+            logger.exception("Failed to update remote media access times")
+
+    @defer.inlineCallbacks
+    def _evict_remote_media(self):
+        """Removes the least recently used remote media (and their
+        thumbnails) until the cache is within max_remote_media_cache_size.
+        """
+        try:
+            size = yield self.store.get_remote_media_cache_size()
+
+            while size > self.max_remote_media_cache_size:
+                lru_media = yield self.store.get_least_recently_used_remote_media(
+                    EVICT_REMOTE_MEDIA_BATCH_SIZE
+                )
+
+                evicted = False
+                for media in lru_media:
+                    if size <= self.max_remote_media_cache_size:
+                        break
+
+                    key = (media["media_origin"], media["media_id"])
+
+                    # Don't remove media that are in use.
+                    if (key in self.downloads or key in self._thumbnail_jobs
+                            or key in self.recently_accessed_remotes):
+                        continue
+
+                    yield self._delete_remote_media(
+                        media["media_origin"], media["media_id"],
+                        media["filesystem_id"],
+                    )
+                    size -= media["size"]
+                    evicted = True
+
+                if not evicted:
+                    break
+        except Exception:
+            logger.exception("Failed to evict remote media")
+
+    @defer.inlineCallbacks
+    def _delete_remote_media(self, server_name, media_id, file_id):
+        logger.info("Evicting remote media %s/%s", server_name, media_id)
+
+        # We delete the rows first, so that nothing tries to serve the files
+        # after we've removed them.
+        yield self.store.delete_remote_media(server_name, media_id)
+
+        def remove_files():
+            try:
+                os.remove(
+                    self.filepaths.remote_media_filepath(server_name, file_id)
+                )
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+            shutil.rmtree(
+                self.filepaths.remote_media_thumbnail_dir(server_name, file_id),
+                ignore_errors=True,
+            )
+
+        yield preserve_context_over_fn(threads.deferToThread, remove_files)
+
     @defer.inlineCallbacks
     def _get_remote_media_impl(self, server_name, media_id):
         media_info = yield self.store.get_cached_remote_media(
@@ -188,8 +387,9 @@ class MediaRepository(object):
             "filesystem_id": file_id,
         }
 
-        yield self._generate_remote_thumbnails(
-            server_name, media_id, media_info
+        self._queue_thumbnail_job(
+            server_name, media_id,
+            self._generate_remote_thumbnails, server_name, media_id, media_info
         )
 
         defer.returnValue(media_info)
@@ -210,6 +410,8 @@ class MediaRepository(object):
             )
             return
 
+        thumbnailer.draft(t_width, t_height)
+
         if t_method == "crop":
             t_len = thumbnailer.crop(t_path, t_width, t_height, t_type)
         elif t_method == "scale":
@@ -266,14 +468,23 @@ class MediaRepository(object):
 
             defer.returnValue(t_path)
 
-    @defer.inlineCallbacks
-    def _generate_local_thumbnails(self, media_id, media_info):
-        media_type = media_info["media_type"]
-        requirements = self._get_thumbnail_requirements(media_type)
-        if not requirements:
-            return
-
-        input_path = self.filepaths.local_media_filepath(media_id)
+    def _generate_thumbnails(self, input_path, requirements, thumbnail_path):
+        """Generates all the required thumbnails of an image in one pass,
+        decoding the image only once. This blocks, so should be run on a
+        thread.
+
+        Args:
+            input_path (str): The path of the image.
+            requirements (list(ThumbnailRequirement)): The thumbnails to
+                generate.
+            thumbnail_path (func): Called with the width, height, type and
+                method of a thumbnail, returns the path to write it to.
+
+        Returns:
+            tuple(int, int, list): The width and height of the image, and a list
+            of (width, height, type, method, length) of the thumbnails that
+            were generated.
+        """
         thumbnailer = Thumbnailer(input_path)
         m_width = thumbnailer.width
         m_height = thumbnailer.height
@@ -283,54 +494,79 @@ class MediaRepository(object):
                 "Image too large to thumbnail %r x %r > %r",
                 m_width, m_height, self.max_image_pixels
             )
-            return
+            return m_width, m_height, []
+
+        scales = set()
+        crops = set()
+        for r_width, r_height, r_method, r_type in requirements:
+            if r_method == "scale":
+                t_width, t_height = thumbnailer.aspect(r_width, r_height)
+                scales.add((
+                    min(m_width, t_width), min(m_height, t_height), r_type,
+                ))
+            elif r_method == "crop":
+                crops.add((r_width, r_height, r_type))
+
+        to_generate = [
+            (s_width, s_height, s_type, "scale")
+            for s_width, s_height, s_type in scales
+        ]
+
+        # If the aspect ratio of the cropped thumbnail matches a purely
+        # scaled one then there is no point in calculating a separate
+        # thumbnail.
+        to_generate.extend(
+            (c_width, c_height, c_type, "crop")
+            for c_width, c_height, c_type in crops
+            if (c_width, c_height, c_type) not in scales
+        )
 
-        local_thumbnails = []
-
-        def generate_thumbnails():
-            scales = set()
-            crops = set()
-            for r_width, r_height, r_method, r_type in requirements:
-                if r_method == "scale":
-                    t_width, t_height = thumbnailer.aspect(r_width, r_height)
-                    scales.add((
-                        min(m_width, t_width), min(m_height, t_height), r_type,
-                    ))
-                elif r_method == "crop":
-                    crops.add((r_width, r_height, r_type))
-
-            for t_width, t_height, t_type in scales:
-                t_method = "scale"
-                t_path = self.filepaths.local_media_thumbnail(
-                    media_id, t_width, t_height, t_type, t_method
-                )
-                self._makedirs(t_path)
-                t_len = thumbnailer.scale(t_path, t_width, t_height, t_type)
+        if not to_generate:
+            return m_width, m_height, []
 
-                local_thumbnails.append((
-                    media_id, t_width, t_height, t_type, t_method, t_len
-                ))
+        # We generate the largest thumbnails first so that the smaller ones
+        # can be scaled down from them, and only decode the image at the size
+        # the largest one needs.
+        to_generate.sort(key=lambda t: t[0] * t[1], reverse=True)
+        thumbnailer.draft(
+            max(t[0] for t in to_generate), max(t[1] for t in to_generate),
+        )
 
-            for t_width, t_height, t_type in crops:
-                if (t_width, t_height, t_type) in scales:
-                    # If the aspect ratio of the cropped thumbnail matches a purely
-                    # scaled one then there is no point in calculating a separate
-                    # thumbnail.
-                    continue
-                t_method = "crop"
-                t_path = self.filepaths.local_media_thumbnail(
-                    media_id, t_width, t_height, t_type, t_method
-                )
-                self._makedirs(t_path)
+        thumbnails = []
+        for t_width, t_height, t_type, t_method in to_generate:
+            t_path = thumbnail_path(t_width, t_height, t_type, t_method)
+            self._makedirs(t_path)
+            if t_method == "scale":
+                t_len = thumbnailer.scale(t_path, t_width, t_height, t_type)
+            else:
                 t_len = thumbnailer.crop(t_path, t_width, t_height, t_type)
-                local_thumbnails.append((
-                    media_id, t_width, t_height, t_type, t_method, t_len
-                ))
+            thumbnails.append((t_width, t_height, t_type, t_method, t_len))
+
+        return m_width, m_height, thumbnails
+
+    @defer.inlineCallbacks
+    def _generate_local_thumbnails(self, media_id, media_info):
+        media_type = media_info["media_type"]
+        requirements = self._get_thumbnail_requirements(media_type)
+        if not requirements:
+            return
+
+        input_path = self.filepaths.local_media_filepath(media_id)
+
+        def thumbnail_path(t_width, t_height, t_type, t_method):
+            return self.filepaths.local_media_thumbnail(
+                media_id, t_width, t_height, t_type, t_method
+            )
 
-        yield preserve_context_over_fn(threads.deferToThread, generate_thumbnails)
+        m_width, m_height, thumbnails = yield preserve_context_over_fn(
+            threads.deferToThread,
+            self._generate_thumbnails, input_path, requirements, thumbnail_path,
+        )
 
-        for l in local_thumbnails:
-            yield self.store.store_local_thumbnail(*l)
+        for t_width, t_height, t_type, t_method, t_len in thumbnails:
+            yield self.store.store_local_thumbnail(
+                media_id, t_width, t_height, t_type, t_method, t_len
+            )
 
         defer.returnValue({
             "width": m_width,
@@ -345,71 +581,125 @@ class MediaRepository(object):
         if not requirements:
             return
 
-        remote_thumbnails = []
-
         input_path = self.filepaths.remote_media_filepath(server_name, file_id)
-        thumbnailer = Thumbnailer(input_path)
-        m_width = thumbnailer.width
-        m_height = thumbnailer.height
 
-        def generate_thumbnails():
-            if m_width * m_height >= self.max_image_pixels:
-                logger.info(
-                    "Image too large to thumbnail %r x %r > %r",
-                    m_width, m_height, self.max_image_pixels
-                )
-                return
-
-            scales = set()
-            crops = set()
-            for r_width, r_height, r_method, r_type in requirements:
-                if r_method == "scale":
-                    t_width, t_height = thumbnailer.aspect(r_width, r_height)
-                    scales.add((
-                        min(m_width, t_width), min(m_height, t_height), r_type,
-                    ))
-                elif r_method == "crop":
-                    crops.add((r_width, r_height, r_type))
-
-            for t_width, t_height, t_type in scales:
-                t_method = "scale"
-                t_path = self.filepaths.remote_media_thumbnail(
-                    server_name, file_id, t_width, t_height, t_type, t_method
-                )
-                self._makedirs(t_path)
-                t_len = thumbnailer.scale(t_path, t_width, t_height, t_type)
-                remote_thumbnails.append([
-                    server_name, media_id, file_id,
-                    t_width, t_height, t_type, t_method, t_len
-                ])
-
-            for t_width, t_height, t_type in crops:
-                if (t_width, t_height, t_type) in scales:
-                    # If the aspect ratio of the cropped thumbnail matches a purely
-                    # scaled one then there is no point in calculating a separate
-                    # thumbnail.
-                    continue
-                t_method = "crop"
-                t_path = self.filepaths.remote_media_thumbnail(
-                    server_name, file_id, t_width, t_height, t_type, t_method
-                )
-                self._makedirs(t_path)
-                t_len = thumbnailer.crop(t_path, t_width, t_height, t_type)
-                remote_thumbnails.append([
-                    server_name, media_id, file_id,
-                    t_width, t_height, t_type, t_method, t_len
-                ])
+        def thumbnail_path(t_width, t_height, t_type, t_method):
+            return self.filepaths.remote_media_thumbnail(
+                server_name, file_id, t_width, t_height, t_type, t_method
+            )
 
-        yield preserve_context_over_fn(threads.deferToThread, generate_thumbnails)
+        m_width, m_height, thumbnails = yield preserve_context_over_fn(
+            threads.deferToThread,
+            self._generate_thumbnails, input_path, requirements, thumbnail_path,
+        )
 
-        for r in remote_thumbnails:
-            yield self.store.store_remote_media_thumbnail(*r)
+        for t_width, t_height, t_type, t_method, t_len in thumbnails:
+            yield self.store.store_remote_media_thumbnail(
+                server_name, media_id, file_id,
+                t_width, t_height, t_type, t_method, t_len
+            )
 
         defer.returnValue({
             "width": m_width,
             "height": m_height,
         })
 
+    def _queue_thumbnail_job(self, server_name, media_id, f, *args):
+        """Queues up generating the thumbnails for a piece of media, so that
+        we don't make the uploader (or downloader) wait for them.
+
+        Args:
+            server_name (str|None): The origin of the media, or None if local.
+            media_id (str)
+            f (func): Function that generates the thumbnails, returning a
+                deferred.
+            *args: Arguments to pass to f.
+        """
+        key = (server_name, media_id)
+        deferred = defer.Deferred()
+        self._thumbnail_jobs[key] = ObservableDeferred(deferred)
+        self._queued_thumbnail_jobs[key] = (deferred, f, args)
+        self._start_thumbnail_jobs()
+
+    def _start_thumbnail_jobs(self):
+        while (self._queued_thumbnail_jobs
+               and self._running_thumbnail_jobs < MAX_CONCURRENT_THUMBNAIL_JOBS):
+            key, job = self._queued_thumbnail_jobs.popitem(last=False)
+            preserve_fn(self._run_thumbnail_job)(key, *job)
+
+    @defer.inlineCallbacks
+    def _run_thumbnail_job(self, key, deferred, f, args):
+        self._running_thumbnail_jobs += 1
+        try:
+            yield f(*args)
+        except Exception:
+            logger.exception("Failed to generate thumbnails for %r", key)
+        finally:
+            self._running_thumbnail_jobs -= 1
+            self._thumbnail_jobs.pop(key, None)
+
+        with PreserveLoggingContext():
+            deferred.callback(None)
+
+        self._start_thumbnail_jobs()
+
+    def wait_for_thumbnails(self, server_name, media_id):
+        """Waits for any pending thumbnails of the media to be generated. If
+        they are still queued then they are generated straight away.
+
+        Args:
+            server_name (str|None): The origin of the media, or None if local.
+            media_id (str)
+
+        Returns:
+            Deferred
+        """
+        key = (server_name, media_id)
+
+        job = self._queued_thumbnail_jobs.pop(key, None)
+        if job:
+            # Someone wants the thumbnails now, so don't make them wait for
+            # the rest of the queue.
+            preserve_fn(self._run_thumbnail_job)(key, *job)
+
+        pending = self._thumbnail_jobs.get(key)
+        if pending is None:
+            return defer.succeed(None)
+
+        return preserve_context_over_deferred(pending.observe())
+
+    def generate_missing_thumbnails(self, server_name, media_id, media_info):
+        """Generates the thumbnails of media that has none stored, e.g.
+        because we restarted before its queued thumbnail job ran, or the job
+        failed.
+
+        Args:
+            server_name (str|None): The origin of the media, or None if local.
+            media_id (str)
+            media_info (dict): The media's row from the local_media_repository
+                or remote_media_cache table.
+
+        Returns:
+            Deferred
+        """
+        if not self._get_thumbnail_requirements(media_info["media_type"]):
+            return defer.succeed(None)
+
+        if (server_name, media_id) not in self._thumbnail_jobs:
+            if server_name is None:
+                self._queue_thumbnail_job(
+                    None, media_id,
+                    self._generate_local_thumbnails, media_id, media_info
+                )
+            else:
+                self._queue_thumbnail_job(
+                    server_name, media_id,
+                    self._generate_remote_thumbnails,
+                    server_name, media_id, media_info
+                )
+
+        return self.wait_for_thumbnails(server_name, media_id)
+
 
 class MediaRepositoryResource(Resource):
     """File uploading and downloading.
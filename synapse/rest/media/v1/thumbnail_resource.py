@@ -89,8 +89,18 @@ class ThumbnailResource(Resource):
         #     yield respond_with_file(request, media_info["media_type"], file_path)
         #     return
 
+        yield self.media_repo.wait_for_thumbnails(None, media_id)
+
         thumbnail_infos = yield self.store.get_local_media_thumbnails(media_id)
 
+        if not thumbnail_infos:
+            # The thumbnails may never have been generated, e.g. if we
+            # restarted before the queued job ran, so generate them now.
+            yield self.media_repo.generate_missing_thumbnails(
+                None, media_id, media_info,
+            )
+            thumbnail_infos = yield self.store.get_local_media_thumbnails(media_id)
+
         if thumbnail_infos:
             thumbnail_info = self._select_thumbnail(
                 width, height, method, m_type, thumbnail_infos
@@ -125,6 +135,8 @@ class ThumbnailResource(Resource):
         #     yield respond_with_file(request, media_info["media_type"], file_path)
         #     return
 
+        yield self.media_repo.wait_for_thumbnails(None, media_id)
+
         thumbnail_infos = yield self.store.get_local_media_thumbnails(media_id)
         for info in thumbnail_infos:
             t_w = info["thumbnail_width"] == desired_width
@@ -165,6 +177,8 @@ class ThumbnailResource(Resource):
         #     yield respond_with_file(request, media_info["media_type"], file_path)
         #     return
 
+        yield self.media_repo.wait_for_thumbnails(server_name, media_id)
+
         thumbnail_infos = yield self.store.get_remote_media_thumbnails(
             server_name, media_id,
         )
@@ -213,10 +227,22 @@ class ThumbnailResource(Resource):
         #     yield respond_with_file(request, media_info["media_type"], file_path)
         #     return
 
+        yield self.media_repo.wait_for_thumbnails(server_name, media_id)
+
         thumbnail_infos = yield self.store.get_remote_media_thumbnails(
             server_name, media_id,
         )
 
+        if not thumbnail_infos:
+            # The thumbnails may never have been generated, e.g. if we
+            # restarted before the queued job ran, so generate them now.
+            yield self.media_repo.generate_missing_thumbnails(
+                server_name, media_id, media_info,
+            )
+            thumbnail_infos = yield self.store.get_remote_media_thumbnails(
+                server_name, media_id,
+            )
+
         if thumbnail_infos:
             thumbnail_info = self._select_thumbnail(
                 width, height, method, m_type, thumbnail_infos
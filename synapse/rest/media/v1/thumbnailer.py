@@ -28,6 +28,23 @@ class Thumbnailer(object):
         self.image = Image.open(input_path)
         self.width, self.height = self.image.size
 
+        # Images we have already scaled down. Smaller thumbnails are scaled
+        # from these, rather than from the full size image.
+        self._scaled_images = []
+
+    def draft(self, width, height):
+        """Tells the decoder that we only need an image at least as large as
+        the given dimensions. For JPEGs this lets the image be downscaled
+        while it is decoded, which is much cheaper than decoding it at full
+        size. This must be called before any thumbnails are generated.
+
+        Args:
+            width: The smallest width we need.
+            height: The smallest height we need.
+        """
+        if self.image.format == "JPEG":
+            self.image.draft(self.image.mode, (width, height))
+
     def aspect(self, max_width, max_height):
         """Calculate the largest size that preserves aspect ratio which
         fits within the given rectangle::
@@ -48,7 +65,7 @@ class Thumbnailer(object):
 
     def scale(self, output_path, width, height, output_type):
         """Rescales the image to the given dimensions"""
-        scaled = self.image.resize((width, height), Image.ANTIALIAS)
+        scaled = self._resize(width, height)
         return self.save_image(scaled, output_type, output_path)
 
     def crop(self, output_path, width, height, output_type):
@@ -64,22 +81,34 @@ class Thumbnailer(object):
         """
         if width * self.height > height * self.width:
             scaled_height = (width * self.height) // self.width
-            scaled_image = self.image.resize(
-                (width, scaled_height), Image.ANTIALIAS
-            )
+            scaled_image = self._resize(width, scaled_height)
             crop_top = (scaled_height - height) // 2
             crop_bottom = height + crop_top
             cropped = scaled_image.crop((0, crop_top, width, crop_bottom))
         else:
             scaled_width = (height * self.width) // self.height
-            scaled_image = self.image.resize(
-                (scaled_width, height), Image.ANTIALIAS
-            )
+            scaled_image = self._resize(scaled_width, height)
             crop_left = (scaled_width - width) // 2
             crop_right = width + crop_left
             cropped = scaled_image.crop((crop_left, 0, crop_right, height))
         return self.save_image(cropped, output_type, output_path)
 
+    def _resize(self, width, height):
+        """Resizes the image to the given dimensions, starting from the
+        smallest image we have already scaled that is at least that large.
+        """
+        source = self.image
+        for image in self._scaled_images:
+            i_width, i_height = image.size
+            s_width, s_height = source.size
+            if (width <= i_width and height <= i_height
+                    and i_width * i_height < s_width * s_height):
+                source = image
+
+        scaled = source.resize((width, height), Image.ANTIALIAS)
+        self._scaled_images.append(scaled)
+        return scaled
+
     def save_image(self, output_image, output_type, output_path):
         output_bytes_io = BytesIO()
         output_image.save(output_bytes_io, self.FORMATS[output_type], quality=80)
@@ -92,8 +92,12 @@ class UploadResource(Resource):
         #     disposition = headers.getRawHeaders("Content-Disposition")[0]
         # TODO(markjh): parse content-dispostion
 
+        # Twisted will have already buffered large request bodies to a
+        # temporary file, so we pass the file object along to be streamed to
+        # disk rather than reading it all into memory.
+        request.content.seek(0)
         content_uri = yield self.media_repo.create_content(
-            media_type, upload_name, request.content.read(),
+            media_type, upload_name, request.content,
             content_length, requester.user
         )
 
@@ -43,6 +43,7 @@ from synapse.streams.events import EventSources
 from synapse.api.ratelimiting import Ratelimiter
 from synapse.crypto.keyring import Keyring
 from synapse.push.pusherpool import PusherPool
+from synapse.push.action_generator import ActionGenerator
 from synapse.events.builder import EventBuilderFactory
 from synapse.api.filtering import Filtering
 
@@ -113,6 +114,7 @@ class HomeServer(object):
         'filtering',
         'http_client_context_factory',
         'simple_http_client',
+        'action_generator',
     ]
 
     def __init__(self, hostname, **kwargs):
@@ -222,6 +224,9 @@ class HomeServer(object):
     def build_pusherpool(self):
         return PusherPool(self)
 
+    def build_action_generator(self):
+        return ActionGenerator(self)
+
     def build_http_client(self):
         return MatrixFederationHttpClient(self)
 
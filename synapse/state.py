@@ -44,10 +44,15 @@ EVICTION_TIMEOUT_SECONDS = 60 * 60
 
 
 class _StateCacheEntry(object):
-    def __init__(self, state, state_group, ts):
+    def __init__(self, state, state_group, ts, prev_group=None, delta_ids=None):
         self.state = state
         self.state_group = state_group
 
+        # A state group that the resolved state can be stored as a delta
+        # against, if `state_group` is None.
+        self.prev_group = prev_group
+        self.delta_ids = delta_ids
+
 
 class StateHandler(object):
     """ Responsible for doing state conflict resolution.
@@ -149,20 +154,19 @@ class StateHandler(object):
             defer.returnValue(context)
 
         if event.is_state():
-            ret = yield self.resolve_state_groups(
+            ret = yield self._resolve_state_groups(
                 event.room_id, [e for e, _ in event.prev_events],
                 event_type=event.type,
                 state_key=event.state_key,
             )
         else:
-            ret = yield self.resolve_state_groups(
+            ret = yield self._resolve_state_groups(
                 event.room_id, [e for e, _ in event.prev_events],
             )
 
-        group, curr_state, prev_state = ret
+        group, curr_state, prev_state, prev_group, delta_ids = ret
 
         context.current_state = curr_state
-        context.state_group = group if not event.is_state() else None
 
         if event.is_state():
             key = (event.type, event.state_key)
@@ -170,11 +174,26 @@ class StateHandler(object):
                 replaces = context.current_state[key]
                 event.unsigned["replaces_state"] = replaces.event_id
 
+            # The state after a state event always needs a new state group,
+            # which we can store as a delta against the state before it.
+            context.state_group = None
+            if group is not None:
+                context.prev_group = group
+                context.delta_ids = {key: event.event_id}
+            elif prev_group is not None:
+                context.prev_group = prev_group
+                context.delta_ids = dict(delta_ids)
+                context.delta_ids[key] = event.event_id
+        else:
+            context.state_group = group
+            if group is None and prev_group is not None:
+                context.prev_group = prev_group
+                context.delta_ids = dict(delta_ids)
+
         context.prev_state_events = prev_state
         defer.returnValue(context)
 
     @defer.inlineCallbacks
-    @log_function
     def resolve_state_groups(self, room_id, event_ids, event_type=None, state_key=""):
         """ Given a list of event_ids this method fetches the state at each
         event, resolves conflicts between them and returns them.
@@ -185,6 +204,25 @@ class StateHandler(object):
             involved. `state` is a map from (type, state_key) to event, and
             `prev_state` is a list of event ids.
         """
+        ret = yield self._resolve_state_groups(
+            room_id, event_ids, event_type=event_type, state_key=state_key,
+        )
+        defer.returnValue(ret[:3])
+
+    @defer.inlineCallbacks
+    @log_function
+    def _resolve_state_groups(self, room_id, event_ids, event_type=None,
+                              state_key=""):
+        """ As `resolve_state_groups`, but additionally returns a state group
+        that the resolved state can be stored as a delta against.
+
+        Returns:
+            a Deferred tuple of (`state_group`, `state`, `prev_state`,
+            `prev_group`, `delta_ids`). If `state_group` is None then
+            `prev_group` may be an existing state group which, when combined
+            with `delta_ids` (a map from (type, state_key) to event_id), gives
+            `state`.
+        """
         logger.debug("resolve_state_groups event_ids %s", event_ids)
 
         state_groups = yield self.store.get_state_groups(
@@ -210,7 +248,7 @@ class StateHandler(object):
             else:
                 prev_states = []
 
-            defer.returnValue((name, state, prev_states))
+            defer.returnValue((name, state, prev_states, None, None))
 
         if self._state_cache is not None:
             cache = self._state_cache.get(group_names, None)
@@ -226,9 +264,10 @@ class StateHandler(object):
                     prev_states = [prev_state]
                 else:
                     prev_states = []
-                defer.returnValue(
-                    (cache.state_group, state, prev_states)
-                )
+                defer.returnValue((
+                    cache.state_group, state, prev_states,
+                    cache.prev_group, cache.delta_ids,
+                ))
 
         logger.info("Resolving state for %s with %d groups", room_id, len(state_groups))
 
@@ -243,16 +282,41 @@ class StateHandler(object):
                 state_group = sg
                 break
 
+        # If the resolved state doesn't match an existing group, find the
+        # group that it differs least from so that it can be stored as a delta.
+        prev_group = None
+        delta_ids = None
+        if state_group is None:
+            new_state_ids = {
+                key: event.event_id for key, event in new_state.items()
+            }
+            for sg, events in state_groups.items():
+                if any((e.type, e.state_key) not in new_state_ids for e in events):
+                    # State can't be removed by a delta.
+                    continue
+
+                old_state_ids = {(e.type, e.state_key): e.event_id for e in events}
+                n_delta_ids = {
+                    key: event_id
+                    for key, event_id in new_state_ids.items()
+                    if old_state_ids.get(key) != event_id
+                }
+                if delta_ids is None or len(n_delta_ids) < len(delta_ids):
+                    prev_group = sg
+                    delta_ids = n_delta_ids
+
         if self._state_cache is not None:
             cache = _StateCacheEntry(
                 state={key: event.event_id for key, event in new_state.items()},
                 state_group=state_group,
-                ts=self.clock.time_msec()
+                ts=self.clock.time_msec(),
+                prev_group=prev_group,
+                delta_ids=delta_ids,
             )
 
             self._state_cache[group_names] = cache
 
-        defer.returnValue((state_group, new_state, prev_states))
+        defer.returnValue((state_group, new_state, prev_states, prev_group, delta_ids))
 
     def resolve_events(self, state_sets, event):
         logger.info(
@@ -50,6 +50,7 @@ from .client_ips import ClientIpStore
 from .util.id_generators import IdGenerator, StreamIdGenerator, ChainedIdGenerator
 
 from synapse.api.constants import PresenceState
+from synapse.util.caches.room_membership_index import RoomMembershipIndex
 from synapse.util.caches.stream_change_cache import StreamChangeCache
 
 
@@ -105,6 +106,9 @@ class DataStore(RoomMemberStore, RoomStore,
         )
 
         self._transaction_id_gen = IdGenerator(db_conn, "sent_transactions", "id")
+        self._federation_queue_id_gen = IdGenerator(
+            db_conn, "federation_outbound_queue", "stream_id"
+        )
         self._state_groups_id_gen = StreamIdGenerator(db_conn, "state_groups", "id")
         self._access_tokens_id_gen = IdGenerator(db_conn, "access_tokens", "id")
         self._refresh_tokens_id_gen = IdGenerator(db_conn, "refresh_tokens", "id")
@@ -134,6 +138,7 @@ class DataStore(RoomMemberStore, RoomStore,
         self._membership_stream_cache = StreamChangeCache(
             "MembershipStreamChangeCache", events_max,
         )
+        self.room_membership_index = RoomMembershipIndex("RoomMembershipIndex")
 
         account_max = self._account_data_id_gen.get_current_token()
         self._account_data_stream_cache = StreamChangeCache(
@@ -25,6 +25,10 @@ from Queue import PriorityQueue, Empty
 
 logger = logging.getLogger(__name__)
 
+# How many events that couldn't be indexed when they were persisted we add to
+# the auth chain index at a time.
+PENDING_AUTH_CHAINS_BATCH_SIZE = 100
+
 
 class EventFederationStore(SQLBaseStore):
     """ Responsible for storing and serving up the various graphs associated
@@ -36,6 +40,19 @@ class EventFederationStore(SQLBaseStore):
     and backfilling from another server respectively.
     """
 
+    EVENT_AUTH_CHAINS_UPDATE_NAME = "event_auth_chains"
+
+    def __init__(self, hs):
+        super(EventFederationStore, self).__init__(hs)
+        self.register_background_update_handler(
+            self.EVENT_AUTH_CHAINS_UPDATE_NAME,
+            self._background_index_auth_chains,
+        )
+
+        hs.get_clock().looping_call(
+            self._index_pending_auth_chains, 60 * 1000
+        )
+
     def get_auth_chain(self, event_ids):
         return self.get_auth_chain_ids(event_ids).addCallback(self._get_events)
 
@@ -47,6 +64,62 @@ class EventFederationStore(SQLBaseStore):
         )
 
     def _get_auth_chain_ids_txn(self, txn, event_ids):
+        """Returns the ids of all the events in the auth chains of the given
+        events.
+
+        This looks up the events' auth events and then their auth chains in
+        the event_auth_chains index, falling back to walking event_auth for
+        any auth events that haven't been indexed yet.
+        """
+        auth_ids = set()
+        event_ids = list(event_ids)
+        for chunk in _chunks(event_ids, 100):
+            txn.execute(
+                "SELECT auth_id FROM event_auth WHERE event_id IN (%s)" % (
+                    ",".join(["?"] * len(chunk)),
+                ),
+                chunk
+            )
+            auth_ids.update(r[0] for r in txn.fetchall())
+
+        chains = self._get_indexed_auth_chains_txn(txn, auth_ids)
+
+        results = set()
+        for chain in chains.values():
+            results.update(chain)
+
+        unindexed = auth_ids - set(chains)
+        if unindexed:
+            results.update(unindexed)
+            results.update(self._walk_auth_chain_ids_txn(txn, unindexed))
+
+        return list(results)
+
+    def _get_indexed_auth_chains_txn(self, txn, event_ids):
+        """Looks up the auth chains of the given events in the
+        event_auth_chains index.
+
+        Returns:
+            dict: event_id -> set of event ids in its auth chain, including the
+            event itself. Events that haven't been indexed are omitted.
+        """
+        chains = {}
+        event_ids = list(event_ids)
+        for chunk in _chunks(event_ids, 100):
+            txn.execute(
+                "SELECT event_id, auth_id FROM event_auth_chains"
+                " WHERE event_id IN (%s)" % (",".join(["?"] * len(chunk)),),
+                chunk
+            )
+            for event_id, auth_id in txn.fetchall():
+                chains.setdefault(event_id, set()).add(auth_id)
+
+        return chains
+
+    def _walk_auth_chain_ids_txn(self, txn, event_ids):
+        """Finds the auth chains of the given events by walking event_auth a
+        level at a time.
+        """
         results = set()
 
         base_sql = (
@@ -57,11 +130,7 @@ class EventFederationStore(SQLBaseStore):
         while front:
             new_front = set()
             front_list = list(front)
-            chunks = [
-                front_list[x:x + 100]
-                for x in xrange(0, len(front), 100)
-            ]
-            for chunk in chunks:
+            for chunk in _chunks(front_list, 100):
                 txn.execute(
                     base_sql % (",".join(["?"] * len(chunk)),),
                     chunk
@@ -73,7 +142,215 @@ class EventFederationStore(SQLBaseStore):
             front = new_front
             results.update(front)
 
-        return list(results)
+        return results
+
+    def _add_to_auth_chain_index_txn(self, txn, events, walk=False):
+        """Adds events to the event_auth_chains index, which maps each state
+        event to every event in its auth chain (including itself).
+
+        Only state events need indexing, since only state events can be auth
+        events.
+
+        Args:
+            txn
+            events (list): list of (event_id, auth_ids) for the events to
+                index. It is cheaper if events come after any of their auth
+                events that are also in the list. Events that are already
+                indexed are skipped.
+            walk (bool): Whether to work out the auth chains of any auth
+                events that haven't been indexed by walking event_auth.
+                Otherwise events with such auth events are added to
+                event_auth_chains_pending, to be indexed in the background,
+                so that persisting events never has to walk auth chains.
+        """
+        if not events:
+            return
+
+        event_ids = set(event_id for event_id, _ in events)
+        needed = set(
+            auth_id
+            for _, auth_ids in events
+            for auth_id in auth_ids
+        )
+        needed.update(event_ids)
+
+        chains = self._get_indexed_auth_chains_txn(txn, needed)
+        already_indexed = set(e_id for e_id in event_ids if e_id in chains)
+
+        rows = []
+        pending = []
+        for event_id, auth_ids in events:
+            if event_id in already_indexed:
+                continue
+
+            chain = set([event_id])
+            for auth_id in auth_ids:
+                auth_chain = chains.get(auth_id)
+                if auth_chain is None:
+                    if not walk:
+                        pending.append(event_id)
+                        chain = None
+                        break
+
+                    # The auth event hasn't been indexed (yet), so work out
+                    # its auth chain the slow way.
+                    auth_chain = set([auth_id])
+                    auth_chain.update(
+                        self._walk_auth_chain_ids_txn(txn, [auth_id])
+                    )
+                    if not self._have_all_events_txn(txn, auth_chain):
+                        # We're missing some of the auth chain, so we don't
+                        # index the event: looking up its auth chain will
+                        # fall back to walking event_auth instead.
+                        chain = None
+                        break
+                    chains[auth_id] = auth_chain
+                chain.update(auth_chain)
+
+            if chain is None:
+                continue
+
+            chains[event_id] = chain
+            rows.extend(
+                {"event_id": event_id, "auth_id": auth_id}
+                for auth_id in chain
+            )
+
+        self._simple_insert_many_txn(
+            txn,
+            table="event_auth_chains",
+            values=rows,
+        )
+
+        self._simple_insert_many_txn(
+            txn,
+            table="event_auth_chains_pending",
+            values=[{"event_id": event_id} for event_id in pending],
+        )
+
+    def _index_auth_chains_for_events_txn(self, txn, event_ids):
+        """Looks up the auth events of the given events and adds them to the
+        event_auth_chains index, walking event_auth where needed.
+        """
+        auth_ids_by_event = {}
+        for chunk in _chunks(event_ids, 100):
+            txn.execute(
+                "SELECT event_id, auth_id FROM event_auth"
+                " WHERE event_id IN (%s)" % (",".join(["?"] * len(chunk)),),
+                chunk
+            )
+            for event_id, auth_id in txn.fetchall():
+                auth_ids_by_event.setdefault(event_id, []).append(auth_id)
+
+        self._add_to_auth_chain_index_txn(txn, [
+            (event_id, auth_ids_by_event.get(event_id, []))
+            for event_id in event_ids
+        ], walk=True)
+
+    @defer.inlineCallbacks
+    def _index_pending_auth_chains(self):
+        """Indexes the events that couldn't be indexed when they were
+        persisted, because some of their auth events weren't indexed.
+
+        Events whose auth chains turn out to be incomplete are dropped from
+        the queue without being indexed, so that we only walk them once.
+        Looking up their auth chains falls back to walking event_auth.
+        """
+        def index_pending_txn(txn):
+            txn.execute(
+                "SELECT p.event_id FROM event_auth_chains_pending AS p"
+                " INNER JOIN events AS e USING (event_id)"
+                " ORDER BY e.stream_ordering ASC"
+                " LIMIT ?",
+                (PENDING_AUTH_CHAINS_BATCH_SIZE,)
+            )
+            event_ids = [r[0] for r in txn.fetchall()]
+            if not event_ids:
+                return 0
+
+            self._index_auth_chains_for_events_txn(txn, event_ids)
+
+            for chunk in _chunks(event_ids, 100):
+                txn.execute(
+                    "DELETE FROM event_auth_chains_pending"
+                    " WHERE event_id IN (%s)" % (",".join(["?"] * len(chunk)),),
+                    chunk
+                )
+
+            return len(event_ids)
+
+        try:
+            while True:
+                count = yield self.runInteraction(
+                    "_index_pending_auth_chains", index_pending_txn
+                )
+                if count < PENDING_AUTH_CHAINS_BATCH_SIZE:
+                    break
+        except:
+            logger.exception("Failed to index pending auth chains")
+
+    def _have_all_events_txn(self, txn, event_ids):
+        """Checks whether we have persisted all of the given events"""
+        event_ids = list(event_ids)
+        found = 0
+        for chunk in _chunks(event_ids, 100):
+            txn.execute(
+                "SELECT count(*) FROM events WHERE event_id IN (%s)" % (
+                    ",".join(["?"] * len(chunk)),
+                ),
+                chunk
+            )
+            found += txn.fetchone()[0]
+        return found == len(event_ids)
+
+    @defer.inlineCallbacks
+    def _background_index_auth_chains(self, progress, batch_size):
+        """Adds the state events that were persisted before the
+        event_auth_chains index existed to it, oldest first so that auth
+        events are generally indexed before the events that refer to them.
+        """
+        min_stream_id = progress["min_stream_id_inclusive"]
+        max_stream_id = progress["max_stream_id_exclusive"]
+        rows_inserted = progress.get("rows_inserted", 0)
+
+        def index_auth_chains_txn(txn):
+            txn.execute(
+                "SELECT e.stream_ordering, e.event_id FROM events AS e"
+                " INNER JOIN state_events USING (event_id)"
+                " WHERE ? <= e.stream_ordering AND e.stream_ordering < ?"
+                " ORDER BY e.stream_ordering ASC"
+                " LIMIT ?",
+                (min_stream_id, max_stream_id, batch_size)
+            )
+
+            rows = txn.fetchall()
+            if not rows:
+                return 0
+
+            event_ids = [row[1] for row in rows]
+
+            self._index_auth_chains_for_events_txn(txn, event_ids)
+
+            progress = {
+                "min_stream_id_inclusive": rows[-1][0] + 1,
+                "max_stream_id_exclusive": max_stream_id,
+                "rows_inserted": rows_inserted + len(rows),
+            }
+
+            self._background_update_progress_txn(
+                txn, self.EVENT_AUTH_CHAINS_UPDATE_NAME, progress
+            )
+
+            return len(rows)
+
+        result = yield self.runInteraction(
+            self.EVENT_AUTH_CHAINS_UPDATE_NAME, index_auth_chains_txn
+        )
+
+        if not result:
+            yield self._end_background_update(self.EVENT_AUTH_CHAINS_UPDATE_NAME)
+
+        defer.returnValue(result)
 
     def get_oldest_events_in_room(self, room_id):
         return self.runInteraction(
@@ -446,3 +723,8 @@ class EventFederationStore(SQLBaseStore):
 
         txn.execute(query, (room_id,))
         txn.call_after(self.get_latest_event_ids_in_room.invalidate, (room_id,))
+
+
+def _chunks(l, n):
+    """Splits the list into lists of at most n items"""
+    return [l[x:x + n] for x in xrange(0, len(l), n)]
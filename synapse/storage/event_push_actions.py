@@ -54,11 +54,43 @@ class EventPushActionsStore(SQLBaseStore):
             )
         self._simple_insert_many_txn(txn, "event_push_actions", values)
 
+        # Bump the users' unread counts, if the event is after the read
+        # receipt the counts are for.
+        sql = (
+            "UPDATE event_push_summary"
+            " SET notif_count = notif_count + 1,"
+            " highlight_count = highlight_count + ?"
+            " WHERE user_id = ? AND room_id = ?"
+            " AND ("
+            "       topological_ordering < ?"
+            "       OR (topological_ordering = ? AND stream_ordering < ?)"
+            ")"
+        )
+        txn.executemany(sql, [
+            (
+                value["highlight"], value["user_id"], event.room_id,
+                event.depth, event.depth,
+                event.internal_metadata.stream_ordering,
+            )
+            for value in values
+        ])
+
     @cachedInlineCallbacks(num_args=3, lru=True, tree=True, max_entries=5000)
     def get_unread_event_push_actions_by_room_for_user(
             self, room_id, user_id, last_read_event_id
     ):
         def _get_unread_event_push_actions_by_room(txn):
+            sql = (
+                "SELECT notif_count, highlight_count FROM event_push_summary"
+                " WHERE user_id = ? AND room_id = ? AND last_read_event_id = ?"
+            )
+            txn.execute(sql, (user_id, room_id, last_read_event_id))
+            row = txn.fetchone()
+            if row:
+                return {"notify_count": row[0], "highlight_count": row[1]}
+
+            # We don't have counts for this receipt, so fall back to counting
+            # the push actions.
             sql = (
                 "SELECT stream_ordering, topological_ordering"
                 " FROM events"
@@ -74,29 +106,13 @@ class EventPushActionsStore(SQLBaseStore):
             stream_ordering = results[0][0]
             topological_ordering = results[0][1]
 
-            sql = (
-                "SELECT sum(notif), sum(highlight)"
-                " FROM event_push_actions ea"
-                " WHERE"
-                " user_id = ?"
-                " AND room_id = ?"
-                " AND ("
-                "       topological_ordering > ?"
-                "       OR (topological_ordering = ? AND stream_ordering > ?)"
-                ")"
+            notify_count, highlight_count = self._count_push_actions_after_txn(
+                txn, room_id, user_id, topological_ordering, stream_ordering,
             )
-            txn.execute(sql, (
-                user_id, room_id,
-                topological_ordering, topological_ordering, stream_ordering
-            ))
-            row = txn.fetchone()
-            if row:
-                return {
-                    "notify_count": row[0] or 0,
-                    "highlight_count": row[1] or 0,
-                }
-            else:
-                return {"notify_count": 0, "highlight_count": 0}
+            return {
+                "notify_count": notify_count,
+                "highlight_count": highlight_count,
+            }
 
         ret = yield self.runInteraction(
             "get_unread_event_push_actions_by_room",
@@ -104,6 +120,96 @@ class EventPushActionsStore(SQLBaseStore):
         )
         defer.returnValue(ret)
 
+    def _count_push_actions_after_txn(self, txn, room_id, user_id,
+                                      topological_ordering, stream_ordering):
+        """Counts the user's notifications and highlights in the room after
+        the given position.
+
+        Returns:
+            tuple(int, int): The notification and highlight counts.
+        """
+        sql = (
+            "SELECT sum(notif), sum(highlight)"
+            " FROM event_push_actions ea"
+            " WHERE"
+            " user_id = ?"
+            " AND room_id = ?"
+            " AND ("
+            "       topological_ordering > ?"
+            "       OR (topological_ordering = ? AND stream_ordering > ?)"
+            ")"
+        )
+        txn.execute(sql, (
+            user_id, room_id,
+            topological_ordering, topological_ordering, stream_ordering
+        ))
+        row = txn.fetchone()
+        if row:
+            return row[0] or 0, row[1] or 0
+        else:
+            return 0, 0
+
+    def _update_push_summary_for_receipt_txn(self, txn, room_id, user_id,
+                                             event_id, topological_ordering,
+                                             stream_ordering):
+        """Resets the user's unread counts for the room to those after their
+        new read receipt.
+
+        Push actions being persisted concurrently must either be included in
+        the count, or bump the count after we've written it. So we move the
+        summary row to the new receipt *before* counting: this takes a lock
+        on the row, which the bump in `_set_push_actions_for_event_and_users_txn`
+        has to wait for, and once it has it rechecks the event against the
+        new receipt. Anything that committed before we took the lock is
+        included in the count.
+        """
+        txn.execute(
+            "UPDATE event_push_summary"
+            " SET last_read_event_id = ?, topological_ordering = ?,"
+            " stream_ordering = ?"
+            " WHERE user_id = ? AND room_id = ?",
+            (event_id, topological_ordering, stream_ordering, user_id, room_id)
+        )
+
+        if txn.rowcount == 0:
+            # There is no row to lock yet, so we have to lock the table
+            # instead. This only happens for the user's first receipt in the
+            # room.
+            self.database_engine.lock_table(txn, "event_push_summary")
+
+            notif_count, highlight_count = self._count_push_actions_after_txn(
+                txn, room_id, user_id, topological_ordering, stream_ordering,
+            )
+
+            self._simple_upsert_txn(
+                txn,
+                table="event_push_summary",
+                keyvalues={
+                    "user_id": user_id,
+                    "room_id": room_id,
+                },
+                values={
+                    "last_read_event_id": event_id,
+                    "topological_ordering": topological_ordering,
+                    "stream_ordering": stream_ordering,
+                    "notif_count": notif_count,
+                    "highlight_count": highlight_count,
+                },
+                lock=False,
+            )
+            return
+
+        notif_count, highlight_count = self._count_push_actions_after_txn(
+            txn, room_id, user_id, topological_ordering, stream_ordering,
+        )
+
+        txn.execute(
+            "UPDATE event_push_summary"
+            " SET notif_count = ?, highlight_count = ?"
+            " WHERE user_id = ? AND room_id = ?",
+            (notif_count, highlight_count, user_id, room_id)
+        )
+
     @defer.inlineCallbacks
     def get_push_action_users_in_range(self, min_stream_ordering, max_stream_ordering):
         def f(txn):
@@ -225,6 +331,19 @@ class EventPushActionsStore(SQLBaseStore):
             self.get_unread_event_push_actions_by_room_for_user.invalidate_many,
             (room_id,)
         )
+
+        # The unread counts of the users notified about the event are now
+        # wrong, so we throw them away and count from the push actions until
+        # their next read receipt.
+        txn.execute(
+            "DELETE FROM event_push_summary"
+            " WHERE room_id = ? AND user_id IN ("
+            "   SELECT user_id FROM event_push_actions"
+            "   WHERE room_id = ? AND event_id = ?"
+            " )",
+            (room_id, room_id, event_id)
+        )
+
         txn.execute(
             "DELETE FROM event_push_actions WHERE room_id = ? AND event_id = ?",
             (room_id, event_id)
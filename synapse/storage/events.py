@@ -22,7 +22,7 @@ from synapse.events.utils import prune_event
 from synapse.util.async import ObservableDeferred
 from synapse.util.logcontext import preserve_fn, PreserveLoggingContext
 from synapse.util.logutils import log_function
-from synapse.api.constants import EventTypes
+from synapse.api.constants import EventTypes, Membership
 
 from canonicaljson import encode_canonical_json
 from collections import deque, namedtuple
@@ -148,6 +148,11 @@ class _EventPeristenceQueue(object):
 
 _EventCacheEntry = namedtuple("_EventCacheEntry", ("event", "redacted_event"))
 
+# An event decoded by the event fetch threads, see _decode_event_rows
+_DecodedEvent = namedtuple(
+    "_DecodedEvent", ("event", "redacted_event", "redaction_id")
+)
+
 
 class EventsStore(SQLBaseStore):
     EVENT_ORIGIN_SERVER_TS_NAME = "event_origin_server_ts"
@@ -356,6 +361,7 @@ class EventsStore(SQLBaseStore):
             txn.call_after(self.get_users_in_room.invalidate, (event.room_id,))
             txn.call_after(self.get_joined_hosts_for_room.invalidate, (event.room_id,))
             txn.call_after(self.get_room_name_and_aliases.invalidate, (event.room_id,))
+            txn.call_after(self.room_membership_index.invalidate_room, event.room_id)
 
             # Add an entry to the current_state_resets table to record the point
             # where we clobbered the current state
@@ -600,6 +606,15 @@ class EventsStore(SQLBaseStore):
             ],
         )
 
+        self._add_to_auth_chain_index_txn(
+            txn,
+            [
+                (event.event_id, [auth_id for auth_id, _ in event.auth_events])
+                for event, _ in events_and_contexts
+                if event.is_state()
+            ],
+        )
+
         self._store_event_reference_hashes_txn(
             txn, [event for event, _ in events_and_contexts]
         )
@@ -651,7 +666,7 @@ class EventsStore(SQLBaseStore):
             # to update the current state table
             return
 
-        for event, _ in state_events_and_contexts:
+        for event, context in state_events_and_contexts:
             if event.internal_metadata.is_outlier():
                 # Outlier events shouldn't clobber the current state.
                 continue
@@ -666,6 +681,13 @@ class EventsStore(SQLBaseStore):
                 (event.room_id, event.type, event.state_key,)
             )
 
+            if event.type == EventTypes.Member:
+                txn.call_after(
+                    self.room_membership_index.membership_changed,
+                    event.room_id, event.state_key,
+                    event.membership == Membership.JOIN,
+                )
+
             if event.type in [EventTypes.Name, EventTypes.Aliases]:
                 txn.call_after(
                     self.get_room_name_and_aliases.invalidate,
@@ -885,10 +907,9 @@ class EventsStore(SQLBaseStore):
                     conn, "do_fetch", [], None, self._fetch_event_rows, event_ids
                 )
 
-                row_dict = {
-                    r["event_id"]: r
-                    for r in rows
-                }
+                # Decode the events here rather than on the main thread, so
+                # that loading lots of events doesn't block the reactor.
+                decoded = self._decode_event_rows(rows)
 
                 # We only want to resolve deferreds from the main thread
                 def fire(lst, res):
@@ -896,15 +917,22 @@ class EventsStore(SQLBaseStore):
                         if not d.called:
                             try:
                                 with PreserveLoggingContext():
-                                    d.callback([
-                                        res[i]
-                                        for i in ids
-                                        if i in res
-                                    ])
+                                    failures = [
+                                        res[i] for i in ids
+                                        if isinstance(res.get(i), Exception)
+                                    ]
+                                    if failures:
+                                        d.errback(failures[0])
+                                    else:
+                                        d.callback([
+                                            res[i]
+                                            for i in ids
+                                            if i in res
+                                        ])
                             except:
                                 logger.exception("Failed to callback")
                 with PreserveLoggingContext():
-                    reactor.callFromThread(fire, event_list, row_dict)
+                    reactor.callFromThread(fire, event_list, decoded)
             except Exception as e:
                 logger.exception("do_fetch")
 
@@ -949,26 +977,34 @@ class EventsStore(SQLBaseStore):
                 )
 
         with PreserveLoggingContext():
-            rows = yield events_d
+            decoded_events = yield events_d
 
         if not allow_rejected:
-            rows[:] = [r for r in rows if not r["rejects"]]
+            decoded_events = [
+                d for d in decoded_events if not d.event.rejected_reason
+            ]
+
+        res = {}
+        redacted = []
+        for decoded in decoded_events:
+            if decoded.redacted_event:
+                redacted.append(decoded)
+            else:
+                res[decoded.event.event_id] = self._get_event_cache_entry(decoded)
 
-        res = yield defer.gatherResults(
-            [
-                preserve_fn(self._get_event_from_row)(
-                    row["internal_metadata"], row["json"], row["redacts"],
-                    rejected_reason=row["rejects"],
-                )
-                for row in rows
-            ],
-            consumeErrors=True
-        )
+        if redacted:
+            # Redacted events need the redaction event fetching, so these have
+            # to be done separately.
+            entries = yield defer.gatherResults(
+                [
+                    preserve_fn(self._get_redacted_event_cache_entry)(decoded)
+                    for decoded in redacted
+                ],
+                consumeErrors=True
+            )
+            res.update((e.event.event_id, e) for e in entries)
 
-        defer.returnValue({
-            e.event.event_id: e
-            for e in res if e
-        })
+        defer.returnValue(res)
 
     def _fetch_event_rows(self, txn, events):
         rows = []
@@ -983,8 +1019,9 @@ class EventsStore(SQLBaseStore):
                 " e.event_id as event_id, "
                 " e.internal_metadata,"
                 " e.json,"
-                " r.redacts as redacts,"
-                " rej.event_id as rejects "
+                " r.event_id as redaction_id,"
+                " rej.event_id as rejects,"
+                " rej.reason as rejected_reason"
                 " FROM event_json as e"
                 " LEFT JOIN rejections as rej USING (event_id)"
                 " LEFT JOIN redactions as r ON e.event_id = r.redacts"
@@ -996,59 +1033,68 @@ class EventsStore(SQLBaseStore):
 
         return rows
 
-    @defer.inlineCallbacks
-    def _get_event_from_row(self, internal_metadata, js, redacted,
-                            rejected_reason=None):
-        d = json.loads(js)
-        internal_metadata = json.loads(internal_metadata)
-
-        if rejected_reason:
-            rejected_reason = yield self._simple_select_one_onecol(
-                table="rejections",
-                keyvalues={"event_id": rejected_reason},
-                retcol="reason",
-                desc="_get_event_from_row_rejected_reason",
-            )
+    def _decode_event_rows(self, rows):
+        """Turns rows from _fetch_event_rows into events. This is called on
+        the event fetch threads.
 
-        original_ev = FrozenEvent(
-            d,
-            internal_metadata_dict=internal_metadata,
-            rejected_reason=rejected_reason,
-        )
+        Returns:
+            dict: event_id -> _DecodedEvent, or the exception raised while
+            decoding the event.
+        """
+        res = {}
+        for row in rows:
+            event_id = row["event_id"]
+            try:
+                rejected_reason = None
+                if row["rejects"]:
+                    rejected_reason = row["rejected_reason"]
+
+                original_ev = FrozenEvent(
+                    json.loads(row["json"]),
+                    internal_metadata_dict=json.loads(row["internal_metadata"]),
+                    rejected_reason=rejected_reason,
+                )
 
-        redacted_event = None
-        if redacted:
-            redacted_event = prune_event(original_ev)
+                redacted_event = None
+                redaction_id = row["redaction_id"]
+                if redaction_id:
+                    redacted_event = prune_event(original_ev)
+                    redacted_event.unsigned["redacted_by"] = redaction_id
 
-            redaction_id = yield self._simple_select_one_onecol(
-                table="redactions",
-                keyvalues={"redacts": redacted_event.event_id},
-                retcol="event_id",
-                desc="_get_event_from_row_redactions",
-            )
+                res[event_id] = _DecodedEvent(
+                    original_ev, redacted_event, redaction_id,
+                )
+            except Exception as e:
+                logger.exception("Failed to decode event %s", event_id)
+                res[event_id] = e
 
-            redacted_event.unsigned["redacted_by"] = redaction_id
-            # Get the redaction event.
+        return res
 
-            because = yield self.get_event(
-                redaction_id,
-                check_redacted=False,
-                allow_none=True,
-            )
+    def _get_event_cache_entry(self, decoded):
+        cache_entry = _EventCacheEntry(
+            event=decoded.event,
+            redacted_event=decoded.redacted_event,
+        )
 
-            if because:
-                # It's fine to do add the event directly, since get_pdu_json
-                # will serialise this field correctly
-                redacted_event.unsigned["redacted_because"] = because
+        self._get_event_cache.prefill((decoded.event.event_id,), cache_entry)
 
-        cache_entry = _EventCacheEntry(
-            event=original_ev,
-            redacted_event=redacted_event,
+        return cache_entry
+
+    @defer.inlineCallbacks
+    def _get_redacted_event_cache_entry(self, decoded):
+        # Get the redaction event.
+        because = yield self.get_event(
+            decoded.redaction_id,
+            check_redacted=False,
+            allow_none=True,
         )
 
-        self._get_event_cache.prefill((original_ev.event_id,), cache_entry)
+        if because:
+            # It's fine to do add the event directly, since get_pdu_json
+            # will serialise this field correctly
+            decoded.redacted_event.unsigned["redacted_because"] = because
 
-        defer.returnValue(cache_entry)
+        defer.returnValue(self._get_event_cache_entry(decoded))
 
     @defer.inlineCallbacks
     def count_daily_messages(self):
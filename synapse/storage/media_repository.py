@@ -157,10 +157,109 @@ class MediaRepositoryStore(SQLBaseStore):
                 "created_ts": time_now_ms,
                 "upload_name": upload_name,
                 "filesystem_id": filesystem_id,
+                "last_access_ts": time_now_ms,
             },
             desc="store_cached_remote_media",
         )
 
+    def update_cached_last_access_time(self, origin_media_ids, time_ts):
+        """Marks the given remote media as having been accessed.
+
+        Args:
+            origin_media_ids (iterable): (media_origin, media_id) tuples
+            time_ts (int): The time they were last accessed, in ms
+        """
+        def update_cache_txn(txn):
+            sql = (
+                "UPDATE remote_media_cache SET last_access_ts = ?"
+                " WHERE media_origin = ? AND media_id = ?"
+            )
+
+            txn.executemany(sql, (
+                (time_ts, media_origin, media_id)
+                for media_origin, media_id in origin_media_ids
+            ))
+
+        return self.runInteraction(
+            "update_cached_last_access_time", update_cache_txn
+        )
+
+    def get_remote_media_cache_size(self):
+        """Get the number of bytes used by cached remote media and their
+        thumbnails.
+
+        Returns:
+            Deferred[int]
+        """
+        def get_remote_media_cache_size_txn(txn):
+            txn.execute(
+                "SELECT COALESCE(SUM(media_length), 0) FROM remote_media_cache"
+            )
+            media_size, = txn.fetchone()
+
+            txn.execute(
+                "SELECT COALESCE(SUM(thumbnail_length), 0)"
+                " FROM remote_media_cache_thumbnails"
+            )
+            thumbnails_size, = txn.fetchone()
+
+            return media_size + thumbnails_size
+
+        return self.runInteraction(
+            "get_remote_media_cache_size", get_remote_media_cache_size_txn
+        )
+
+    def get_least_recently_used_remote_media(self, limit):
+        """Get the least recently accessed remote media, along with the number
+        of bytes used by each (including their thumbnails).
+
+        Args:
+            limit (int): The maximum number of rows to return
+
+        Returns:
+            Deferred[list[dict]]: With keys "media_origin", "media_id",
+            "filesystem_id" and "size", least recently used first.
+        """
+        def get_least_recently_used_remote_media_txn(txn):
+            sql = (
+                "SELECT media_origin, media_id, filesystem_id,"
+                " COALESCE(media_length, 0) + COALESCE(("
+                "   SELECT SUM(thumbnail_length)"
+                "   FROM remote_media_cache_thumbnails AS t"
+                "   WHERE t.media_origin = r.media_origin"
+                "   AND t.media_id = r.media_id"
+                " ), 0) AS size"
+                " FROM remote_media_cache AS r"
+                " ORDER BY last_access_ts ASC"
+                " LIMIT ?"
+            )
+            txn.execute(sql, (limit,))
+            return self.cursor_to_dict(txn)
+
+        return self.runInteraction(
+            "get_least_recently_used_remote_media",
+            get_least_recently_used_remote_media_txn,
+        )
+
+    def delete_remote_media(self, media_origin, media_id):
+        """Removes a remote media, and its thumbnails, from the cache."""
+        def delete_remote_media_txn(txn):
+            self._simple_delete_txn(
+                txn,
+                "remote_media_cache",
+                keyvalues={
+                    "media_origin": media_origin, "media_id": media_id
+                },
+            )
+            self._simple_delete_txn(
+                txn,
+                "remote_media_cache_thumbnails",
+                keyvalues={
+                    "media_origin": media_origin, "media_id": media_id
+                },
+            )
+        return self.runInteraction("delete_remote_media", delete_remote_media_txn)
+
     def get_remote_media_thumbnails(self, origin, media_id):
         return self._simple_select_list(
             "remote_media_cache_thumbnails",
@@ -328,6 +328,16 @@ class ReceiptsStore(SQLBaseStore):
                 topological_ordering=topological_ordering,
             )
 
+            if self.hs.is_mine_id(user_id):
+                self._update_push_summary_for_receipt_txn(
+                    txn,
+                    room_id=room_id,
+                    user_id=user_id,
+                    event_id=event_id,
+                    topological_ordering=topological_ordering,
+                    stream_ordering=stream_ordering,
+                )
+
         return True
 
     @defer.inlineCallbacks
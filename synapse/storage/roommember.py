@@ -277,6 +277,34 @@ class RoomMemberStore(SQLBaseStore):
             user_id, membership_list=[Membership.JOIN],
         )
 
+    @defer.inlineCallbacks
+    def get_joined_room_ids_for_user(self, user_id):
+        """Returns the frozenset of room_ids the user is joined to, using the
+        in-memory room membership index where possible.
+        """
+        room_ids = self.room_membership_index.get_rooms_for_user(user_id)
+        if room_ids is None:
+            sequence = self.room_membership_index.sequence
+            rooms = yield self.get_rooms_for_user(user_id)
+            room_ids = self.room_membership_index.prefill_rooms_for_user(
+                sequence, user_id, (r.room_id for r in rooms),
+            )
+        defer.returnValue(room_ids)
+
+    @defer.inlineCallbacks
+    def get_joined_user_ids_for_room(self, room_id):
+        """Returns the frozenset of user_ids joined to the room, using the
+        in-memory room membership index where possible.
+        """
+        user_ids = self.room_membership_index.get_users_in_room(room_id)
+        if user_ids is None:
+            sequence = self.room_membership_index.sequence
+            users = yield self.get_users_in_room(room_id)
+            user_ids = self.room_membership_index.prefill_users_in_room(
+                sequence, room_id, users,
+            )
+        defer.returnValue(user_ids)
+
     @defer.inlineCallbacks
     def forget(self, user_id, room_id):
         """Indicate that user_id wishes to discard history for room_id."""
@@ -0,0 +1,74 @@
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from synapse.storage.prepare_database import get_statements
+
+import logging
+import ujson
+
+logger = logging.getLogger(__name__)
+
+
+CREATE_TABLE = """
+-- Maps each state event to every event in its auth chain, including itself.
+CREATE TABLE event_auth_chains(
+    event_id TEXT NOT NULL,
+    auth_id TEXT NOT NULL
+);
+
+CREATE UNIQUE INDEX event_auth_chains_id ON event_auth_chains(event_id, auth_id);
+
+-- State events that couldn't be indexed when they were persisted because some
+-- of their auth events hadn't been indexed, waiting to be indexed in the
+-- background.
+CREATE TABLE event_auth_chains_pending(
+    event_id TEXT NOT NULL
+);
+
+CREATE UNIQUE INDEX event_auth_chains_pending_id ON event_auth_chains_pending(event_id);
+"""
+
+
+def run_create(cur, database_engine, *args, **kwargs):
+    for statement in get_statements(CREATE_TABLE.splitlines()):
+        cur.execute(statement)
+
+    cur.execute("SELECT MIN(stream_ordering) FROM events")
+    rows = cur.fetchall()
+    min_stream_id = rows[0][0]
+
+    cur.execute("SELECT MAX(stream_ordering) FROM events")
+    rows = cur.fetchall()
+    max_stream_id = rows[0][0]
+
+    if min_stream_id is not None and max_stream_id is not None:
+        progress = {
+            "min_stream_id_inclusive": min_stream_id,
+            "max_stream_id_exclusive": max_stream_id + 1,
+            "rows_inserted": 0,
+        }
+        progress_json = ujson.dumps(progress)
+
+        sql = (
+            "INSERT into background_updates (update_name, progress_json)"
+            " VALUES (?, ?)"
+        )
+
+        sql = database_engine.convert_param_style(sql)
+
+        cur.execute(sql, ("event_auth_chains", progress_json))
+
+
+def run_upgrade(*args, **kwargs):
+    pass
@@ -0,0 +1,31 @@
+/* Copyright 2016 OpenMarket Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+
+-- The number of notifications (and highlights) each local user has in each
+-- room after their read receipt, so that unread counts don't need to be
+-- counted from event_push_actions on every sync. A row is only valid for the
+-- read receipt it was calculated for, whose position is stored alongside.
+CREATE TABLE event_push_summary (
+    user_id TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    last_read_event_id TEXT NOT NULL,
+    topological_ordering BIGINT NOT NULL,
+    stream_ordering BIGINT NOT NULL,
+    notif_count BIGINT NOT NULL,
+    highlight_count BIGINT NOT NULL
+);
+
+CREATE UNIQUE INDEX event_push_summary_user_rm ON event_push_summary(user_id, room_id);
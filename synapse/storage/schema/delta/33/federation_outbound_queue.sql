@@ -0,0 +1,36 @@
+/* Copyright 2016 OpenMarket Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+
+
+-- PDUs and EDUs waiting to be sent to remote servers. Each row is either a PDU,
+-- in which case event_id is set, or an EDU. Rows are deleted once they have
+-- been sent, and are sent to each destination in stream_id order. Rows that
+-- have been queued for too long are dropped, so the queue of a server that
+-- has gone away doesn't grow forever.
+CREATE TABLE federation_outbound_queue (
+    stream_id BIGINT NOT NULL,
+    destination TEXT NOT NULL,
+    event_id TEXT,
+    edu_type TEXT,
+    edu_content TEXT,
+    queued_ts BIGINT NOT NULL
+);
+
+CREATE UNIQUE INDEX federation_outbound_queue_destination_stream_id
+    ON federation_outbound_queue(destination, stream_id);
+
+CREATE INDEX federation_outbound_queue_queued_ts
+    ON federation_outbound_queue(queued_ts);
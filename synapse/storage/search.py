@@ -18,6 +18,7 @@ from twisted.internet import defer
 from .background_updates import BackgroundUpdateStore
 from synapse.api.errors import SynapseError
 from synapse.storage.engines import PostgresEngine, Sqlite3Engine
+from synapse.util.caches.expiringcache import ExpiringCache
 
 import logging
 import re
@@ -26,6 +27,12 @@ import ujson as json
 
 logger = logging.getLogger(__name__)
 
+# The maximum number of ranked results we fetch (and cache) for a search.
+SEARCH_RESULTS_LIMIT = 500
+
+# The maximum number of room_ids we put in a single query.
+SEARCH_ROOMS_CHUNK_SIZE = 500
+
 
 class SearchStore(BackgroundUpdateStore):
 
@@ -42,6 +49,24 @@ class SearchStore(BackgroundUpdateStore):
             self._background_reindex_search_order
         )
 
+        # (search_query, keys, room_ids) -> (list of (rank, event_id), count)
+        self._search_results_cache = ExpiringCache(
+            cache_name="search_results_cache",
+            clock=self._clock,
+            max_len=1000,
+            expiry_ms=5 * 60 * 1000,
+        )
+        self._search_results_cache.start()
+
+        # (search_query, keys, room_ids) -> count
+        self._search_counts_cache = ExpiringCache(
+            cache_name="search_counts_cache",
+            clock=self._clock,
+            max_len=1000,
+            expiry_ms=5 * 60 * 1000,
+        )
+        self._search_counts_cache.start()
+
     @defer.inlineCallbacks
     def _background_reindex_search(self, progress, batch_size):
         target_min_stream_id = progress["target_min_stream_id_inclusive"]
@@ -216,122 +241,198 @@ class SearchStore(BackgroundUpdateStore):
         defer.returnValue(num_rows)
 
     @defer.inlineCallbacks
-    def search_msgs(self, room_ids, search_term, keys):
-        """Performs a full text search over events with given keys.
+    def search_msgs(self, room_ids, search_term, keys, limit, pagination_token=None):
+        """Performs a full text search over events with given keys, ordered by
+        rank.
+
+        The full ranked list of matching event_ids is cached for a short time,
+        so that paginating through the results only needs to slice the cached
+        list rather than re-running the search.
 
         Args:
             room_ids (list): List of room ids to search in
             search_term (str): Search term to search for
             keys (list): List of keys to search in, currently supports
                 "content.body", "content.name", "content.topic"
+            limit (int): The maximum number of results to return
+            pagination_token (str): A pagination token previously returned
 
         Returns:
             list of dicts
         """
-        clauses = []
+        offset = 0
+        if pagination_token:
+            try:
+                offset = int(pagination_token)
+            except:
+                raise SynapseError(400, "Invalid pagination token")
 
-        search_query = search_query = _parse_query(self.database_engine, search_term)
+            if offset < 0:
+                raise SynapseError(400, "Invalid pagination token")
 
-        args = []
+        search_query = _parse_query(self.database_engine, search_term)
 
-        # Make sure we don't explode because the person is in too many rooms.
-        # We filter the results below regardless.
-        if len(room_ids) < 500:
-            clauses.append(
-                "room_id IN (%s)" % (",".join(["?"] * len(room_ids)),)
+        cache_key = (search_query, frozenset(keys), frozenset(room_ids))
+
+        # We only use the cached results when paginating, so that the first
+        # page always includes new events.
+        ranked = None
+        if pagination_token:
+            ranked = self._search_results_cache.get(cache_key)
+
+        if ranked is None:
+            ranked = yield self.runInteraction(
+                "search_msgs", self._search_msgs_txn,
+                search_query, room_ids, keys,
             )
-            args.extend(room_ids)
+            self._search_results_cache[cache_key] = ranked
 
-        local_clauses = []
-        for key in keys:
-            local_clauses.append("key = ?")
-            args.append(key)
+        ranked_rows, count = ranked
 
-        clauses.append(
-            "(%s)" % (" OR ".join(local_clauses),)
-        )
+        if count is None:
+            count = yield self._get_search_count(
+                search_query, room_ids, keys, use_cache=bool(pagination_token),
+            )
 
-        count_args = args
-        count_clauses = clauses
+        rows = ranked_rows[offset:offset + limit]
 
+        events = yield self._get_events([event_id for _, event_id in rows])
+
+        event_map = {
+            ev.event_id: ev
+            for ev in events
+        }
+
+        highlights = None
+        if isinstance(self.database_engine, PostgresEngine):
+            highlights = yield self._find_highlights_in_postgres(search_query, events)
+
+        defer.returnValue({
+            "results": [
+                {
+                    "event": event_map[event_id],
+                    "rank": rank,
+                    "pagination_token": str(offset + i + 1),
+                }
+                for i, (rank, event_id) in enumerate(rows)
+                if event_id in event_map
+            ],
+            "highlights": highlights,
+            "count": count,
+        })
+
+    def _search_msgs_txn(self, txn, search_query, room_ids, keys):
+        """Fetches the ranked list of events matching the search query.
+
+        The rooms are filtered in the database, in chunks so that we don't
+        explode because the person is in too many rooms.
+
+        Returns:
+            tuple(list, int|None): The list of (rank, event_id) ordered by rank,
+            and the total number of matching events if it is known (i.e. if the
+            list didn't hit the limit), or None.
+        """
         if isinstance(self.database_engine, PostgresEngine):
             sql = (
                 "SELECT ts_rank_cd(vector, to_tsquery('english', ?)) AS rank,"
-                " room_id, event_id"
+                " event_id"
                 " FROM event_search"
                 " WHERE vector @@ to_tsquery('english', ?)"
             )
-            args = [search_query, search_query] + args
-
-            count_sql = (
-                "SELECT room_id, count(*) as count FROM event_search"
-                " WHERE vector @@ to_tsquery('english', ?)"
-            )
-            count_args = [search_query] + count_args
+            query_args = [search_query, search_query]
         elif isinstance(self.database_engine, Sqlite3Engine):
             sql = (
-                "SELECT rank(matchinfo(event_search)) as rank, room_id, event_id"
+                "SELECT rank(matchinfo(event_search)) as rank, event_id"
                 " FROM event_search"
                 " WHERE value MATCH ?"
             )
-            args = [search_query] + args
-
-            count_sql = (
-                "SELECT room_id, count(*) as count FROM event_search"
-                " WHERE value MATCH ?"
-            )
-            count_args = [search_term] + count_args
+            query_args = [search_query]
         else:
             # This should be unreachable.
             raise Exception("Unrecognized database engine")
 
-        for clause in clauses:
-            sql += " AND " + clause
-
-        for clause in count_clauses:
-            count_sql += " AND " + clause
-
         # We add an arbitrary limit here to ensure we don't try to pull the
         # entire table from the database.
-        sql += " ORDER BY rank DESC LIMIT 500"
+        sql += " AND room_id IN (%s) AND (%s) ORDER BY rank DESC LIMIT ?"
+
+        results = []
+        truncated = False
+        room_ids = list(room_ids)
+        for chunk in _chunk_room_ids(room_ids):
+            txn.execute(
+                sql % (
+                    ",".join(["?"] * len(chunk)),
+                    " OR ".join(["key = ?"] * len(keys)),
+                ),
+                query_args + chunk + list(keys) + [SEARCH_RESULTS_LIMIT],
+            )
+            rows = txn.fetchall()
+            results.extend(rows)
 
-        results = yield self._execute(
-            "search_msgs", self.cursor_to_dict, sql, *args
-        )
+            if len(rows) >= SEARCH_RESULTS_LIMIT:
+                truncated = True
 
-        results = filter(lambda row: row["room_id"] in room_ids, results)
+        results.sort(key=lambda r: (-r[0], r[1]))
 
-        events = yield self._get_events([r["event_id"] for r in results])
+        if truncated:
+            return results[:SEARCH_RESULTS_LIMIT], None
 
-        event_map = {
-            ev.event_id: ev
-            for ev in events
-        }
+        return results, len(results)
+
+    @defer.inlineCallbacks
+    def _get_search_count(self, search_query, room_ids, keys, use_cache):
+        """Counts the number of events matching the search query, caching the
+        result for a short time.
+
+        Args:
+            search_query (str): The query, as returned by `_parse_query`
+            room_ids (list)
+            keys (list)
+            use_cache (bool): Whether a previously cached count may be used.
+
+        Returns:
+            Deferred[int]
+        """
+        cache_key = (search_query, frozenset(keys), frozenset(room_ids))
+
+        if use_cache:
+            count = self._search_counts_cache.get(cache_key)
+            if count is not None:
+                defer.returnValue(count)
 
-        highlights = None
         if isinstance(self.database_engine, PostgresEngine):
-            highlights = yield self._find_highlights_in_postgres(search_query, events)
+            sql = (
+                "SELECT count(*) FROM event_search"
+                " WHERE vector @@ to_tsquery('english', ?)"
+            )
+        elif isinstance(self.database_engine, Sqlite3Engine):
+            sql = (
+                "SELECT count(*) FROM event_search"
+                " WHERE value MATCH ?"
+            )
+        else:
+            # This should be unreachable.
+            raise Exception("Unrecognized database engine")
 
-        count_sql += " GROUP BY room_id"
+        sql += " AND room_id IN (%s) AND (%s)"
 
-        count_results = yield self._execute(
-            "search_rooms_count", self.cursor_to_dict, count_sql, *count_args
-        )
+        def get_search_count_txn(txn):
+            count = 0
+            for chunk in _chunk_room_ids(list(room_ids)):
+                txn.execute(
+                    sql % (
+                        ",".join(["?"] * len(chunk)),
+                        " OR ".join(["key = ?"] * len(keys)),
+                    ),
+                    [search_query] + chunk + list(keys),
+                )
+                count += txn.fetchone()[0]
+            return count
 
-        count = sum(row["count"] for row in count_results if row["room_id"] in room_ids)
+        count = yield self.runInteraction("search_count", get_search_count_txn)
+        self._search_counts_cache[cache_key] = count
 
-        defer.returnValue({
-            "results": [
-                {
-                    "event": event_map[r["event_id"]],
-                    "rank": r["rank"],
-                }
-                for r in results
-                if r["event_id"] in event_map
-            ],
-            "highlights": highlights,
-            "count": count,
-        })
+        defer.returnValue(count)
 
     @defer.inlineCallbacks
     def search_rooms(self, room_ids, search_term, keys, limit, pagination_token=None):
@@ -353,14 +454,6 @@ class SearchStore(BackgroundUpdateStore):
 
         args = []
 
-        # Make sure we don't explode because the person is in too many rooms.
-        # We filter the results below regardless.
-        if len(room_ids) < 500:
-            clauses.append(
-                "room_id IN (%s)" % (",".join(["?"] * len(room_ids)),)
-            )
-            args.extend(room_ids)
-
         local_clauses = []
         for key in keys:
             local_clauses.append("key = ?")
@@ -370,11 +463,6 @@ class SearchStore(BackgroundUpdateStore):
             "(%s)" % (" OR ".join(local_clauses),)
         )
 
-        # take copies of the current args and clauses lists, before adding
-        # pagination clauses to main query.
-        count_args = list(args)
-        count_clauses = list(clauses)
-
         if pagination_token:
             try:
                 origin_server_ts, stream = pagination_token.split(",")
@@ -397,12 +485,6 @@ class SearchStore(BackgroundUpdateStore):
                 " WHERE vector @@ to_tsquery('english', ?) AND "
             )
             args = [search_query, search_query] + args
-
-            count_sql = (
-                "SELECT room_id, count(*) as count FROM event_search"
-                " WHERE vector @@ to_tsquery('english', ?) AND "
-            )
-            count_args = [search_query] + count_args
         elif isinstance(self.database_engine, Sqlite3Engine):
             # We use CROSS JOIN here to ensure we use the right indexes.
             # https://sqlite.org/optoverview.html#crossjoin
@@ -423,18 +505,12 @@ class SearchStore(BackgroundUpdateStore):
                 " WHERE "
             )
             args = [search_query] + args
-
-            count_sql = (
-                "SELECT room_id, count(*) as count FROM event_search"
-                " WHERE value MATCH ? AND "
-            )
-            count_args = [search_term] + count_args
         else:
             # This should be unreachable.
             raise Exception("Unrecognized database engine")
 
         sql += " AND ".join(clauses)
-        count_sql += " AND ".join(count_clauses)
+        sql += " AND room_id IN (%s)"
 
         # We add an arbitrary limit here to ensure we don't try to pull the
         # entire table from the database.
@@ -448,13 +524,25 @@ class SearchStore(BackgroundUpdateStore):
         else:
             raise Exception("Unrecognized database engine")
 
-        args.append(limit)
+        def search_rooms_txn(txn):
+            # The rooms are filtered in chunks so that we don't explode because
+            # the person is in too many rooms. Each chunk is ordered and
+            # limited by the database, so we only need to merge them.
+            results = []
+            for chunk in _chunk_room_ids(list(room_ids)):
+                txn.execute(
+                    sql % (",".join(["?"] * len(chunk)),),
+                    args + chunk + [limit],
+                )
+                results.extend(self.cursor_to_dict(txn))
 
-        results = yield self._execute(
-            "search_rooms", self.cursor_to_dict, sql, *args
-        )
+            results.sort(
+                key=lambda r: (r["origin_server_ts"], r["stream_ordering"]),
+                reverse=True,
+            )
+            return results[:limit]
 
-        results = filter(lambda row: row["room_id"] in room_ids, results)
+        results = yield self.runInteraction("search_rooms", search_rooms_txn)
 
         events = yield self._get_events([r["event_id"] for r in results])
 
@@ -467,14 +555,10 @@ class SearchStore(BackgroundUpdateStore):
         if isinstance(self.database_engine, PostgresEngine):
             highlights = yield self._find_highlights_in_postgres(search_query, events)
 
-        count_sql += " GROUP BY room_id"
-
-        count_results = yield self._execute(
-            "search_rooms_count", self.cursor_to_dict, count_sql, *count_args
+        count = yield self._get_search_count(
+            search_query, room_ids, keys, use_cache=bool(pagination_token),
         )
 
-        count = sum(row["count"] for row in count_results if row["room_id"] in room_ids)
-
         defer.returnValue({
             "results": [
                 {
@@ -556,6 +640,16 @@ class SearchStore(BackgroundUpdateStore):
         return self.runInteraction("_find_highlights", f)
 
 
+def _chunk_room_ids(room_ids):
+    """Splits the room_ids into chunks small enough to be used in an
+    `IN (...)` clause.
+    """
+    return [
+        room_ids[i:i + SEARCH_ROOMS_CHUNK_SIZE]
+        for i in xrange(0, len(room_ids), SEARCH_ROOMS_CHUNK_SIZE)
+    ]
+
+
 def _to_postgres_options(options_dict):
     return "'%s'" % (
         ",".join("%s=%s" % (k, v) for k, v in options_dict.items()),
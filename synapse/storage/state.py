@@ -14,6 +14,7 @@
 # limitations under the License.
 
 from ._base import SQLBaseStore
+from .engines import PostgresEngine
 from synapse.util.caches.descriptors import cached, cachedList
 from synapse.util.caches import intern_string
 
@@ -24,6 +25,12 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# The maximum number of state groups we will walk through when resolving a
+# delta encoded state group. Once a chain gets this long the next state group
+# is stored as a full snapshot again, which bounds the cost of reads.
+MAX_STATE_DELTA_HOPS = 100
+
+
 class StateStore(SQLBaseStore):
     """ Keeps track of the state at a given event.
 
@@ -36,11 +43,19 @@ class StateStore(SQLBaseStore):
     generated. However, if no change happens (e.g., if we get a message event
     with only one parent it inherits the state group from its parent.)
 
-    There are three tables:
+    State groups are stored either as a full snapshot of the state, or as a
+    delta against a previous state group. Deltas are only written while the
+    chain of previous groups is shorter than `MAX_STATE_DELTA_HOPS`.
+
+    There are four tables:
       * `state_groups`: Stores group name, first event with in the group and
         room id.
       * `event_to_state_groups`: Maps events to state groups.
-      * `state_groups_state`: Maps state group to state events.
+      * `state_groups_state`: Maps state group to state events. For delta
+        encoded groups this only contains the state that differs from the
+        previous group.
+      * `state_group_edges`: Maps a delta encoded state group to the state
+        group it is a delta against.
     """
 
     @defer.inlineCallbacks
@@ -77,11 +92,6 @@ class StateStore(SQLBaseStore):
                 state_groups[event.event_id] = context.state_group
                 continue
 
-            state_events = dict(context.current_state)
-
-            if event.is_state():
-                state_events[(event.type, event.state_key)] = event
-
             state_group = context.new_state_group_id
 
             self._simple_insert_txn(
@@ -94,20 +104,61 @@ class StateStore(SQLBaseStore):
                 },
             )
 
-            self._simple_insert_many_txn(
-                txn,
-                table="state_groups_state",
-                values=[
-                    {
+            # We persist as a delta if we can, while also ensuring the chain
+            # of deltas doesn't get too long, as otherwise reads degrade.
+            prev_group = context.prev_group
+            delta_ids = context.delta_ids
+            if prev_group is not None and delta_ids is not None:
+                potential_hops = self._count_state_group_hops_txn(
+                    txn, prev_group
+                )
+                if potential_hops >= MAX_STATE_DELTA_HOPS:
+                    prev_group = None
+
+            if prev_group is not None and delta_ids is not None:
+                self._simple_insert_txn(
+                    txn,
+                    table="state_group_edges",
+                    values={
                         "state_group": state_group,
-                        "room_id": state.room_id,
-                        "type": state.type,
-                        "state_key": state.state_key,
-                        "event_id": state.event_id,
-                    }
-                    for state in state_events.values()
-                ],
-            )
+                        "prev_state_group": prev_group,
+                    },
+                )
+
+                self._simple_insert_many_txn(
+                    txn,
+                    table="state_groups_state",
+                    values=[
+                        {
+                            "state_group": state_group,
+                            "room_id": event.room_id,
+                            "type": etype,
+                            "state_key": state_key,
+                            "event_id": state_id,
+                        }
+                        for (etype, state_key), state_id in delta_ids.items()
+                    ],
+                )
+            else:
+                state_events = dict(context.current_state)
+
+                if event.is_state():
+                    state_events[(event.type, event.state_key)] = event
+
+                self._simple_insert_many_txn(
+                    txn,
+                    table="state_groups_state",
+                    values=[
+                        {
+                            "state_group": state_group,
+                            "room_id": state.room_id,
+                            "type": state.type,
+                            "state_key": state.state_key,
+                            "event_id": state.event_id,
+                        }
+                        for state in state_events.values()
+                    ],
+                )
             state_groups[event.event_id] = state_group
 
         self._simple_insert_many_txn(
@@ -122,6 +173,48 @@ class StateStore(SQLBaseStore):
             ],
         )
 
+    def _count_state_group_hops_txn(self, txn, state_group):
+        """Given a state group, count how many hops there are in the chain of
+        deltas it is stored as.
+
+        This is used to ensure the delta chains don't get too long.
+        """
+        if isinstance(self.database_engine, PostgresEngine):
+            sql = (
+                "WITH RECURSIVE state(state_group) AS ("
+                " VALUES(?::bigint)"
+                " UNION ALL"
+                " SELECT prev_state_group FROM state_group_edges e, state s"
+                " WHERE s.state_group = e.state_group"
+                " )"
+                " SELECT count(*) FROM state"
+            )
+
+            txn.execute(sql, (state_group,))
+            row = txn.fetchone()
+            if row and row[0]:
+                # The count includes the starting state group itself.
+                return row[0] - 1
+            return 0
+        else:
+            # We don't use WITH RECURSIVE on sqlite3 as there are
+            # distributions that ship with a version that doesn't support it.
+            next_group = state_group
+            count = 0
+
+            while next_group is not None and count < MAX_STATE_DELTA_HOPS:
+                next_group = self._simple_select_one_onecol_txn(
+                    txn,
+                    table="state_group_edges",
+                    keyvalues={"state_group": next_group},
+                    retcol="prev_state_group",
+                    allow_none=True,
+                )
+                if next_group is not None:
+                    count += 1
+
+            return count
+
     @defer.inlineCallbacks
     def get_current_state(self, room_id, event_type=None, state_key=""):
         if event_type and state_key is not None:
@@ -184,34 +277,7 @@ class StateStore(SQLBaseStore):
         """Returns dictionary state_group -> (dict of (type, state_key) -> event id)
         """
         def f(txn, groups):
-            if types is not None:
-                where_clause = "AND (%s)" % (
-                    " OR ".join(["(type = ? AND state_key = ?)"] * len(types)),
-                )
-            else:
-                where_clause = ""
-
-            sql = (
-                "SELECT state_group, event_id, type, state_key"
-                " FROM state_groups_state WHERE"
-                " state_group IN (%s) %s" % (
-                    ",".join("?" for _ in groups),
-                    where_clause,
-                )
-            )
-
-            args = list(groups)
-            if types is not None:
-                args.extend([i for typ in types for i in typ])
-
-            txn.execute(sql, args)
-            rows = self.cursor_to_dict(txn)
-
-            results = {group: {} for group in groups}
-            for row in rows:
-                key = (row["type"], row["state_key"])
-                results[row["state_group"]][key] = row["event_id"]
-            return results
+            return self._get_state_groups_from_groups_txn(txn, groups, types)
 
         results = {}
 
@@ -225,6 +291,86 @@ class StateStore(SQLBaseStore):
 
         defer.returnValue(results)
 
+    def _get_state_groups_from_groups_txn(self, txn, groups, types=None):
+        """Fetches the full state of each of the given state groups, resolving
+        any chains of delta encoded state groups.
+
+        Returns:
+            dict of state_group -> (dict of (type, state_key) -> event id)
+        """
+        where_clause = ""
+        where_args = []
+        if types is not None:
+            clauses = []
+            for etype, state_key in types:
+                if state_key is None:
+                    clauses.append("(type = ?)")
+                    where_args.append(etype)
+                else:
+                    clauses.append("(type = ? AND state_key = ?)")
+                    where_args.extend((etype, state_key))
+            where_clause = "AND (%s)" % (" OR ".join(clauses),)
+
+        results = {group: {} for group in groups}
+
+        if isinstance(self.database_engine, PostgresEngine):
+            # Walk the chain of state groups and then pick the entry from the
+            # most recent state group for each (type, state_key). Previous
+            # state groups always have a numerically lower id.
+            sql = (
+                "WITH RECURSIVE state(state_group) AS ("
+                " VALUES(?::bigint)"
+                " UNION ALL"
+                " SELECT prev_state_group FROM state_group_edges e, state s"
+                " WHERE s.state_group = e.state_group"
+                " )"
+                " SELECT DISTINCT ON (type, state_key) type, state_key, event_id"
+                " FROM state_groups_state"
+                " WHERE state_group IN (SELECT state_group FROM state) %s"
+                " ORDER BY type, state_key, state_group DESC"
+            ) % (where_clause,)
+
+            for group in groups:
+                txn.execute(sql, [group] + where_args)
+                results[group] = {
+                    (etype, state_key): event_id
+                    for etype, state_key, event_id in txn
+                }
+        else:
+            # We don't use WITH RECURSIVE on sqlite3 as there are
+            # distributions that ship with a version that doesn't support it.
+            sql = (
+                "SELECT type, state_key, event_id FROM state_groups_state"
+                " WHERE state_group = ? %s"
+            ) % (where_clause,)
+
+            # If every requested type has an explicit state_key then we can
+            # stop walking the chain once we have found all of them.
+            max_entries = None
+            if types is not None and all(k is not None for _, k in types):
+                max_entries = len(set(types))
+
+            for group in groups:
+                state = results[group]
+                next_group = group
+                while next_group is not None:
+                    txn.execute(sql, [next_group] + where_args)
+                    for etype, state_key, event_id in txn.fetchall():
+                        state.setdefault((etype, state_key), event_id)
+
+                    if max_entries is not None and len(state) >= max_entries:
+                        break
+
+                    next_group = self._simple_select_one_onecol_txn(
+                        txn,
+                        table="state_group_edges",
+                        keyvalues={"state_group": next_group},
+                        retcol="prev_state_group",
+                        allow_none=True,
+                    )
+
+        return results
+
     @defer.inlineCallbacks
     def get_state_for_events(self, event_ids, types):
         """Given a list of event_ids and type tuples, return a list of state
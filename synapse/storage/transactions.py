@@ -24,6 +24,7 @@ from collections import namedtuple
 
 import itertools
 import logging
+import ujson as json
 
 logger = logging.getLogger(__name__)
 
@@ -244,6 +245,231 @@ class TransactionStore(SQLBaseStore):
 
         return self.cursor_to_dict(txn)
 
+    def add_pdu_to_federation_queue(self, event_id, destinations):
+        """Persists a PDU that needs to be sent to the given destinations.
+
+        Args:
+            event_id (str): The event to send, which must already be persisted.
+            destinations (list): The servers to send it to.
+
+        Returns:
+            Deferred
+        """
+        stream_id = self._federation_queue_id_gen.get_next()
+        now = self._clock.time_msec()
+
+        return self.runInteraction(
+            "add_pdu_to_federation_queue",
+            self._simple_insert_many_txn,
+            table="federation_outbound_queue",
+            values=[
+                {
+                    "stream_id": stream_id,
+                    "destination": destination,
+                    "event_id": event_id,
+                    "edu_type": None,
+                    "edu_content": None,
+                    "queued_ts": now,
+                }
+                for destination in destinations
+            ],
+        )
+
+    def add_edu_to_federation_queue(self, destination, edu_type, content):
+        """Persists an EDU that needs to be sent to the given destination.
+
+        Args:
+            destination (str)
+            edu_type (str)
+            content (dict)
+
+        Returns:
+            Deferred
+        """
+        stream_id = self._federation_queue_id_gen.get_next()
+
+        return self._simple_insert(
+            table="federation_outbound_queue",
+            values={
+                "stream_id": stream_id,
+                "destination": destination,
+                "event_id": None,
+                "edu_type": edu_type,
+                "edu_content": json.dumps(content),
+                "queued_ts": self._clock.time_msec(),
+            },
+            desc="add_edu_to_federation_queue",
+        )
+
+    def get_federation_queue_for_destination(self, destination, pdu_limit,
+                                             edu_limit):
+        """Gets the oldest PDUs and EDUs queued for the destination.
+
+        Args:
+            destination (str)
+            pdu_limit (int): The maximum number of PDUs to return.
+            edu_limit (int): The maximum number of EDUs to return.
+
+        Returns:
+            Deferred[tuple]: A pair of lists, the first of tuples of
+            (stream_id, event_id) and the second of tuples of
+            (stream_id, edu_type, content), both ordered by stream_id.
+        """
+        def get_federation_queue_for_destination_txn(txn):
+            sql = (
+                "SELECT stream_id, event_id FROM federation_outbound_queue"
+                " WHERE destination = ? AND event_id IS NOT NULL"
+                " ORDER BY stream_id ASC LIMIT ?"
+            )
+            txn.execute(sql, (destination, pdu_limit,))
+            pdu_rows = txn.fetchall()
+
+            sql = (
+                "SELECT stream_id, edu_type, edu_content"
+                " FROM federation_outbound_queue"
+                " WHERE destination = ? AND event_id IS NULL"
+                " ORDER BY stream_id ASC LIMIT ?"
+            )
+            txn.execute(sql, (destination, edu_limit,))
+            edu_rows = [
+                (stream_id, edu_type, json.loads(edu_content))
+                for stream_id, edu_type, edu_content in txn.fetchall()
+            ]
+
+            return pdu_rows, edu_rows
+
+        return self.runInteraction(
+            "get_federation_queue_for_destination",
+            get_federation_queue_for_destination_txn,
+        )
+
+    def remove_from_federation_queue(self, destination, stream_ids):
+        """Removes PDUs and EDUs from the destination's queue once they have
+        been sent.
+
+        Args:
+            destination (str)
+            stream_ids (list)
+
+        Returns:
+            Deferred
+        """
+        def remove_from_federation_queue_txn(txn):
+            txn.executemany(
+                "DELETE FROM federation_outbound_queue"
+                " WHERE destination = ? AND stream_id = ?",
+                [(destination, stream_id) for stream_id in stream_ids]
+            )
+
+        return self.runInteraction(
+            "remove_from_federation_queue", remove_from_federation_queue_txn,
+        )
+
+    def get_destinations_with_federation_queue(self):
+        """Gets the destinations that have PDUs or EDUs waiting to be sent.
+
+        Returns:
+            Deferred[list]
+        """
+        def get_destinations_with_federation_queue_txn(txn):
+            txn.execute(
+                "SELECT DISTINCT destination FROM federation_outbound_queue"
+            )
+            return [row[0] for row in txn.fetchall()]
+
+        return self.runInteraction(
+            "get_destinations_with_federation_queue",
+            get_destinations_with_federation_queue_txn,
+        )
+
+    def prune_federation_queue(self, max_age_ms, max_per_destination):
+        """Drops the PDUs and EDUs that have been queued for too long, and the
+        oldest ones of any destination with too many queued, so that the
+        queues of servers that have gone away don't grow forever.
+
+        Args:
+            max_age_ms (int): Rows queued longer ago than this are dropped.
+            max_per_destination (int): The maximum number of rows to keep for
+                each destination.
+
+        Returns:
+            Deferred[int]: The number of rows dropped.
+        """
+        def prune_federation_queue_txn(txn):
+            txn.execute(
+                "DELETE FROM federation_outbound_queue WHERE queued_ts < ?",
+                (self._clock.time_msec() - max_age_ms,)
+            )
+            pruned = txn.rowcount
+
+            txn.execute(
+                "SELECT destination FROM federation_outbound_queue"
+                " GROUP BY destination HAVING count(*) > ?",
+                (max_per_destination,)
+            )
+            destinations = [row[0] for row in txn.fetchall()]
+
+            for destination in destinations:
+                # Find the oldest row we are keeping, and drop everything
+                # before it.
+                txn.execute(
+                    "SELECT stream_id FROM federation_outbound_queue"
+                    " WHERE destination = ?"
+                    " ORDER BY stream_id DESC LIMIT 1 OFFSET ?",
+                    (destination, max_per_destination - 1)
+                )
+                min_stream_id, = txn.fetchone()
+
+                txn.execute(
+                    "DELETE FROM federation_outbound_queue"
+                    " WHERE destination = ? AND stream_id < ?",
+                    (destination, min_stream_id)
+                )
+                pruned += txn.rowcount
+
+            return pruned
+
+        return self.runInteraction(
+            "prune_federation_queue", prune_federation_queue_txn,
+        )
+
+    def get_federation_out_pos(self, stream):
+        """Gets the position in a replication stream that the federation
+        sender has sent up to.
+
+        Args:
+            stream (str): The name of the stream, e.g. "events".
+
+        Returns:
+            Deferred[int|None]: The position, or None if it hasn't been stored
+            yet.
+        """
+        return self._simple_select_one_onecol(
+            table="federation_stream_position",
+            keyvalues={"type": stream},
+            retcol="stream_id",
+            allow_none=True,
+            desc="get_federation_out_pos",
+        )
+
+    def update_federation_out_pos(self, stream, stream_id):
+        """Stores the position in a replication stream that the federation
+        sender has sent up to.
+
+        Args:
+            stream (str): The name of the stream, e.g. "events".
+            stream_id (int)
+
+        Returns:
+            Deferred
+        """
+        return self._simple_upsert(
+            table="federation_stream_position",
+            keyvalues={"type": stream},
+            values={"stream_id": stream_id},
+            desc="update_federation_out_pos",
+        )
+
     @cached()
     def get_destination_retry_timings(self, destination):
         """Gets the current retry timings (if any) for a given destination.
@@ -194,3 +194,58 @@ class Linearizer(object):
                     self.key_to_defer.pop(key, None)
 
         defer.returnValue(_ctx_manager())
+
+
+class Limiter(object):
+    """Limits concurrent access to resources based on a key. Useful to ensure
+    only a few things happen at a time on a given resource.
+
+    Example:
+
+        with (yield limiter.queue("test_key")):
+            # do some work.
+
+    """
+    def __init__(self, max_count):
+        """
+        Args:
+            max_count(int): The maximum number of concurrent accesses for a
+                given key.
+        """
+        self.max_count = max_count
+
+        # key -> [number of things executing, list of deferreds of things
+        # waiting to execute]
+        self.key_to_defer = {}
+
+    @defer.inlineCallbacks
+    def queue(self, key):
+        entry = self.key_to_defer.setdefault(key, [0, []])
+
+        # If there are already too many things executing, we wait for one of
+        # them to finish. It will then resolve our deferred, so that we can
+        # continue executing.
+        if entry[0] >= self.max_count:
+            new_defer = defer.Deferred()
+            entry[1].append(new_defer)
+            with PreserveLoggingContext():
+                yield new_defer
+
+        entry[0] += 1
+
+        @contextmanager
+        def _ctx_manager():
+            try:
+                yield
+            finally:
+                # We've finished executing, so start the next thing that is
+                # waiting, if any.
+                entry[0] -= 1
+                if entry[1]:
+                    next_defer = entry[1].pop(0)
+                    with PreserveLoggingContext():
+                        next_defer.callback(None)
+                elif entry[0] == 0:
+                    self.key_to_defer.pop(key, None)
+
+        defer.returnValue(_ctx_manager())
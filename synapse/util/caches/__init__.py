@@ -15,10 +15,20 @@
 
 import synapse.metrics
 from lrucache import LruCache
+from memory_budget import MemoryBudget, parse_byte_size
 import os
 
 CACHE_SIZE_FACTOR = float(os.environ.get("SYNAPSE_CACHE_FACTOR", 0.1))
 
+# The approximate number of bytes that size aware caches may use between them,
+# e.g. "512M". If unset then caches are only bounded by their number of
+# entries.
+CACHE_MEMORY_BUDGET = parse_byte_size(
+    os.environ.get("SYNAPSE_CACHE_MEMORY_BUDGET", None)
+)
+
+cache_memory_budget = MemoryBudget(CACHE_MEMORY_BUDGET)
+
 DEBUG_CACHES = False
 
 metrics = synapse.metrics.get_metrics_for("synapse.util.caches")
@@ -33,10 +43,13 @@ caches_by_name = {}
 
 def register_cache(name, cache):
     caches_by_name[name] = cache
+
+    size_in_bytes = getattr(cache, "size_in_bytes", None)
     return metrics.register_cache(
         "cache",
         lambda: len(cache),
         name,
+        bytes_callback=size_in_bytes,
     )
 
 
@@ -66,6 +79,55 @@ KNOWN_KEYS = {
 }
 
 
+# Keys and values that turn up in the content of lots of events
+KNOWN_CONTENT_KEYS = {
+    key: key for key in
+    (
+        "avatar_url",
+        "body",
+        "creator",
+        "displayname",
+        "format",
+        "formatted_body",
+        "guest_access",
+        "history_visibility",
+        "join_rule",
+        "membership",
+        "msgtype",
+        "name",
+        "topic",
+        "url",
+        "users",
+        "users_default",
+    )
+}
+
+KNOWN_CONTENT_VALUES = {
+    value: value for value in
+    (
+        "ban",
+        "can_join",
+        "forbidden",
+        "invite",
+        "invited",
+        "join",
+        "joined",
+        "knock",
+        "leave",
+        "m.emote",
+        "m.file",
+        "m.image",
+        "m.notice",
+        "m.text",
+        "org.matrix.custom.html",
+        "private",
+        "public",
+        "shared",
+        "world_readable",
+    )
+}
+
+
 def intern_string(string):
     """Takes a (potentially) unicode string and interns using custom cache
     """
@@ -89,6 +151,22 @@ def _intern_known_values(key, value):
         return intern(value.encode('ascii'))
 
     if key in intern_unicode_keys:
+        if isinstance(value, unicode):
+            try:
+                # Most of these are ASCII, so store them as (smaller) byte
+                # strings, which can also use the builtin intern table.
+                return intern(value.encode('ascii'))
+            except UnicodeEncodeError:
+                pass
         return intern_string(value)
 
+    if key == "content" and type(value) is dict:
+        return {
+            KNOWN_CONTENT_KEYS.get(k, k): (
+                KNOWN_CONTENT_VALUES.get(v, v)
+                if isinstance(v, basestring) else v
+            )
+            for k, v in value.items()
+        }
+
     return value
@@ -22,7 +22,7 @@ from synapse.util.logcontext import (
     PreserveLoggingContext, preserve_context_over_deferred, preserve_context_over_fn
 )
 
-from . import DEBUG_CACHES, register_cache
+from . import DEBUG_CACHES, register_cache, cache_memory_budget
 
 from twisted.internet import defer
 
@@ -43,6 +43,53 @@ _CacheSentinel = object()
 CACHE_SIZE_FACTOR = float(os.environ.get("SYNAPSE_CACHE_FACTOR", 0.1))
 
 
+def _get_cache_key_builder(orig, num_args):
+    """Builds a function that extracts the cache key from the arguments of a
+    call to `orig`, without having to go through `inspect.getcallargs` on every
+    call.
+
+    Args:
+        orig (function): The method being cached. The first argument is
+            assumed to be `self`, and is not part of the key.
+        num_args (int): The number of arguments (after `self`) that make up
+            the key.
+
+    Returns:
+        tuple: (arg_names, get_cache_key), where `get_cache_key` is a function
+        that takes `(args, kwargs)` (excluding `self`) and returns the key as
+        a tuple.
+    """
+    argspec = inspect.getargspec(orig)
+    arg_names = argspec.args[1:num_args + 1]
+
+    defaults = {}
+    if argspec.defaults:
+        defaults = dict(zip(
+            argspec.args[-len(argspec.defaults):], argspec.defaults
+        ))
+
+    def get_cache_key(args, kwargs):
+        if not kwargs and len(args) >= num_args:
+            # The common case: all the key arguments were passed positionally.
+            return args[:num_args]
+
+        key = []
+        for i, arg_nm in enumerate(arg_names):
+            if i < len(args):
+                key.append(args[i])
+            elif arg_nm in kwargs:
+                key.append(kwargs[arg_nm])
+            elif arg_nm in defaults:
+                key.append(defaults[arg_nm])
+            else:
+                raise TypeError(
+                    "%s() missing required argument %r" % (orig.__name__, arg_nm)
+                )
+        return tuple(key)
+
+    return arg_names, get_cache_key
+
+
 class Cache(object):
     __slots__ = (
         "cache",
@@ -54,11 +101,20 @@ class Cache(object):
         "metrics",
     )
 
-    def __init__(self, name, max_entries=1000, keylen=1, lru=True, tree=False):
+    def __init__(self, name, max_entries=1000, keylen=1, lru=True, tree=False,
+                 size_callback=None):
+        """
+        Args:
+            size_callback (func|None): If given, a function returning the
+                estimated size in bytes of a cache value. The cache then counts
+                towards the shared cache memory budget. Only supported if `lru`
+                is True.
+        """
         if lru:
             cache_type = TreeCache if tree else dict
             self.cache = LruCache(
-                max_size=max_entries, keylen=keylen, cache_type=cache_type
+                max_size=max_entries, keylen=keylen, cache_type=cache_type,
+                size_callback=size_callback, memory_budget=cache_memory_budget,
             )
             self.max_entries = None
         else:
@@ -168,7 +224,9 @@ class CacheDescriptor(object):
         self.lru = lru
         self.tree = tree
 
-        self.arg_names = inspect.getargspec(orig).args[1:num_args + 1]
+        self.arg_names, self.get_cache_key = _get_cache_key_builder(
+            orig, num_args
+        )
 
         if len(self.arg_names) < self.num_args:
             raise Exception(
@@ -186,13 +244,20 @@ class CacheDescriptor(object):
             tree=self.tree,
         )
 
+        get_cache_key = self.get_cache_key
+
         @functools.wraps(self.orig)
         def wrapped(*args, **kwargs):
-            arg_dict = inspect.getcallargs(self.orig, obj, *args, **kwargs)
-            cache_key = tuple(arg_dict[arg_nm] for arg_nm in self.arg_names)
+            cache_key = get_cache_key(args, kwargs)
             try:
                 cached_result_d = cache.get(cache_key)
 
+                if not DEBUG_CACHES and cached_result_d.has_succeeded():
+                    # Fast path: the result is already available, so there is
+                    # no need to create observers or preserve the logcontext
+                    # as any callbacks will be run immediately.
+                    return defer.succeed(cached_result_d.get_result())
+
                 observer = cached_result_d.observe()
                 if DEBUG_CACHES:
                     @defer.inlineCallbacks
@@ -271,8 +336,9 @@ class CacheListDescriptor(object):
         self.num_args = num_args
         self.list_name = list_name
 
-        self.arg_names = inspect.getargspec(orig).args[1:num_args + 1]
-        self.list_pos = self.arg_names.index(self.list_name)
+        self.arg_names, self.get_cache_key = _get_cache_key_builder(
+            orig, num_args
+        )
 
         self.cached_method_name = cached_method_name
 
@@ -291,15 +357,18 @@ class CacheListDescriptor(object):
                 % (self.list_name, cached_method_name,)
             )
 
+        self.list_pos = self.arg_names.index(self.list_name)
+
     def __get__(self, obj, objtype=None):
 
         cache = getattr(obj, self.cached_method_name).cache
+        get_cache_key = self.get_cache_key
+        list_pos = self.list_pos
 
         @functools.wraps(self.orig)
         def wrapped(*args, **kwargs):
-            arg_dict = inspect.getcallargs(self.orig, obj, *args, **kwargs)
-            keyargs = [arg_dict[arg_nm] for arg_nm in self.arg_names]
-            list_args = arg_dict[self.list_name]
+            keyargs = list(get_cache_key(args, kwargs))
+            list_args = keyargs[list_pos]
 
             # cached is a dict arg -> deferred, where deferred results in a
             # 2-tuple (`arg`, `result`)
@@ -308,7 +377,7 @@ class CacheListDescriptor(object):
             missing = []
             for arg in list_args:
                 key = list(keyargs)
-                key[self.list_pos] = arg
+                key[list_pos] = arg
 
                 try:
                     res = cache.get(tuple(key))
@@ -323,13 +392,20 @@ class CacheListDescriptor(object):
 
             if missing:
                 sequence = cache.sequence
-                args_to_call = dict(arg_dict)
-                args_to_call[self.list_name] = missing
+
+                # Call the function with the same arguments, but with the
+                # list replaced with just the missing entries.
+                args_to_call = list(args)
+                kwargs_to_call = dict(kwargs)
+                if list_pos < len(args_to_call):
+                    args_to_call[list_pos] = missing
+                else:
+                    kwargs_to_call[self.list_name] = missing
 
                 ret_d = defer.maybeDeferred(
                     preserve_context_over_fn,
                     self.function_to_call,
-                    **args_to_call
+                    obj, *args_to_call, **kwargs_to_call
                 )
 
                 ret_d = ObservableDeferred(ret_d)
@@ -344,7 +420,7 @@ class CacheListDescriptor(object):
                     observer = ObservableDeferred(observer)
 
                     key = list(keyargs)
-                    key[self.list_pos] = arg
+                    key[list_pos] = arg
                     cache.update(sequence, tuple(key), observer)
 
                     def invalidate(f, key):
@@ -30,13 +30,14 @@ def enumerate_leaves(node, depth):
 
 
 class _Node(object):
-    __slots__ = ["prev_node", "next_node", "key", "value"]
+    __slots__ = ["prev_node", "next_node", "key", "value", "size"]
 
-    def __init__(self, prev_node, next_node, key, value):
+    def __init__(self, prev_node, next_node, key, value, size=0):
         self.prev_node = prev_node
         self.next_node = next_node
         self.key = key
         self.value = value
+        self.size = size
 
 
 class LruCache(object):
@@ -44,14 +45,25 @@ class LruCache(object):
     Least-recently-used cache.
     Supports del_multi only if cache_type=TreeCache
     If cache_type=TreeCache, all keys must be tuples.
+
+    If a `size_callback` is given then the cache keeps track of the
+    (estimated) number of bytes used by its values, which is reported by
+    `size_in_bytes`. If a `memory_budget` is also given then the cache is
+    registered with it, and entries may be evicted to keep the total size of
+    all caches sharing the budget within its limit.
     """
-    def __init__(self, max_size, keylen=1, cache_type=dict):
+    def __init__(self, max_size, keylen=1, cache_type=dict, size_callback=None,
+                 memory_budget=None):
         cache = cache_type()
         self.cache = cache  # Used for introspection.
         list_root = _Node(None, None, None, None)
         list_root.next_node = list_root
         list_root.prev_node = list_root
 
+        # The total of the sizes of all the nodes in the cache, as a list so
+        # that the closures below can update it.
+        size_in_bytes = [0]
+
         lock = threading.Lock()
 
         def synchronized(f):
@@ -65,10 +77,12 @@ class LruCache(object):
         def add_node(key, value):
             prev_node = list_root
             next_node = prev_node.next_node
-            node = _Node(prev_node, next_node, key, value)
+            size = size_callback(value) if size_callback else 0
+            node = _Node(prev_node, next_node, key, value, size)
             prev_node.next_node = node
             next_node.prev_node = node
             cache[key] = node
+            size_in_bytes[0] += size
 
         def move_node_to_front(node):
             prev_node = node.prev_node
@@ -87,6 +101,18 @@ class LruCache(object):
             next_node = node.next_node
             prev_node.next_node = next_node
             next_node.prev_node = prev_node
+            size_in_bytes[0] -= node.size
+
+        def update_node_value(node, value):
+            node.value = value
+            if size_callback:
+                size = size_callback(value)
+                size_in_bytes[0] += size - node.size
+                node.size = size
+
+        def evict_if_needed():
+            if memory_budget is not None:
+                memory_budget.evict_if_needed()
 
         @synchronized
         def cache_get(key, default=None):
@@ -98,11 +124,11 @@ class LruCache(object):
                 return default
 
         @synchronized
-        def cache_set(key, value):
+        def _cache_set(key, value):
             node = cache.get(key, None)
             if node is not None:
                 move_node_to_front(node)
-                node.value = value
+                update_node_value(node, value)
             else:
                 add_node(key, value)
                 if len(cache) > max_size:
@@ -110,8 +136,12 @@ class LruCache(object):
                     delete_node(todelete)
                     cache.pop(todelete.key, None)
 
+        def cache_set(key, value):
+            _cache_set(key, value)
+            evict_if_needed()
+
         @synchronized
-        def cache_set_default(key, value):
+        def _cache_set_default(key, value):
             node = cache.get(key, None)
             if node is not None:
                 return node.value
@@ -123,6 +153,11 @@ class LruCache(object):
                     cache.pop(todelete.key, None)
                 return value
 
+        def cache_set_default(key, value):
+            ret = _cache_set_default(key, value)
+            evict_if_needed()
+            return ret
+
         @synchronized
         def cache_pop(key, default=None):
             node = cache.get(key, None)
@@ -149,6 +184,21 @@ class LruCache(object):
             list_root.next_node = list_root
             list_root.prev_node = list_root
             cache.clear()
+            size_in_bytes[0] = 0
+
+        @synchronized
+        def cache_evict_oldest():
+            todelete = list_root.prev_node
+            if todelete is list_root:
+                return None
+            delete_node(todelete)
+            cache.pop(todelete.key, None)
+            return todelete.size
+
+        def cache_size_in_bytes():
+            if size_callback is None:
+                return None
+            return size_in_bytes[0]
 
         @synchronized
         def cache_len():
@@ -168,6 +218,11 @@ class LruCache(object):
         self.len = cache_len
         self.contains = cache_contains
         self.clear = cache_clear
+        self.evict_oldest = cache_evict_oldest
+        self.size_in_bytes = cache_size_in_bytes
+
+        if size_callback is not None and memory_budget is not None:
+            memory_budget.register(self)
 
     def __getitem__(self, key):
         result = self.get(key, self.sentinel)
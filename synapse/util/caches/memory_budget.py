@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import weakref
+
+
+def parse_byte_size(value):
+    """Parses a size such as "512M" into a number of bytes. Returns None if
+    value is empty.
+    """
+    if not value:
+        return None
+    if isinstance(value, (int, long)):
+        return value
+    sizes = {"K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+    size = 1
+    suffix = value[-1].upper()
+    if suffix in sizes:
+        value = value[:-1]
+        size = sizes[suffix]
+    return int(value) * size
+
+
+def estimate_size(obj):
+    """Gives a rough estimate of the number of bytes used by an object,
+    including any dicts, lists, tuples, strings or object attributes it
+    references. Objects referenced more than once are only counted once.
+    """
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+
+        size += sys.getsizeof(o)
+
+        if isinstance(o, (str, unicode, int, long, float, bool)) or o is None:
+            continue
+        elif isinstance(o, dict):
+            stack.extend(o.iterkeys())
+            stack.extend(o.itervalues())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        else:
+            d = getattr(o, "__dict__", None)
+            if d is not None:
+                stack.append(d)
+            for cls in type(o).__mro__:
+                for slot in cls.__dict__.get("__slots__", ()):
+                    v = getattr(o, slot, None)
+                    if v is not None:
+                        stack.append(v)
+    return size
+
+
+class MemoryBudget(object):
+    """A limit on the total number of bytes used by a set of size aware
+    caches.
+
+    Caches register with the budget and call `evict_if_needed` after adding
+    entries. If the caches are using more than `max_bytes` between them then
+    entries are evicted, oldest first, from whichever cache is currently using
+    the most memory.
+
+    Caches must implement `size_in_bytes()`, returning their current usage,
+    and `evict_oldest()`, which evicts their least recently used entry and
+    returns the number of bytes freed (or None if the cache is empty).
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self._caches = weakref.WeakSet()
+
+    def register(self, cache):
+        self._caches.add(cache)
+
+    def total_bytes(self):
+        return sum(cache.size_in_bytes() for cache in list(self._caches))
+
+    def evict_if_needed(self):
+        if self.max_bytes is None:
+            return
+
+        sizes = {}
+        for cache in list(self._caches):
+            sizes[cache] = cache.size_in_bytes()
+
+        excess = sum(sizes.values()) - self.max_bytes
+        while excess > 0 and sizes:
+            largest = max(sizes, key=sizes.get)
+            freed = largest.evict_oldest()
+            if freed is None:
+                # The cache is empty, so try the next one.
+                del sizes[largest]
+                continue
+            sizes[largest] -= freed
+            excess -= freed
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from synapse.util.caches import register_cache, CACHE_SIZE_FACTOR
+from synapse.util.caches.lrucache import LruCache
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class RoomMembershipIndex(object):
+    """An in-memory index of the users joined to each room and the rooms each
+    user is joined to.
+
+    Entries are loaded lazily by the store and are then kept up to date by
+    applying membership changes as they are persisted (or replicated), rather
+    than being thrown away and reloaded from the database. This makes it cheap
+    to repeatedly ask whether two users share a room, which is what the
+    presence stream needs to do for every user whose presence has changed.
+
+    Entries are frozensets that are replaced, rather than modified, when the
+    membership changes, so callers can safely hold on to and iterate over the
+    sets they get back while the index is being updated.
+    """
+    def __init__(self, name, max_size=50000):
+        max_size = int(max_size * CACHE_SIZE_FACTOR)
+        self._users_in_room = LruCache(max_size)
+        self._rooms_for_user = LruCache(max_size)
+        self.name = name
+        self.room_metrics = register_cache(name + "_rooms", self._users_in_room)
+        self.user_metrics = register_cache(name + "_users", self._rooms_for_user)
+
+        # Incremented on every change. Loads that started before a change
+        # might have read stale data from the database, so are only added to
+        # the index if the sequence number hasn't changed since they started.
+        self.sequence = 0
+
+    def get_users_in_room(self, room_id):
+        """Returns the frozenset of user_ids joined to the room, or None if the
+        room isn't in the index.
+        """
+        users = self._users_in_room.get(room_id)
+        if users is None:
+            self.room_metrics.inc_misses()
+        else:
+            self.room_metrics.inc_hits()
+        return users
+
+    def get_rooms_for_user(self, user_id):
+        """Returns the frozenset of room_ids the user is joined to, or None if
+        the user isn't in the index.
+        """
+        rooms = self._rooms_for_user.get(user_id)
+        if rooms is None:
+            self.user_metrics.inc_misses()
+        else:
+            self.user_metrics.inc_hits()
+        return rooms
+
+    def prefill_users_in_room(self, sequence, room_id, user_ids):
+        """Add the joined users of a room that were loaded from the database.
+
+        Args:
+            sequence (int): The value of `sequence` before the load started.
+            room_id (str)
+            user_ids (iterable): The user_ids joined to the room.
+
+        Returns:
+            frozenset: The user_ids joined to the room.
+        """
+        users = frozenset(user_ids)
+        if sequence == self.sequence:
+            self._users_in_room[room_id] = users
+        return users
+
+    def prefill_rooms_for_user(self, sequence, user_id, room_ids):
+        """Add the rooms a user is joined to that were loaded from the
+        database.
+
+        Args:
+            sequence (int): The value of `sequence` before the load started.
+            user_id (str)
+            room_ids (iterable): The room_ids the user is joined to.
+
+        Returns:
+            frozenset: The room_ids the user is joined to.
+        """
+        rooms = frozenset(room_ids)
+        if sequence == self.sequence:
+            self._rooms_for_user[user_id] = rooms
+        return rooms
+
+    def membership_changed(self, room_id, user_id, joined):
+        """Apply a change to the current membership of a user in a room.
+
+        Args:
+            room_id (str)
+            user_id (str)
+            joined (bool): Whether the user is now joined to the room.
+        """
+        self.sequence += 1
+
+        users = self._users_in_room.get(room_id)
+        if users is not None:
+            if joined:
+                users = users | frozenset((user_id,))
+            else:
+                users = users - frozenset((user_id,))
+            self._users_in_room[room_id] = users
+
+        rooms = self._rooms_for_user.get(user_id)
+        if rooms is not None:
+            if joined:
+                rooms = rooms | frozenset((room_id,))
+            else:
+                rooms = rooms - frozenset((room_id,))
+            self._rooms_for_user[user_id] = rooms
+
+    def invalidate_room(self, room_id):
+        """Drop everything we know about a room, e.g. because its state has
+        been reset. As any user may have been affected we have to forget the
+        rooms of every user too.
+        """
+        self.sequence += 1
+        self._users_in_room.pop(room_id)
+        self._rooms_for_user.clear()
+
+    def is_user_in_any_room(self, user_id, room_ids):
+        """Checks if the user is joined to any of the given rooms.
+
+        Args:
+            user_id (str)
+            room_ids (set): The rooms to check.
+
+        Returns:
+            bool|None: None if the user isn't in the index.
+        """
+        rooms = self.get_rooms_for_user(user_id)
+        if rooms is None:
+            return None
+        return not rooms.isdisjoint(room_ids)
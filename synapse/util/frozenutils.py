@@ -16,15 +16,60 @@
 from frozendict import frozendict
 
 
+class FrozenDict(dict):
+    """An immutable dict.
+
+    Unlike frozendict this is a dict subclass without a __dict__, so it takes
+    up no more memory than the dict it replaces, and JSON encoders can encode
+    it like any other dict.
+    """
+    __slots__ = []
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("'%s' object is immutable" % (type(self).__name__,))
+
+    __setitem__ = _immutable
+    __delitem__ = _immutable
+    clear = _immutable
+    pop = _immutable
+    popitem = _immutable
+    setdefault = _immutable
+    update = _immutable
+
+    def __hash__(self):
+        h = 0
+        for item in self.iteritems():
+            h ^= hash(item)
+        return h
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+    def __repr__(self):
+        return "FrozenDict(%s)" % (dict.__repr__(self),)
+
+
 def freeze(o):
+    """Returns an immutable copy of a JSON-like object, turning dicts into
+    FrozenDicts and lists into tuples.
+
+    ASCII-only unicode strings are turned into byte strings, which take up a
+    fraction of the memory.
+    """
     t = type(o)
     if t is dict:
-        return frozendict({k: freeze(v) for k, v in o.items()})
+        return FrozenDict({freeze(k): freeze(v) for k, v in o.items()})
 
-    if t is frozendict:
+    if t is FrozenDict or t is frozendict:
         return o
 
-    if t is str or t is unicode:
+    if t is unicode:
+        try:
+            return o.encode("ascii")
+        except UnicodeEncodeError:
+            return o
+
+    if t is str:
         return o
 
     try:
@@ -37,7 +82,7 @@ def freeze(o):
 
 def unfreeze(o):
     t = type(o)
-    if t is dict or t is frozendict:
+    if t is dict or t is FrozenDict or t is frozendict:
         return dict({k: unfreeze(v) for k, v in o.items()})
 
     if t is str or t is unicode:
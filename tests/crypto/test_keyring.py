@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+from twisted.internet import defer
+
+from synapse.api.errors import SynapseError
+from synapse.crypto.keyring import Keyring
+
+from tests.utils import setup_test_homeserver
+
+from signedjson.key import generate_signing_key, get_verify_key
+from signedjson.sign import sign_json
+
+from mock import Mock
+
+
+class KeyringTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver(http_client=Mock())
+        hs.config.perspectives = {}
+
+        self.keyring = Keyring(hs)
+
+        # server_name -> key_id -> verify key, for each of the places we
+        # fetch keys from.
+        self.store_keys = {}
+        self.perspectives_keys = {}
+        self.server_keys = {}
+
+        self.keyring.get_keys_from_store = self.key_fetcher(self.store_keys)
+        self.keyring.get_keys_from_perspectives = self.key_fetcher(
+            self.perspectives_keys
+        )
+        self.keyring.get_keys_from_server = self.key_fetcher(self.server_keys)
+
+        self.signing_key = generate_signing_key("ver1")
+        self.verify_key = get_verify_key(self.signing_key)
+        self.key_id = "ed25519:ver1"
+
+    def key_fetcher(self, keys):
+        def fetch(server_name_and_key_ids):
+            return defer.succeed({
+                server_name: {
+                    key_id: keys[server_name][key_id]
+                    for key_id in key_ids
+                    if key_id in keys.get(server_name, {})
+                }
+                for server_name, key_ids in server_name_and_key_ids
+            })
+        return Mock(side_effect=fetch)
+
+    def signed(self, server_name, content, signing_key=None):
+        return sign_json(
+            {"content": content}, server_name, signing_key or self.signing_key,
+        )
+
+    @defer.inlineCallbacks
+    def assert_rejected(self, deferred, code):
+        try:
+            yield deferred
+        except SynapseError as e:
+            self.assertEquals(e.code, code)
+        else:
+            self.fail("Verification should have failed")
+
+    @defer.inlineCallbacks
+    def test_valid_signature(self):
+        self.store_keys["server1"] = {self.key_id: self.verify_key}
+
+        yield self.keyring.verify_json_for_server(
+            "server1", self.signed("server1", "hello")
+        )
+
+        # We didn't need to look any further than the store.
+        self.assertFalse(self.keyring.get_keys_from_perspectives.called)
+        self.assertFalse(self.keyring.get_keys_from_server.called)
+
+    @defer.inlineCallbacks
+    def test_bad_signature(self):
+        self.store_keys["server1"] = {self.key_id: self.verify_key}
+
+        other_key = generate_signing_key("ver1")
+        yield self.assert_rejected(
+            self.keyring.verify_json_for_server(
+                "server1", self.signed("server1", "hello", other_key)
+            ),
+            401,
+        )
+
+        json_object = self.signed("server1", "hello")
+        json_object["content"] = "goodbye"
+        yield self.assert_rejected(
+            self.keyring.verify_json_for_server("server1", json_object), 401,
+        )
+
+    @defer.inlineCallbacks
+    def test_unsigned(self):
+        yield self.assert_rejected(
+            self.keyring.verify_json_for_server("server1", {"content": "hi"}),
+            401,
+        )
+
+    @defer.inlineCallbacks
+    def test_cached_signature(self):
+        self.store_keys["server1"] = {self.key_id: self.verify_key}
+
+        json_object = self.signed("server1", "hello")
+        yield self.keyring.verify_json_for_server("server1", json_object)
+
+        # The second time around we don't check the signature again.
+        verify_key = Mock(wraps=self.verify_key)
+        verify_key.alg = self.verify_key.alg
+        verify_key.version = self.verify_key.version
+        self.store_keys["server1"] = {self.key_id: verify_key}
+
+        yield self.keyring.verify_json_for_server("server1", json_object)
+        self.assertFalse(verify_key.verify.called)
+
+        # The unsigned section isn't covered by the signature.
+        json_object["unsigned"] = {"age": 10}
+        yield self.keyring.verify_json_for_server("server1", json_object)
+        self.assertFalse(verify_key.verify.called)
+
+    @defer.inlineCallbacks
+    def test_cached_signature_with_tampered_content(self):
+        self.store_keys["server1"] = {self.key_id: self.verify_key}
+
+        json_object = self.signed("server1", "hello")
+        yield self.keyring.verify_json_for_server("server1", json_object)
+
+        # Reusing a signature we've already verified with different content
+        # must not be accepted.
+        tampered = dict(json_object)
+        tampered["content"] = "goodbye"
+        yield self.assert_rejected(
+            self.keyring.verify_json_for_server("server1", tampered), 401,
+        )
+
+        # Nor with the signature claimed by a different server.
+        self.store_keys["server2"] = {self.key_id: self.verify_key}
+        other_server = dict(json_object)
+        other_server["signatures"] = {
+            "server2": json_object["signatures"]["server1"],
+        }
+        other_server["content"] = "goodbye"
+        yield self.assert_rejected(
+            self.keyring.verify_json_for_server("server2", other_server), 401,
+        )
+
+    @defer.inlineCallbacks
+    def test_key_not_found(self):
+        yield self.assert_rejected(
+            self.keyring.verify_json_for_server(
+                "server1", self.signed("server1", "hello")
+            ),
+            401,
+        )
+
+        # We tried everywhere before giving up.
+        self.assertTrue(self.keyring.get_keys_from_store.called)
+        self.assertTrue(self.keyring.get_keys_from_perspectives.called)
+        self.assertTrue(self.keyring.get_keys_from_server.called)
+
+    @defer.inlineCallbacks
+    def test_key_download_failure(self):
+        self.keyring.get_keys_from_server = Mock(
+            return_value=defer.fail(IOError("Connection refused"))
+        )
+
+        yield self.assert_rejected(
+            self.keyring.verify_json_for_server(
+                "server1", self.signed("server1", "hello")
+            ),
+            502,
+        )
+
+    @defer.inlineCallbacks
+    def test_servers_verified_independently(self):
+        self.store_keys["fast"] = {self.key_id: self.verify_key}
+
+        slow_keys = defer.Deferred()
+        self.keyring.get_keys_from_perspectives = Mock(return_value=slow_keys)
+
+        fast_d, slow_d, fast_bad_d = self.keyring.verify_json_objects_for_server([
+            ("fast", self.signed("fast", "hello")),
+            ("slow", self.signed("slow", "hello")),
+            ("fast", self.signed("fast", "hi", generate_signing_key("ver1"))),
+        ])
+
+        # The objects from the fast server are checked without waiting for
+        # the slow server's keys.
+        yield fast_d
+        yield self.assert_rejected(fast_bad_d, 401)
+        self.assertFalse(slow_d.called)
+
+        slow_keys.callback({
+            "fast": {},
+            "slow": {self.key_id: self.verify_key},
+        })
+        yield slow_d
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from .. import unittest
+
+from synapse.events import FrozenEvent
+from synapse.util.frozenutils import FrozenDict
+
+from canonicaljson import encode_canonical_json
+
+import copy
+
+
+EVENT = {
+    "event_id": u"$1:test",
+    "room_id": u"!room:test",
+    "sender": u"@alice:test",
+    "type": u"m.room.member",
+    "state_key": u"@alice:test",
+    "depth": 5,
+    "origin": u"test",
+    "origin_server_ts": 1234,
+    "content": {u"membership": u"join", u"displayname": u"Alice ☃"},
+    "auth_events": [[u"$create:test", {u"sha256": u"abc"}]],
+    "prev_events": [[u"$0:test", {u"sha256": u"def"}]],
+    "hashes": {u"sha256": u"ghi"},
+    "signatures": {u"test": {u"ed25519:1": u"sig"}},
+    "unsigned": {u"age_ts": 1000},
+}
+
+
+class FrozenEventTestCase(unittest.TestCase):
+
+    def test_fields(self):
+        event = FrozenEvent(EVENT)
+
+        self.assertEquals(event.event_id, "$1:test")
+        self.assertEquals(event.user_id, "@alice:test")
+        self.assertEquals(event.membership, "join")
+        self.assertEquals(event.content["displayname"], u"Alice ☃")
+        self.assertEquals(event["type"], "m.room.member")
+        self.assertEquals(event.get("redacts", None), None)
+        self.assertTrue("state_key" in event)
+        self.assertFalse("redacts" in event)
+        self.assertTrue(event.is_state())
+
+        with self.assertRaises(KeyError):
+            event["redacts"]
+
+    def test_not_state(self):
+        event_dict = dict(EVENT)
+        del event_dict["state_key"]
+        event = FrozenEvent(event_dict)
+
+        self.assertFalse(event.is_state())
+        self.assertFalse("state_key" in event)
+
+    def test_round_trip(self):
+        event = FrozenEvent(EVENT)
+
+        self.assertEquals(set(event.get_dict()), set(EVENT))
+        self.assertEquals(
+            encode_canonical_json(event.get_pdu_json()),
+            encode_canonical_json(EVENT),
+        )
+
+    def test_immutable(self):
+        event = FrozenEvent(EVENT)
+
+        with self.assertRaises(TypeError):
+            event.content["membership"] = "leave"
+
+        with self.assertRaises(AttributeError):
+            event.event_id = "$2:test"
+
+    def test_shared_references(self):
+        event_1 = FrozenEvent(EVENT)
+        event_2 = FrozenEvent(EVENT)
+
+        self.assertIs(event_1.auth_events[0], event_2.auth_events[0])
+
+    def test_internal_metadata(self):
+        event = FrozenEvent(EVENT, internal_metadata_dict={"outlier": True})
+
+        self.assertTrue(event.internal_metadata.is_outlier())
+        event.internal_metadata.stream_ordering = 5
+
+        metadata = copy.deepcopy(event.internal_metadata)
+        self.assertEquals(metadata.get_dict(), {
+            "outlier": True, "stream_ordering": 5,
+        })
+        self.assertFalse(hasattr(metadata, "txn_id"))
+
+
+class FrozenDictTestCase(unittest.TestCase):
+
+    def test_frozen_dict(self):
+        d = FrozenDict({"a": 1})
+
+        with self.assertRaises(TypeError):
+            d["b"] = 2
+        with self.assertRaises(TypeError):
+            d.update({"b": 2})
+
+        self.assertEquals(d, {"a": 1})
+        self.assertEquals(hash(d), hash(FrozenDict({"a": 1})))
+        self.assertEquals(copy.deepcopy(d), d)
+        self.assertIs(type(copy.deepcopy(d)), FrozenDict)
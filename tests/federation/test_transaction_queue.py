@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+from twisted.internet import defer
+
+from synapse.api.constants import PresenceState
+from synapse.federation.units import Edu
+from synapse.federation.transaction_queue import TransactionQueue
+from synapse.storage.presence import UserPresenceState
+from synapse.util.async import sleep
+
+from tests.utils import setup_test_homeserver
+
+from mock import Mock
+
+
+REMOTE = "remote"
+
+
+def presence(user_id, state):
+    return UserPresenceState.default(user_id).copy_and_replace(state=state)
+
+
+class FakeEvent(object):
+    def __init__(self, event_id):
+        self.event_id = event_id
+
+    def get_pdu_json(self):
+        return {"event_id": self.event_id}
+
+
+class TransactionQueueTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.hs = yield setup_test_homeserver(http_client=None)
+        self.hs.config.federation_presence_flush_interval_ms = 1000
+        self.hs.config.federation_presence_batch_size = 3
+
+        self.clock = self.hs.get_clock()
+        self.store = self.hs.get_datastore()
+
+        self.transport = Mock()
+        self.transport.send_transaction.return_value = defer.succeed({})
+
+        self.queue = TransactionQueue(self.hs, self.transport)
+
+        # The events table isn't needed to test the queue itself.
+        self.store.get_events = Mock(side_effect=lambda event_ids: defer.succeed({
+            event_id: FakeEvent(event_id) for event_id in event_ids
+        }))
+
+    @defer.inlineCallbacks
+    def send_queued(self, destination):
+        """Sends everything queued for the destination, including the
+        transactions that are attempted in the background once the first one
+        has been sent.
+        """
+        yield self.queue._attempt_new_transaction(destination)
+
+        for _ in range(100):
+            if (destination not in self.queue.pending_transactions
+                    and destination not in self.queue.destinations_with_queue):
+                break
+            yield sleep(0)
+
+    def sent_transactions(self):
+        """Returns the JSON of the transactions that have been sent"""
+        return [
+            call[0][1]()
+            for call in self.transport.send_transaction.call_args_list
+        ]
+
+    @defer.inlineCallbacks
+    def test_presence_coalesced(self):
+        self.queue.send_presence(REMOTE, [
+            presence("@a:test", PresenceState.ONLINE),
+        ])
+        self.queue.send_presence(REMOTE, [
+            presence("@a:test", PresenceState.UNAVAILABLE),
+            presence("@b:test", PresenceState.ONLINE),
+        ])
+
+        yield self.queue._attempt_new_transaction(REMOTE)
+
+        transactions = self.sent_transactions()
+        self.assertEquals(len(transactions), 1)
+
+        edus = transactions[0]["edus"]
+        self.assertEquals(len(edus), 1)
+        self.assertEquals(edus[0]["edu_type"], "m.presence")
+        self.assertEquals(
+            sorted(
+                (p["user_id"], p["presence"]) for p in edus[0]["content"]["push"]
+            ),
+            [
+                ("@a:test", PresenceState.UNAVAILABLE),
+                ("@b:test", PresenceState.ONLINE),
+            ],
+        )
+
+        # Nothing is left to send.
+        self.assertEquals(self.queue.pending_presence_by_dest, {})
+
+    def test_presence_flushed_after_interval(self):
+        self.queue._attempt_new_transaction = Mock()
+
+        self.queue.send_presence(REMOTE, [
+            presence("@a:test", PresenceState.ONLINE),
+        ])
+        self.assertFalse(self.queue._attempt_new_transaction.called)
+
+        self.clock.advance_time_msec(1000)
+        self.queue._attempt_new_transaction.assert_called_once_with(REMOTE)
+
+    def test_presence_flushed_at_batch_size(self):
+        self.queue._attempt_new_transaction = Mock()
+
+        self.queue.send_presence(REMOTE, [
+            presence("@a:test", PresenceState.ONLINE),
+            presence("@b:test", PresenceState.ONLINE),
+        ])
+        # Updating the same user again doesn't count towards the batch.
+        self.queue.send_presence(REMOTE, [
+            presence("@b:test", PresenceState.UNAVAILABLE),
+        ])
+        self.assertFalse(self.queue._attempt_new_transaction.called)
+
+        self.queue.send_presence(REMOTE, [
+            presence("@c:test", PresenceState.ONLINE),
+        ])
+        self.queue._attempt_new_transaction.assert_called_once_with(REMOTE)
+
+    @defer.inlineCallbacks
+    def test_queue_paged_at_caps(self):
+        self.queue._max_pdus_per_transaction = 2
+        self.queue._max_edus_per_transaction = 3
+
+        for i in range(5):
+            yield self.store.add_pdu_to_federation_queue("$%d:test" % (i,), [REMOTE])
+        for i in range(4):
+            yield self.store.add_edu_to_federation_queue(REMOTE, "m.test", {"i": i})
+        self.queue.destinations_with_queue.add(REMOTE)
+
+        yield self.send_queued(REMOTE)
+
+        transactions = self.sent_transactions()
+        self.assertEquals(
+            [[p["event_id"] for p in txn["pdus"]] for txn in transactions],
+            [["$0:test", "$1:test"], ["$2:test", "$3:test"], ["$4:test"]],
+        )
+        self.assertEquals(
+            [[e["content"]["i"] for e in txn.get("edus", [])] for txn in transactions],
+            [[0, 1, 2], [3], []],
+        )
+
+    @defer.inlineCallbacks
+    def test_queue_rows_removed_after_sending(self):
+        yield self.store.add_pdu_to_federation_queue("$0:test", [REMOTE, "other"])
+        yield self.store.add_edu_to_federation_queue(REMOTE, "m.test", {})
+        self.queue.destinations_with_queue.add(REMOTE)
+
+        yield self.send_queued(REMOTE)
+        self.assertEquals(len(self.sent_transactions()), 1)
+
+        pdu_rows, edu_rows = yield self.store.get_federation_queue_for_destination(
+            REMOTE, 10, 10,
+        )
+        self.assertEquals((pdu_rows, edu_rows), ([], []))
+
+        # Other destinations keep their queue.
+        pdu_rows, edu_rows = yield self.store.get_federation_queue_for_destination(
+            "other", 10, 10,
+        )
+        self.assertEquals([event_id for _, event_id in pdu_rows], ["$0:test"])
+        self.assertEquals(edu_rows, [])
+
+    @defer.inlineCallbacks
+    def test_queue_rows_kept_after_failure(self):
+        self.transport.send_transaction.return_value = defer.fail(
+            Exception("Connection refused")
+        )
+
+        yield self.store.add_edu_to_federation_queue(REMOTE, "m.test", {})
+        self.queue.destinations_with_queue.add(REMOTE)
+
+        yield self.send_queued(REMOTE)
+        self.assertEquals(len(self.transport.send_transaction.call_args_list), 1)
+
+        _, edu_rows = yield self.store.get_federation_queue_for_destination(
+            REMOTE, 10, 10,
+        )
+        self.assertEquals(len(edu_rows), 1)
+
+        # The destination is retried from memory, without scanning the queue.
+        self.assertEquals(self.queue._destinations_to_retry, set([REMOTE]))
+        self.store.get_destinations_with_federation_queue = Mock()
+        self.transport.send_transaction.return_value = defer.succeed({})
+
+        # ... once the destination is ready to be retried.
+        yield self.store.set_destination_retry_timings(REMOTE, 0, 0)
+        self.queue._retry_queued_destinations()
+        yield self.send_queued(REMOTE)
+
+        self.assertEquals(len(self.transport.send_transaction.call_args_list), 2)
+        self.assertEquals(self.queue._destinations_to_retry, set())
+        self.assertFalse(self.store.get_destinations_with_federation_queue.called)
+
+    @defer.inlineCallbacks
+    def test_typing_kept_in_memory(self):
+        self.store.add_edu_to_federation_queue = Mock()
+        self.queue._attempt_new_transaction = Mock()
+
+        for typing in (True, False):
+            self.queue.enqueue_edu(Edu(
+                origin="test",
+                destination=REMOTE,
+                edu_type="m.typing",
+                content={
+                    "room_id": "!room:test",
+                    "user_id": "@a:test",
+                    "typing": typing,
+                },
+            ))
+
+        self.assertFalse(self.store.add_edu_to_federation_queue.called)
+        del self.queue._attempt_new_transaction
+
+        yield self.queue._attempt_new_transaction(REMOTE)
+
+        # Only the latest notification for the user in the room is sent.
+        transactions = self.sent_transactions()
+        self.assertEquals(len(transactions), 1)
+        self.assertEquals(
+            [
+                (e["edu_type"], e["content"]["typing"])
+                for e in transactions[0]["edus"]
+            ],
+            [("m.typing", False)],
+        )
+        self.assertEquals(self.queue.pending_typing_by_dest, {})
@@ -15,8 +15,9 @@
 
 
 from tests import unittest
+from twisted.internet import defer
 
-from mock import Mock, call
+from mock import Mock, call, patch
 
 from synapse.api.constants import PresenceState
 from synapse.handlers.presence import (
@@ -26,6 +27,8 @@ from synapse.handlers.presence import (
 )
 from synapse.storage.presence import UserPresenceState
 
+from tests.utils import setup_test_homeserver
+
 
 class PresenceUpdateTestCase(unittest.TestCase):
     def test_offline_to_online(self):
@@ -380,3 +383,74 @@ class PresenceTimeoutTestCase(unittest.TestCase):
 
         self.assertIsNotNone(new_state)
         self.assertEquals(state, new_state)
+
+
+class PresenceBatchTestCase(unittest.TestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.hs = yield setup_test_homeserver(
+            resource_for_federation=Mock(),
+            http_client=None,
+        )
+        self.store = self.hs.get_datastore()
+        self.presence_handler = self.hs.get_presence_handler()
+
+        self.persisted_batches = []
+        update_presence = self.store.update_presence
+
+        def _update_presence(states):
+            self.persisted_batches.append(sorted(s.user_id for s in states))
+            return update_presence(states)
+        self.store.update_presence = _update_presence
+
+    @defer.inlineCallbacks
+    def test_updates_persisted_in_batches(self):
+        now = self.hs.get_clock().time_msec()
+        user_ids = ["@user%d:test" % (i,) for i in range(5)]
+
+        with patch("synapse.handlers.presence.PRESENCE_BATCH_SIZE", 2):
+            yield self.presence_handler._update_states([
+                UserPresenceState.default(user_id).copy_and_replace(
+                    state=PresenceState.ONLINE,
+                    last_active_ts=now,
+                    last_user_sync_ts=now,
+                )
+                for user_id in user_ids
+            ])
+
+        self.assertEquals(
+            [user_ids[0:2], user_ids[2:4], user_ids[4:]],
+            self.persisted_batches,
+        )
+
+        states = yield self.presence_handler.current_state_for_users(user_ids)
+        for user_id in user_ids:
+            self.assertEquals(PresenceState.ONLINE, states[user_id].state)
+
+    @defer.inlineCallbacks
+    def test_timeouts_handled_in_batches(self):
+        now = self.hs.get_clock().time_msec()
+        user_ids = ["@user%d:test" % (i,) for i in range(3)]
+
+        yield self.presence_handler._update_states([
+            UserPresenceState.default(user_id).copy_and_replace(
+                state=PresenceState.ONLINE,
+                last_active_ts=now,
+                last_user_sync_ts=now,
+            )
+            for user_id in user_ids
+        ])
+        self.persisted_batches = []
+
+        self.hs.get_clock().advance_time_msec(SYNC_ONLINE_TIMEOUT + 1)
+
+        with patch("synapse.handlers.presence.PRESENCE_BATCH_SIZE", 2):
+            yield self.presence_handler._handle_timeouts_for_users(user_ids)
+
+        self.assertEquals(
+            [user_ids[0:2], user_ids[2:]], self.persisted_batches,
+        )
+
+        states = yield self.presence_handler.current_state_for_users(user_ids)
+        for user_id in user_ids:
+            self.assertEquals(PresenceState.OFFLINE, states[user_id].state)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+from twisted.internet import defer
+
+from mock import Mock
+
+from synapse.api.constants import EventTypes, Membership
+from synapse.types import RoomID, UserID
+
+from tests.storage.event_injector import EventInjector
+from tests.utils import setup_test_homeserver
+
+
+class SearchTestCase(unittest.TestCase):
+    """ Tests rank ordered searches. """
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.hs = yield setup_test_homeserver(
+            resource_for_federation=Mock(),
+            http_client=None,
+        )
+        self.store = self.hs.get_datastore()
+        self.event_builder_factory = self.hs.get_event_builder_factory()
+        self.message_handler = self.hs.get_handlers().message_handler
+        self.search_handler = self.hs.get_handlers().search_handler
+        self.event_injector = EventInjector(self.hs)
+
+        self.u_alice = UserID.from_string("@alice:test")
+        self.room = RoomID.from_string("!abc123:test")
+
+        yield self.event_injector.create_room(self.room)
+        yield self.event_injector.inject_room_member(
+            self.room, self.u_alice, Membership.JOIN
+        )
+
+    @defer.inlineCallbacks
+    def inject_message(self, body):
+        builder = self.event_builder_factory.new({
+            "type": EventTypes.Message,
+            "sender": self.u_alice.to_string(),
+            "room_id": self.room.to_string(),
+            "content": {"body": body, "msgtype": u"message"},
+        })
+
+        event, context = yield self.message_handler._create_new_client_event(
+            builder
+        )
+
+        yield self.store.persist_event(event, context)
+
+        defer.returnValue(event)
+
+    def search(self, batch=None):
+        return self.search_handler.search(self.u_alice, {
+            "search_categories": {
+                "room_events": {
+                    "search_term": "raccoon",
+                    "order_by": "rank",
+                    "filter": {"limit": 2},
+                },
+            },
+        }, batch=batch)
+
+    @defer.inlineCallbacks
+    def test_rank_pagination(self):
+        event_ids = set()
+        for i in range(5):
+            event = yield self.inject_message("raccoon %d" % (i,))
+            event_ids.add(event.event_id)
+
+        seen = []
+        batch = None
+        for _ in range(5):
+            result = yield self.search(batch)
+            room_events = result["search_categories"]["room_events"]
+
+            self.assertEquals(room_events["count"], 5)
+            self.assertLessEqual(len(room_events["results"]), 2)
+            seen.extend(r["result"]["event_id"] for r in room_events["results"])
+
+            batch = room_events.get("next_batch")
+            if not batch:
+                break
+
+        self.assertEquals(len(seen), 5)
+        self.assertEquals(set(seen), event_ids)
+
+    @defer.inlineCallbacks
+    def test_rank_no_next_batch_when_exhausted(self):
+        yield self.inject_message("raccoon")
+
+        result = yield self.search()
+        room_events = result["search_categories"]["room_events"]
+
+        self.assertEquals(len(room_events["results"]), 1)
+        self.assertNotIn("next_batch", room_events)
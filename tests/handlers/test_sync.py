@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+from twisted.internet import defer
+
+from synapse.api.constants import EventTypes, Membership
+from synapse.api.filtering import FilterCollection
+from synapse.handlers.sync import SyncConfig
+from synapse.types import UserID, RoomID
+
+from tests.utils import setup_test_homeserver
+
+from mock import Mock
+
+
+class SyncTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver(
+            resource_for_federation=Mock(),
+            http_client=None,
+        )
+
+        self.store = hs.get_datastore()
+        self.event_builder_factory = hs.get_event_builder_factory()
+        self.message_handler = hs.get_handlers().message_handler
+        self.sync_handler = hs.get_sync_handler()
+        self.event_sources = hs.get_event_sources()
+
+        self.u_alice = UserID.from_string("@alice:test")
+        self.room = RoomID.from_string("!abc123:test")
+
+    @defer.inlineCallbacks
+    def inject_event(self, etype, content, state_key=None):
+        event_dict = {
+            "type": etype,
+            "sender": self.u_alice.to_string(),
+            "room_id": self.room.to_string(),
+            "content": content,
+        }
+        if state_key is not None:
+            event_dict["state_key"] = state_key
+
+        builder = self.event_builder_factory.new(event_dict)
+        event, context = yield self.message_handler._create_new_client_event(
+            builder
+        )
+        yield self.store.persist_event(event, context)
+        defer.returnValue(event)
+
+    def sync_config(self, request_key):
+        return SyncConfig(
+            user=self.u_alice,
+            filter_collection=FilterCollection({}),
+            is_guest=False,
+            request_key=request_key,
+        )
+
+    @defer.inlineCallbacks
+    def test_room_sync_shared_between_devices(self):
+        yield self.inject_event(
+            EventTypes.Member, {"membership": Membership.JOIN},
+            state_key=self.u_alice.to_string(),
+        )
+        since_token = yield self.event_sources.get_current_token()
+
+        message = yield self.inject_event(
+            EventTypes.Message, {"body": "hello", "msgtype": "m.text"},
+        )
+
+        calls = []
+        compute = self.sync_handler._compute_room_timeline_and_state
+
+        def counting_compute(*args, **kwargs):
+            calls.append(args)
+            return compute(*args, **kwargs)
+        self.sync_handler._compute_room_timeline_and_state = counting_compute
+
+        results = []
+        for device in ("device1", "device2"):
+            result = yield self.sync_handler.wait_for_sync_for_user(
+                self.sync_config(device), since_token=since_token,
+            )
+            results.append(result)
+
+        self.assertEquals(len(calls), 1)
+
+        for result in results:
+            self.assertEquals(len(result.joined), 1)
+            room = result.joined[0]
+            self.assertEquals(room.room_id, self.room.to_string())
+            self.assertEquals(
+                [e.event_id for e in room.timeline.events], [message.event_id],
+            )
+
+    @defer.inlineCallbacks
+    def test_unchanged_rooms_skipped(self):
+        yield self.inject_event(
+            EventTypes.Member, {"membership": Membership.JOIN},
+            state_key=self.u_alice.to_string(),
+        )
+        since_token = yield self.event_sources.get_current_token()
+
+        generate = self.sync_handler._generate_room_entry
+        self.sync_handler._generate_room_entry = Mock(side_effect=generate)
+
+        result = yield self.sync_handler.wait_for_sync_for_user(
+            self.sync_config("device1"), since_token=since_token,
+        )
+
+        self.assertEquals(result.joined, [])
+        self.assertFalse(self.sync_handler._generate_room_entry.called)
+
+    @defer.inlineCallbacks
+    def test_concurrent_syncs_share_computation(self):
+        yield self.inject_event(
+            EventTypes.Member, {"membership": Membership.JOIN},
+            state_key=self.u_alice.to_string(),
+        )
+        since_token = yield self.event_sources.get_current_token()
+
+        d = defer.Deferred()
+        self.sync_handler.current_sync_for_user = Mock(return_value=d)
+
+        d1 = self.sync_handler.wait_for_sync_for_user(
+            self.sync_config("device1"), since_token=since_token,
+        )
+        d2 = self.sync_handler.wait_for_sync_for_user(
+            self.sync_config("device2"), since_token=since_token,
+        )
+
+        self.assertEquals(self.sync_handler.current_sync_for_user.call_count, 1)
+
+        result = object()
+        d.callback(result)
+
+        self.assertIs((yield d1), result)
+        self.assertIs((yield d2), result)
+
+        # Once the computation has finished new requests start a new one
+        d = defer.Deferred()
+        self.sync_handler.current_sync_for_user.return_value = d
+        self.sync_handler.wait_for_sync_for_user(
+            self.sync_config("device1"), since_token=since_token,
+        )
+        self.assertEquals(self.sync_handler.current_sync_for_user.call_count, 2)
+
+    @defer.inlineCallbacks
+    def test_room_sync_not_shared_after_new_events(self):
+        yield self.inject_event(
+            EventTypes.Member, {"membership": Membership.JOIN},
+            state_key=self.u_alice.to_string(),
+        )
+        since_token = yield self.event_sources.get_current_token()
+
+        message1 = yield self.inject_event(
+            EventTypes.Message, {"body": "one", "msgtype": "m.text"},
+        )
+
+        result = yield self.sync_handler.wait_for_sync_for_user(
+            self.sync_config("device1"), since_token=since_token,
+        )
+        self.assertEquals(
+            [e.event_id for e in result.joined[0].timeline.events],
+            [message1.event_id],
+        )
+
+        message2 = yield self.inject_event(
+            EventTypes.Message, {"body": "two", "msgtype": "m.text"},
+        )
+
+        # A later sync from the same token must not reuse the first device's
+        # batch, or it would skip the second message.
+        result = yield self.sync_handler.wait_for_sync_for_user(
+            self.sync_config("device2"), since_token=since_token,
+        )
+        self.assertEquals(
+            [e.event_id for e in result.joined[0].timeline.events],
+            [message1.event_id, message2.event_id],
+        )
@@ -74,6 +74,7 @@ class TypingNotificationsTestCase(unittest.TestCase):
                 "get_received_txn_response",
                 "set_received_txn_response",
                 "get_destination_retry_timings",
+                "get_destinations_with_federation_queue",
             ]),
             handlers=None,
             notifier=mock_notifier,
@@ -101,6 +102,10 @@ class TypingNotificationsTestCase(unittest.TestCase):
             return defer.succeed(None)
         self.datastore.get_received_txn_response = get_received_txn_response
 
+        self.datastore.get_destinations_with_federation_queue.return_value = (
+            defer.succeed([])
+        )
+
         self.room_id = "a-room"
 
         self.room_members = []
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from .. import unittest
+from twisted.internet import defer
+
+from mock import Mock
+
+from synapse.api.constants import EventTypes
+from synapse.events import FrozenEvent
+from synapse.events.snapshot import EventContext
+from synapse.push.bulk_push_rule_evaluator import RulesForRoom
+
+
+ROOM_ID = "!room:test"
+
+
+def _member(user_id, membership, displayname=None):
+    content = {"membership": membership}
+    if displayname:
+        content["displayname"] = displayname
+    return FrozenEvent({
+        "event_id": "$%s_%s:test" % (user_id, membership),
+        "type": EventTypes.Member,
+        "room_id": ROOM_ID,
+        "sender": user_id,
+        "state_key": user_id,
+        "content": content,
+    })
+
+
+def _context(state_group, members):
+    context = EventContext(current_state={
+        (EventTypes.Member, ev.state_key): ev for ev in members
+    })
+    context.state_group = state_group
+    return context
+
+
+class RulesForRoomTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.store = Mock()
+        self.store.get_pushers_stream_token.return_value = 1
+        self.store.get_push_rules_stream_token.return_value = (1, 10)
+        self.store.get_if_users_have_pushers.side_effect = lambda user_ids: (
+            defer.succeed({u: u == "@alice:test" for u in user_ids})
+        )
+        self.receipts = set(["@bob:test", "@remote:other"])
+        self.store.get_users_with_read_receipts_in_room.side_effect = (
+            lambda room_id: defer.succeed(self.receipts)
+        )
+        self.store.bulk_get_push_rules.side_effect = lambda user_ids: (
+            defer.succeed({u: ["rules for %s" % (u,)] for u in user_ids})
+        )
+
+        hs = Mock()
+        hs.get_datastore.return_value = self.store
+        hs.is_mine_id = lambda user_id: user_id.endswith(":test")
+
+        self.rules_for_room = RulesForRoom(hs, ROOM_ID)
+
+        self.members = [
+            _member("@alice:test", "join", "Alice"),
+            _member("@bob:test", "join"),
+            _member("@carol:test", "join"),
+            _member("@dave:test", "leave"),
+            _member("@remote:other", "join"),
+        ]
+
+    @defer.inlineCallbacks
+    def test_rules_cached_between_events(self):
+        rules = yield self.rules_for_room.get_rules(_context(1, self.members))
+
+        self.assertEquals(set(rules), set(["@alice:test", "@bob:test"]))
+        self.assertEquals(self.rules_for_room.display_names, {
+            "@alice:test": "Alice",
+        })
+        self.assertEquals(self.rules_for_room.joined_member_count, 4)
+
+        yield self.rules_for_room.get_rules(_context(1, self.members))
+        yield self.rules_for_room.get_rules(_context(2, self.members))
+
+        self.assertEquals(self.store.get_if_users_have_pushers.call_count, 1)
+        self.assertEquals(self.store.bulk_get_push_rules.call_count, 1)
+
+    @defer.inlineCallbacks
+    def test_membership_change(self):
+        yield self.rules_for_room.get_rules(_context(1, self.members))
+
+        self.members[2] = _member("@carol:test", "leave")
+        self.receipts = set(["@bob:test", "@carol:test"])
+        rules = yield self.rules_for_room.get_rules(_context(2, self.members))
+
+        self.assertEquals(set(rules), set(["@alice:test", "@bob:test"]))
+        self.assertEquals(self.rules_for_room.joined_member_count, 3)
+        self.assertEquals(self.store.get_if_users_have_pushers.call_count, 2)
+
+        # Only rules for users we didn't already have are fetched
+        self.assertEquals(self.store.bulk_get_push_rules.call_count, 1)
+
+    @defer.inlineCallbacks
+    def test_new_receipt(self):
+        yield self.rules_for_room.get_rules(_context(1, self.members))
+
+        self.receipts = set(["@bob:test", "@carol:test"])
+        rules = yield self.rules_for_room.get_rules(_context(1, self.members))
+
+        self.assertEquals(
+            set(rules), set(["@alice:test", "@bob:test", "@carol:test"])
+        )
+        self.store.bulk_get_push_rules.assert_called_with(["@carol:test"])
+
+    @defer.inlineCallbacks
+    def test_push_rules_change(self):
+        yield self.rules_for_room.get_rules(_context(1, self.members))
+
+        self.store.get_push_rules_stream_token.return_value = (2, 11)
+        rules = yield self.rules_for_room.get_rules(_context(1, self.members))
+
+        self.assertEquals(set(rules), set(["@alice:test", "@bob:test"]))
+        self.assertEquals(self.store.bulk_get_push_rules.call_count, 2)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from .. import unittest
+
+from synapse.events import FrozenEvent
+from synapse.push.baserules import list_with_base_rules
+from synapse.push.push_rule_evaluator import (
+    PushRuleEvaluatorForEvent, compile_push_rules, _glob_matches,
+)
+
+
+def _message(body, sender="@bob:test"):
+    return FrozenEvent({
+        "event_id": "$1:test",
+        "type": "m.room.message",
+        "room_id": "!room:test",
+        "sender": sender,
+        "content": {"msgtype": "m.text", "body": body},
+    })
+
+
+def _first_match(rule_set, evaluator, user_id, display_name=None):
+    for rule in rule_set.candidate_rules(evaluator):
+        if rule.matches_user(evaluator, user_id, display_name):
+            return rule.actions
+    return None
+
+
+class GlobMatchesTestCase(unittest.TestCase):
+
+    def test_glob_matches(self):
+        self.assertTrue(_glob_matches("foo*", "foobar"))
+        self.assertFalse(_glob_matches("foo*", "barfoo"))
+        self.assertTrue(_glob_matches("b?r", "BAR"))
+        self.assertTrue(_glob_matches("[a-c]at", "cat"))
+        self.assertFalse(_glob_matches("[!a-c]at", "cat"))
+        self.assertTrue(_glob_matches("cake", "I like cake!", word_boundary=True))
+        self.assertFalse(_glob_matches("cake", "cupcakes", word_boundary=True))
+        self.assertTrue(_glob_matches("Cake", "cake"))
+        self.assertFalse(_glob_matches("cake", "cakes"))
+
+
+class CompiledPushRulesTestCase(unittest.TestCase):
+
+    def test_base_rules_shared_between_users(self):
+        # The storage layer gives each user their own copy of the base rules
+        rule_set_1 = compile_push_rules(list_with_base_rules([]))
+        rule_set_2 = compile_push_rules(list_with_base_rules([]))
+        self.assertIs(rule_set_1, rule_set_2)
+
+    def test_disabled_rules_not_shared(self):
+        rules = list_with_base_rules([])
+        rules[-1] = dict(rules[-1], enabled=False)
+        self.assertIsNot(
+            compile_push_rules(rules),
+            compile_push_rules(list_with_base_rules([])),
+        )
+
+    def test_rules_indexed_by_event_type(self):
+        rule_set = compile_push_rules(list_with_base_rules([]))
+
+        message_rules = rule_set.rules_for_event_type("m.room.message")
+        call_rules = rule_set.rules_for_event_type("m.call.invite")
+        other_rules = rule_set.rules_for_event_type("com.example.event")
+
+        self.assertTrue(set(other_rules) < set(message_rules))
+        self.assertTrue(set(other_rules) < set(call_rules))
+        self.assertFalse(set(message_rules) & (set(call_rules) - set(other_rules)))
+
+    def test_evaluate(self):
+        rule_set = compile_push_rules(list_with_base_rules([]))
+
+        evaluator = PushRuleEvaluatorForEvent(_message("hello alice"), 5)
+        actions = _first_match(rule_set, evaluator, "@alice:test")
+        self.assertIn({"set_tweak": "highlight"}, actions)
+
+        actions = _first_match(rule_set, evaluator, "@carol:test")
+        self.assertEquals(actions, ["notify", {
+            "set_tweak": "highlight", "value": False,
+        }])
+
+        evaluator = PushRuleEvaluatorForEvent(_message("hi Carol!"), 5)
+        actions = _first_match(rule_set, evaluator, "@carol:test", "carol")
+        self.assertIn({"set_tweak": "highlight"}, actions)
+
+    def test_user_rule(self):
+        user_rules = [{
+            "rule_id": "global/content/cake",
+            "priority_class": 4,
+            "conditions": [{
+                "kind": "event_match", "key": "content.body", "pattern": "cake",
+            }],
+            "actions": ["notify", {"set_tweak": "sound", "value": "cake"}],
+        }]
+        rule_set = compile_push_rules(list_with_base_rules(user_rules))
+
+        evaluator = PushRuleEvaluatorForEvent(_message("Cake time"), 5)
+        actions = _first_match(rule_set, evaluator, "@alice:test")
+        self.assertIn({"set_tweak": "sound", "value": "cake"}, actions)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from .. import unittest
+from twisted.internet import defer
+
+from mock import Mock
+
+from synapse.push.push_tools import BadgeCounter
+
+from collections import namedtuple
+
+
+USER_ID = "@alice:test"
+
+Room = namedtuple("Room", ("room_id",))
+
+
+class BadgeCounterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # room_id -> read receipt event_id
+        self.receipts = {}
+        # room_id -> number of unread notifications
+        self.notify_counts = {}
+        self.joined_room_ids = set()
+        self.invited_room_ids = set()
+
+        self.store = Mock()
+        self.store.get_invited_rooms_for_user.side_effect = lambda user_id: (
+            defer.succeed([Room(r) for r in self.invited_room_ids])
+        )
+        self.store.get_rooms_for_user.side_effect = lambda user_id: (
+            defer.succeed([Room(r) for r in self.joined_room_ids])
+        )
+        self.store.get_receipts_for_user.side_effect = (
+            lambda user_id, receipt_type: defer.succeed(dict(self.receipts))
+        )
+        self.store.get_unread_event_push_actions_by_room_for_user.side_effect = (
+            lambda room_id, user_id, event_id: defer.succeed({
+                "notify_count": self.notify_counts.get(room_id, 0),
+                "highlight_count": 0,
+            })
+        )
+
+        self.counter = BadgeCounter(self.store, USER_ID)
+
+    def recount_calls(self):
+        get_unread = self.store.get_unread_event_push_actions_by_room_for_user
+        return [c[0] for c in get_unread.call_args_list]
+
+    @defer.inlineCallbacks
+    def test_counts_invites_and_unread_rooms(self):
+        self.invited_room_ids = {"!invite:test"}
+        self.joined_room_ids = {"!a:test", "!b:test", "!unread:test"}
+        self.receipts = {"!a:test": "$a", "!unread:test": "$unread"}
+        self.notify_counts = {"!unread:test": 2}
+
+        count = yield self.counter.get_badge_count()
+        self.assertEquals(count, 2)
+
+    @defer.inlineCallbacks
+    def test_unchanged_rooms_not_recounted(self):
+        self.joined_room_ids = {"!a:test"}
+        self.receipts = {"!a:test": "$a"}
+
+        count = yield self.counter.get_badge_count()
+        self.assertEquals(count, 0)
+        self.assertEquals(self.recount_calls(), [("!a:test", USER_ID, "$a")])
+
+        # Notifications that we weren't told about aren't noticed, as the
+        # room isn't recounted until the receipt changes.
+        self.notify_counts = {"!a:test": 1}
+        count = yield self.counter.get_badge_count()
+        self.assertEquals(count, 0)
+        self.assertEquals(len(self.recount_calls()), 1)
+
+    @defer.inlineCallbacks
+    def test_on_notification_marks_room_unread(self):
+        self.joined_room_ids = {"!a:test", "!b:test"}
+        self.receipts = {"!a:test": "$a", "!b:test": "$b"}
+
+        count = yield self.counter.get_badge_count()
+        self.assertEquals(count, 0)
+
+        self.counter.on_notification("!a:test")
+        self.counter.on_notification("!a:test")
+
+        count = yield self.counter.get_badge_count()
+        self.assertEquals(count, 1)
+        self.assertEquals(len(self.recount_calls()), 2)
+
+    @defer.inlineCallbacks
+    def test_on_notification_ignores_rooms_without_receipts(self):
+        self.joined_room_ids = {"!a:test"}
+
+        count = yield self.counter.get_badge_count()
+        self.assertEquals(count, 0)
+
+        self.counter.on_notification("!a:test")
+        self.counter.on_notification("!unknown:test")
+
+        count = yield self.counter.get_badge_count()
+        self.assertEquals(count, 0)
+
+    @defer.inlineCallbacks
+    def test_receipt_change_forces_recount(self):
+        self.joined_room_ids = {"!a:test"}
+        self.receipts = {"!a:test": "$a"}
+
+        yield self.counter.get_badge_count()
+        self.counter.on_notification("!a:test")
+        count = yield self.counter.get_badge_count()
+        self.assertEquals(count, 1)
+
+        # The user reads the room.
+        self.receipts = {"!a:test": "$a2"}
+        count = yield self.counter.get_badge_count()
+        self.assertEquals(count, 0)
+        self.assertEquals(
+            self.recount_calls(),
+            [("!a:test", USER_ID, "$a"), ("!a:test", USER_ID, "$a2")],
+        )
+
+        # A later receipt that still has unread notifications after it.
+        self.receipts = {"!a:test": "$a3"}
+        self.notify_counts = {"!a:test": 1}
+        count = yield self.counter.get_badge_count()
+        self.assertEquals(count, 1)
+
+    @defer.inlineCallbacks
+    def test_leaving_room_drops_it(self):
+        self.joined_room_ids = {"!a:test", "!b:test"}
+        self.receipts = {"!a:test": "$a", "!b:test": "$b"}
+        self.notify_counts = {"!a:test": 1, "!b:test": 1}
+
+        count = yield self.counter.get_badge_count()
+        self.assertEquals(count, 2)
+
+        self.joined_room_ids = {"!b:test"}
+        count = yield self.counter.get_badge_count()
+        self.assertEquals(count, 1)
+        self.assertNotIn("!a:test", self.counter._checked_receipts)
+
+        # Rejoining the room rechecks it from scratch.
+        self.joined_room_ids = {"!a:test", "!b:test"}
+        self.notify_counts = {"!b:test": 1}
+        count = yield self.counter.get_badge_count()
+        self.assertEquals(count, 1)
+        self.assertEquals(self.recount_calls()[-1], ("!a:test", USER_ID, "$a"))
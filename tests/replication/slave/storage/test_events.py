@@ -28,8 +28,20 @@ OUTLIER = {"outlier": True}
 ROOM_ID = "!room:blue"
 
 
+def _attributes(obj):
+    if hasattr(obj, "__dict__"):
+        return obj.__dict__
+
+    # Events and their internal metadata use __slots__
+    return {
+        name: getattr(obj, name, None)
+        for cls in type(obj).__mro__
+        for name in getattr(cls, "__slots__", [])
+    }
+
+
 def dict_equals(self, other):
-    return self.__dict__ == other.__dict__
+    return _attributes(self) == _attributes(other)
 
 
 def patch__eq__(cls):
@@ -208,6 +220,47 @@ class SlavedEventStoreTestCase(BaseSlavedStoreTestCase):
             [join3]
         )
 
+    @defer.inlineCallbacks
+    def test_get_state_for_events(self):
+        create = yield self.persist(
+            type="m.room.create", key="", creator=USER_ID, state={},
+        )
+        join = yield self.persist(
+            type="m.room.member", key=USER_ID, membership="join",
+            state={("m.room.create", ""): create},
+        )
+        yield self.replicate()
+        yield self.check("get_state_for_events", ([join.event_id], None), {
+            join.event_id: {
+                ("m.room.create", ""): create,
+                ("m.room.member", USER_ID): join,
+            },
+        })
+
+    @defer.inlineCallbacks
+    def test_federation_reads(self):
+        create = yield self.persist(type="m.room.create", key="", creator=USER_ID)
+        join = yield self.persist(
+            type="m.room.member", key=USER_ID, membership="join",
+            prev_events=[(create.event_id, {})],
+            auth_events=[(create.event_id, {})],
+        )
+        msg = yield self.persist(
+            type="m.room.message", msgtype="m.text", body="Hello",
+            prev_events=[(join.event_id, {})],
+            auth_events=[(create.event_id, {}), (join.event_id, {})],
+        )
+        yield self.replicate()
+        yield self.check("get_auth_chain", ([join.event_id],), [create])
+        yield self.check(
+            "get_backfill_events", (ROOM_ID, [msg.event_id], 10),
+            [msg, join, create]
+        )
+        yield self.check(
+            "get_missing_events", (ROOM_ID, [create.event_id], [msg.event_id], 10, 0),
+            [join]
+        )
+
     @defer.inlineCallbacks
     def test_redactions(self):
         yield self.persist(type="m.room.create", key="", creator=USER_ID)
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+from twisted.internet import defer
+from twisted.web.test.requesthelper import DummyRequest
+
+from synapse.rest.media.v1._base import (
+    _etag_matches, _parse_range, _UnsatisfiableRange, respond_with_file,
+)
+
+import os
+import shutil
+import tempfile
+
+
+ETAG = b'"abc"'
+
+
+class ParseRangeTestCase(unittest.TestCase):
+
+    def test_no_range(self):
+        self.assertEquals(_parse_range(None, 100), None)
+        self.assertEquals(_parse_range(b"", 100), None)
+
+    def test_range(self):
+        self.assertEquals(_parse_range(b"bytes=0-9", 100), (0, 9))
+        self.assertEquals(_parse_range(b"bytes=10-", 100), (10, 99))
+        self.assertEquals(_parse_range(b"bytes=99-99", 100), (99, 99))
+
+    def test_end_past_file_size(self):
+        self.assertEquals(_parse_range(b"bytes=90-200", 100), (90, 99))
+
+    def test_suffix_range(self):
+        self.assertEquals(_parse_range(b"bytes=-10", 100), (90, 99))
+        self.assertEquals(_parse_range(b"bytes=-200", 100), (0, 99))
+
+    def test_empty_suffix_range(self):
+        with self.assertRaises(_UnsatisfiableRange):
+            _parse_range(b"bytes=-0", 100)
+
+    def test_start_past_file_size(self):
+        with self.assertRaises(_UnsatisfiableRange):
+            _parse_range(b"bytes=100-", 100)
+        with self.assertRaises(_UnsatisfiableRange):
+            _parse_range(b"bytes=150-200", 100)
+
+    def test_end_before_start(self):
+        self.assertEquals(_parse_range(b"bytes=10-5", 100), None)
+
+    def test_multiple_ranges(self):
+        self.assertEquals(_parse_range(b"bytes=0-9,20-29", 100), None)
+
+    def test_malformed(self):
+        self.assertEquals(_parse_range(b"items=0-9", 100), None)
+        self.assertEquals(_parse_range(b"bytes=-", 100), None)
+        self.assertEquals(_parse_range(b"bytes=a-b", 100), None)
+        self.assertEquals(_parse_range(b"bytes", 100), None)
+
+
+class EtagMatchesTestCase(unittest.TestCase):
+
+    def test_no_header(self):
+        self.assertFalse(_etag_matches(None, ETAG))
+        self.assertFalse(_etag_matches(b"", ETAG))
+
+    def test_matches(self):
+        self.assertTrue(_etag_matches(ETAG, ETAG))
+        self.assertTrue(_etag_matches(b'"xyz", "abc"', ETAG))
+        self.assertTrue(_etag_matches(b"*", ETAG))
+
+    def test_weak_etag(self):
+        self.assertTrue(_etag_matches(b'W/"abc"', ETAG))
+        self.assertTrue(_etag_matches(b'"xyz", W/"abc"', ETAG))
+
+    def test_no_match(self):
+        self.assertFalse(_etag_matches(b'"xyz"', ETAG))
+        self.assertFalse(_etag_matches(b'W/"xyz"', ETAG))
+        self.assertFalse(_etag_matches(b'abc', ETAG))
+
+
+class RespondWithFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.temp_dir, "media")
+        self.content = b"".join(chr(ord(b"a") + i % 26) for i in range(100))
+        with open(self.file_path, "wb") as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    @defer.inlineCallbacks
+    def respond(self, headers):
+        request = DummyRequest([])
+        for name, value in headers.items():
+            request.requestHeaders.setRawHeaders(name, [value])
+
+        yield respond_with_file(
+            request, "text/plain", self.file_path, etag="abc",
+        )
+
+        defer.returnValue(request)
+
+    def header(self, request, name):
+        values = request.responseHeaders.getRawHeaders(name)
+        return values[0] if values else None
+
+    @defer.inlineCallbacks
+    def test_whole_file(self):
+        request = yield self.respond({})
+
+        self.assertEquals(request.responseCode, None)  # i.e. 200
+        self.assertEquals(b"".join(request.written), self.content)
+        self.assertEquals(self.header(request, b"ETag"), ETAG)
+        self.assertEquals(self.header(request, b"Content-Length"), b"100")
+
+    @defer.inlineCallbacks
+    def test_range(self):
+        request = yield self.respond({b"Range": b"bytes=10-19"})
+
+        self.assertEquals(request.responseCode, 206)
+        self.assertEquals(b"".join(request.written), self.content[10:20])
+        self.assertEquals(
+            self.header(request, b"Content-Range"), b"bytes 10-19/100"
+        )
+        self.assertEquals(self.header(request, b"Content-Length"), b"10")
+
+    @defer.inlineCallbacks
+    def test_suffix_range(self):
+        request = yield self.respond({b"Range": b"bytes=-5"})
+
+        self.assertEquals(request.responseCode, 206)
+        self.assertEquals(b"".join(request.written), self.content[95:])
+        self.assertEquals(
+            self.header(request, b"Content-Range"), b"bytes 95-99/100"
+        )
+
+    @defer.inlineCallbacks
+    def test_unsatisfiable_range(self):
+        request = yield self.respond({b"Range": b"bytes=100-"})
+
+        self.assertEquals(request.responseCode, 416)
+        self.assertEquals(b"".join(request.written), b"")
+        self.assertEquals(self.header(request, b"Content-Range"), b"bytes */100")
+
+    @defer.inlineCallbacks
+    def test_multiple_ranges_sends_whole_file(self):
+        request = yield self.respond({b"Range": b"bytes=0-9,20-29"})
+
+        self.assertEquals(request.responseCode, None)
+        self.assertEquals(b"".join(request.written), self.content)
+
+    @defer.inlineCallbacks
+    def test_if_range_matches(self):
+        request = yield self.respond({
+            b"Range": b"bytes=10-19",
+            b"If-Range": ETAG,
+        })
+
+        self.assertEquals(request.responseCode, 206)
+        self.assertEquals(b"".join(request.written), self.content[10:20])
+
+    @defer.inlineCallbacks
+    def test_if_range_mismatch_sends_whole_file(self):
+        request = yield self.respond({
+            b"Range": b"bytes=10-19",
+            b"If-Range": b'"xyz"',
+        })
+
+        self.assertEquals(request.responseCode, None)
+        self.assertEquals(b"".join(request.written), self.content)
+        self.assertEquals(self.header(request, b"Content-Range"), None)
+
+    @defer.inlineCallbacks
+    def test_if_none_match(self):
+        request = yield self.respond({b"If-None-Match": b'W/"abc"'})
+
+        self.assertEquals(request.responseCode, 304)
+        self.assertEquals(b"".join(request.written), b"")
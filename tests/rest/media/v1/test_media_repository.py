@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+from twisted.internet import defer
+
+from synapse.config.repository import parse_thumbnail_requirements
+from synapse.rest.media.v1 import media_repository
+from synapse.rest.media.v1.filepath import MediaFilePaths
+from synapse.rest.media.v1.media_repository import MediaRepository
+from synapse.types import UserID
+
+from tests.utils import setup_test_homeserver
+
+from mock import Mock, patch
+from StringIO import StringIO
+
+import PIL.Image as Image
+
+import os
+import shutil
+import tempfile
+
+
+class MediaRepositoryTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.media_store_path = tempfile.mkdtemp()
+
+        self.hs = yield setup_test_homeserver(
+            http_client=None, tls_server_context_factory=Mock(),
+        )
+        self.hs.config.max_upload_size = 1024 * 1024
+        self.hs.config.max_image_pixels = 1024 * 1024
+        self.hs.config.dynamic_thumbnails = False
+        self.hs.config.thumbnail_requirements = parse_thumbnail_requirements([
+            {"width": 32, "height": 32, "method": "crop"},
+            {"width": 64, "height": 64, "method": "scale"},
+        ])
+        self.hs.config.max_remote_media_cache_size = 0
+
+        self.filepaths = MediaFilePaths(self.media_store_path)
+        self.media_repo = MediaRepository(self.hs, self.filepaths)
+
+    def tearDown(self):
+        shutil.rmtree(self.media_store_path)
+
+    def png(self, width=128, height=96):
+        output = StringIO()
+        Image.new("RGB", (width, height), "red").save(output, "PNG")
+        return output.getvalue()
+
+    @defer.inlineCallbacks
+    def upload(self, content):
+        mxc = yield self.media_repo.create_content(
+            "image/png", "test.png", StringIO(content), len(content),
+            UserID.from_string("@a:test"),
+        )
+        defer.returnValue(mxc.rsplit("/", 1)[1])
+
+    def write_local_content(self, media_id, content):
+        fname = self.filepaths.local_media_filepath(media_id)
+        self.media_repo._makedirs(fname)
+        length = self.media_repo._write_local_content(StringIO(content), fname)
+        self.assertEquals(length, len(content))
+        return fname
+
+    def test_identical_uploads_share_file(self):
+        fname1 = self.write_local_content("aaaaaaaaaa", "some content")
+        fname2 = self.write_local_content("bbbbbbbbbb", "some content")
+        fname3 = self.write_local_content("cccccccccc", "other content")
+
+        for fname, content in (
+            (fname1, "some content"),
+            (fname2, "some content"),
+            (fname3, "other content"),
+        ):
+            with open(fname) as f:
+                self.assertEquals(f.read(), content)
+
+        # The identical uploads are links to the same file, the different one
+        # isn't.
+        self.assertTrue(os.path.samefile(fname1, fname2))
+        self.assertFalse(os.path.samefile(fname1, fname3))
+        self.assertEquals(os.stat(fname1).st_nlink, 3)
+
+        # Nothing is left behind in the temporary directory.
+        self.assertEquals(os.listdir(self.filepaths.upload_temp_dir()), [])
+
+    def test_link_failure_falls_back_to_copy(self):
+        fname1 = self.write_local_content("aaaaaaaaaa", "some content")
+
+        with patch("os.link", side_effect=OSError("Not supported")):
+            fname2 = self.write_local_content("bbbbbbbbbb", "some content")
+
+        with open(fname2) as f:
+            self.assertEquals(f.read(), "some content")
+
+        self.assertFalse(os.path.samefile(fname1, fname2))
+        self.assertEquals(os.listdir(self.filepaths.upload_temp_dir()), [])
+
+    @defer.inlineCallbacks
+    def test_upload_returns_before_thumbnails(self):
+        thumbnails_done = defer.Deferred()
+        self.media_repo._generate_local_thumbnails = Mock(
+            return_value=thumbnails_done
+        )
+
+        media_id = yield self.upload(self.png())
+
+        self.media_repo._generate_local_thumbnails.assert_called_once_with(
+            media_id, {"media_type": "image/png", "media_length": len(self.png())},
+        )
+
+        waiting = self.media_repo.wait_for_thumbnails(None, media_id)
+        self.assertFalse(waiting.called)
+
+        thumbnails_done.callback(None)
+        self.assertTrue(waiting.called)
+        self.assertEquals(self.media_repo._thumbnail_jobs, {})
+
+    @defer.inlineCallbacks
+    def test_thumbnails_generated(self):
+        media_id = yield self.upload(self.png())
+
+        yield self.media_repo.wait_for_thumbnails(None, media_id)
+
+        thumbnails = yield self.hs.get_datastore().get_local_media_thumbnails(
+            media_id
+        )
+        self.assertEquals(
+            sorted(
+                (t["thumbnail_width"], t["thumbnail_height"], t["thumbnail_method"])
+                for t in thumbnails
+            ),
+            [(32, 32, "crop"), (64, 48, "scale")],
+        )
+
+        for t in thumbnails:
+            t_path = self.filepaths.local_media_thumbnail(
+                media_id, t["thumbnail_width"], t["thumbnail_height"],
+                t["thumbnail_type"], t["thumbnail_method"],
+            )
+            self.assertEquals(
+                Image.open(t_path).size,
+                (t["thumbnail_width"], t["thumbnail_height"]),
+            )
+
+    def test_wait_for_thumbnails_runs_queued_job(self):
+        running = []
+        for i in range(media_repository.MAX_CONCURRENT_THUMBNAIL_JOBS):
+            job = Mock(return_value=defer.Deferred())
+            self.media_repo._queue_thumbnail_job(None, "running%d" % (i,), job)
+            running.append(job)
+
+        queued = Mock(return_value=defer.Deferred())
+        self.media_repo._queue_thumbnail_job(None, "queued", queued)
+
+        for job in running:
+            self.assertTrue(job.called)
+        self.assertFalse(queued.called)
+
+        waiting = self.media_repo.wait_for_thumbnails(None, "queued")
+
+        # The job was started straight away, rather than waiting for one of
+        # the running jobs to finish.
+        self.assertTrue(queued.called)
+        self.assertEquals(self.media_repo._queued_thumbnail_jobs, {})
+        self.assertFalse(waiting.called)
+
+        queued.return_value.callback(None)
+        self.assertTrue(waiting.called)
+
+    def test_queued_jobs_start_when_running_jobs_finish(self):
+        running = []
+        for i in range(media_repository.MAX_CONCURRENT_THUMBNAIL_JOBS):
+            job = Mock(return_value=defer.Deferred())
+            self.media_repo._queue_thumbnail_job(None, "running%d" % (i,), job)
+            running.append(job)
+
+        queued = Mock(return_value=defer.Deferred())
+        self.media_repo._queue_thumbnail_job(None, "queued", queued)
+        self.assertFalse(queued.called)
+
+        running[0].return_value.callback(None)
+        self.assertTrue(queued.called)
+
+    def test_wait_for_thumbnails_without_job(self):
+        self.assertTrue(
+            self.media_repo.wait_for_thumbnails(None, "unknown").called
+        )
+
+    @defer.inlineCallbacks
+    def test_generate_missing_thumbnails(self):
+        # Media whose thumbnail job never ran, e.g. because we restarted.
+        content = self.png()
+        self.write_local_content("missing", content)
+        store = self.hs.get_datastore()
+        yield store.store_local_media(
+            media_id="missing",
+            media_type="image/png",
+            time_now_ms=0,
+            upload_name=None,
+            media_length=len(content),
+            user_id=UserID.from_string("@a:test"),
+        )
+        media_info = yield store.get_local_media("missing")
+
+        yield self.media_repo.wait_for_thumbnails(None, "missing")
+        thumbnails = yield store.get_local_media_thumbnails("missing")
+        self.assertEquals(thumbnails, [])
+
+        yield self.media_repo.generate_missing_thumbnails(
+            None, "missing", media_info,
+        )
+        thumbnails = yield store.get_local_media_thumbnails("missing")
+        self.assertEquals(
+            sorted(
+                (t["thumbnail_width"], t["thumbnail_height"], t["thumbnail_method"])
+                for t in thumbnails
+            ),
+            [(32, 32, "crop"), (64, 48, "scale")],
+        )
+
+    def test_generate_missing_thumbnails_waits_for_pending_job(self):
+        job = Mock(return_value=defer.Deferred())
+        self.media_repo._queue_thumbnail_job(None, "pending", job)
+
+        self.media_repo._generate_local_thumbnails = Mock()
+        waiting = self.media_repo.generate_missing_thumbnails(
+            None, "pending", {"media_type": "image/png"},
+        )
+
+        # The pending job is reused rather than queueing another one.
+        self.assertFalse(self.media_repo._generate_local_thumbnails.called)
+        self.assertFalse(waiting.called)
+
+        job.return_value.callback(None)
+        self.assertTrue(waiting.called)
+
+    @defer.inlineCallbacks
+    def store_remote_media(self, media_id, length, time_now_ms):
+        store = self.hs.get_datastore()
+        file_id = "file_" + media_id
+
+        yield store.store_cached_remote_media(
+            origin="remote",
+            media_id=media_id,
+            media_type="image/png",
+            media_length=length,
+            time_now_ms=time_now_ms,
+            upload_name=None,
+            filesystem_id=file_id,
+        )
+        yield store.store_remote_media_thumbnail(
+            "remote", media_id, file_id, 32, 32, "image/png", "scale", 10,
+        )
+
+        fname = self.filepaths.remote_media_filepath("remote", file_id)
+        self.media_repo._makedirs(fname)
+        with open(fname, "wb") as f:
+            f.write("x" * length)
+
+        t_path = self.filepaths.remote_media_thumbnail(
+            "remote", file_id, 32, 32, "image/png", "scale"
+        )
+        self.media_repo._makedirs(t_path)
+        with open(t_path, "wb") as f:
+            f.write("x" * 10)
+
+        defer.returnValue(fname)
+
+    @defer.inlineCallbacks
+    def remote_media_ids(self):
+        lru = yield self.hs.get_datastore().get_least_recently_used_remote_media(
+            100
+        )
+        defer.returnValue([m["media_id"] for m in lru])
+
+    @defer.inlineCallbacks
+    def test_evict_least_recently_used(self):
+        fname_a = yield self.store_remote_media("a", 100, 1000)
+        fname_b = yield self.store_remote_media("b", 100, 2000)
+        fname_c = yield self.store_remote_media("c", 100, 3000)
+
+        # Evicting "a" is enough to bring the cache down to size.
+        self.media_repo.max_remote_media_cache_size = 250
+        yield self.media_repo._evict_remote_media()
+
+        media_ids = yield self.remote_media_ids()
+        self.assertEquals(media_ids, ["b", "c"])
+
+        self.assertFalse(os.path.exists(fname_a))
+        self.assertFalse(os.path.exists(
+            self.filepaths.remote_media_thumbnail_dir("remote", "file_a")
+        ))
+        self.assertTrue(os.path.exists(fname_b))
+        self.assertTrue(os.path.exists(fname_c))
+
+    @defer.inlineCallbacks
+    def test_evict_skips_media_in_use(self):
+        yield self.store_remote_media("downloading", 100, 1000)
+        yield self.store_remote_media("thumbnailing", 100, 2000)
+        yield self.store_remote_media("accessed", 100, 3000)
+        yield self.store_remote_media("unused", 100, 4000)
+
+        self.media_repo.downloads[("remote", "downloading")] = Mock()
+        self.media_repo._thumbnail_jobs[("remote", "thumbnailing")] = Mock()
+        self.media_repo.recently_accessed_remotes.add(("remote", "accessed"))
+
+        self.media_repo.max_remote_media_cache_size = 1
+        yield self.media_repo._evict_remote_media()
+
+        # Only the unused media was evicted, even though the cache is still
+        # too large.
+        media_ids = yield self.remote_media_ids()
+        self.assertEquals(media_ids, ["downloading", "thumbnailing", "accessed"])
+
+    @defer.inlineCallbacks
+    def test_recently_accessed_remotes_written(self):
+        yield self.store_remote_media("a", 100, 1000)
+        yield self.store_remote_media("b", 100, 2000)
+
+        self.media_repo.recently_accessed_remotes.add(("remote", "a"))
+        yield self.media_repo._update_recently_accessed_remotes()
+
+        self.assertEquals(self.media_repo.recently_accessed_remotes, set())
+
+        media_ids = yield self.remote_media_ids()
+        self.assertEquals(media_ids, ["b", "a"])
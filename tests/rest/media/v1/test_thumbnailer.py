@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+
+from synapse.rest.media.v1.thumbnailer import Thumbnailer
+
+from mock import Mock
+
+import PIL.Image as Image
+
+import os
+import shutil
+import tempfile
+
+
+class ThumbnailerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def make_image(self, width, height, image_format):
+        path = os.path.join(self.temp_dir, "input")
+        Image.new("RGB", (width, height), "red").save(path, image_format)
+        return Thumbnailer(path)
+
+    def spy_on_resize(self, image):
+        image.resize = Mock(wraps=image.resize)
+        return image.resize
+
+    def test_smaller_thumbnails_scaled_from_larger(self):
+        thumbnailer = self.make_image(800, 600, "PNG")
+        original_resize = self.spy_on_resize(thumbnailer.image)
+
+        output_path = os.path.join(self.temp_dir, "output")
+
+        thumbnailer.scale(output_path, 400, 300, "image/png")
+        self.assertEquals(original_resize.call_count, 1)
+        self.assertEquals(Image.open(output_path).size, (400, 300))
+
+        scaled, = thumbnailer._scaled_images
+        scaled_resize = self.spy_on_resize(scaled)
+
+        thumbnailer.crop(output_path, 32, 32, "image/png")
+        self.assertEquals(Image.open(output_path).size, (32, 32))
+
+        # The crop was scaled from the 400x300 image, not the original.
+        self.assertEquals(original_resize.call_count, 1)
+        self.assertEquals(scaled_resize.call_count, 1)
+
+    def test_larger_thumbnails_not_scaled_from_smaller(self):
+        thumbnailer = self.make_image(800, 600, "PNG")
+        original_resize = self.spy_on_resize(thumbnailer.image)
+
+        output_path = os.path.join(self.temp_dir, "output")
+
+        thumbnailer.scale(output_path, 40, 30, "image/png")
+        thumbnailer.scale(output_path, 400, 300, "image/png")
+
+        self.assertEquals(original_resize.call_count, 2)
+        self.assertEquals(Image.open(output_path).size, (400, 300))
+
+    def test_draft_decodes_jpeg_at_smaller_size(self):
+        thumbnailer = self.make_image(800, 600, "JPEG")
+        thumbnailer.draft(100, 75)
+
+        # The decoder downscales while decoding, but the thumbnailer still
+        # knows the size of the original image.
+        width, height = thumbnailer.image.size
+        self.assertLess(width, 800)
+        self.assertGreaterEqual(width, 100)
+        self.assertGreaterEqual(height, 75)
+        self.assertEquals((thumbnailer.width, thumbnailer.height), (800, 600))
+
+        output_path = os.path.join(self.temp_dir, "output")
+        thumbnailer.scale(output_path, 100, 75, "image/jpeg")
+        self.assertEquals(Image.open(output_path).size, (100, 75))
+
+    def test_draft_ignored_for_png(self):
+        thumbnailer = self.make_image(800, 600, "PNG")
+        thumbnailer.draft(100, 75)
+
+        self.assertEquals(thumbnailer.image.size, (800, 600))
@@ -19,7 +19,7 @@ from twisted.internet import defer
 
 from synapse.util.async import ObservableDeferred
 
-from synapse.util.caches.descriptors import Cache, cached
+from synapse.util.caches.descriptors import Cache, cached, cachedList
 
 
 class CacheTestCase(unittest.TestCase):
@@ -199,3 +199,53 @@ class CacheDecoratorTestCase(unittest.TestCase):
 
         self.assertEquals(a.func("foo").result, d.result)
         self.assertEquals(callcount[0], 0)
+
+    @defer.inlineCallbacks
+    def test_keyword_args(self):
+        callcount = [0]
+
+        class A(object):
+            @cached(num_args=2)
+            def func(self, key, other="bar"):
+                callcount[0] += 1
+                return key + other
+
+        a = A()
+
+        self.assertEquals((yield a.func("foo")), "foobar")
+        self.assertEquals(callcount[0], 1)
+
+        # All of these should resolve to the same cache key
+        self.assertEquals((yield a.func("foo", "bar")), "foobar")
+        self.assertEquals((yield a.func("foo", other="bar")), "foobar")
+        self.assertEquals((yield a.func(key="foo", other="bar")), "foobar")
+        self.assertEquals(callcount[0], 1)
+
+        a.func.invalidate(("foo", "bar"))
+        self.assertEquals((yield a.func(other="bar", key="foo")), "foobar")
+        self.assertEquals(callcount[0], 2)
+
+    @defer.inlineCallbacks
+    def test_cached_list(self):
+        calls = []
+
+        class A(object):
+            @cached(num_args=2)
+            def func(self, prefix, key):
+                raise NotImplementedError()
+
+            @cachedList(cached_method_name="func", list_name="keys", num_args=2)
+            def batch_func(self, prefix, keys):
+                calls.append(list(keys))
+                return {k: prefix + k for k in keys}
+
+        a = A()
+
+        res = yield a.batch_func("x", ["a", "b"])
+        self.assertEquals(res, {"a": "xa", "b": "xb"})
+
+        res = yield a.batch_func("x", keys=["a", "c"])
+        self.assertEquals(res, {"a": "xa", "c": "xc"})
+
+        self.assertEquals(calls, [["a", "b"], ["c"]])
+        self.assertEquals((yield a.func("x", "c")), "xc")
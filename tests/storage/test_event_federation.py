@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+from twisted.internet import defer
+
+from synapse.api.constants import EventTypes, Membership
+from synapse.types import UserID, RoomID
+
+from tests.utils import setup_test_homeserver
+
+from mock import Mock
+
+
+class AuthChainIndexTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver(
+            resource_for_federation=Mock(),
+            http_client=None,
+        )
+
+        self.store = hs.get_datastore()
+        self.event_builder_factory = hs.get_event_builder_factory()
+        self.message_handler = hs.get_handlers().message_handler
+
+        self.room = RoomID.from_string("!abc123:test")
+        self.creator = UserID.from_string("@creator:test")
+
+    @defer.inlineCallbacks
+    def inject_state_event(self, etype, sender, state_key, content):
+        builder = self.event_builder_factory.new({
+            "type": etype,
+            "sender": sender.to_string(),
+            "state_key": state_key,
+            "room_id": self.room.to_string(),
+            "content": content,
+        })
+
+        event, context = yield self.message_handler._create_new_client_event(
+            builder
+        )
+
+        yield self.store.persist_event(event, context)
+
+        defer.returnValue(event)
+
+    @defer.inlineCallbacks
+    def create_room(self, members):
+        events = []
+        event = yield self.inject_state_event(
+            EventTypes.Create, self.creator, "", {"creator": self.creator.to_string()}
+        )
+        events.append(event)
+
+        event = yield self.inject_state_event(
+            EventTypes.Member, self.creator, self.creator.to_string(),
+            {"membership": Membership.JOIN},
+        )
+        events.append(event)
+
+        event = yield self.inject_state_event(
+            EventTypes.JoinRules, self.creator, "", {"join_rule": "public"},
+        )
+        events.append(event)
+
+        for i in range(members):
+            user = UserID.from_string("@user%d:test" % (i,))
+            event = yield self.inject_state_event(
+                EventTypes.Member, user, user.to_string(),
+                {"membership": Membership.JOIN},
+            )
+            events.append(event)
+
+        defer.returnValue(events)
+
+    def walk_auth_chain(self, event_ids):
+        return self.store.runInteraction(
+            "walk_auth_chain", self.store._walk_auth_chain_ids_txn, event_ids,
+        )
+
+    def clear_index(self):
+        def f(txn):
+            txn.execute("DELETE FROM event_auth_chains")
+        return self.store.runInteraction("clear_index", f)
+
+    def get_indexed(self):
+        def f(txn):
+            txn.execute("SELECT DISTINCT event_id FROM event_auth_chains")
+            return set(r[0] for r in txn.fetchall())
+        return self.store.runInteraction("get_indexed", f)
+
+    def get_pending(self):
+        def f(txn):
+            txn.execute("SELECT event_id FROM event_auth_chains_pending")
+            return set(r[0] for r in txn.fetchall())
+        return self.store.runInteraction("get_pending", f)
+
+    @defer.inlineCallbacks
+    def test_auth_chain_matches_walk(self):
+        events = yield self.create_room(3)
+        event_ids = [events[-1].event_id]
+
+        chain = yield self.store.get_auth_chain_ids(event_ids)
+        walked = yield self.walk_auth_chain(event_ids)
+
+        self.assertEquals(set(chain), walked)
+        self.assertIn(events[0].event_id, chain)
+        self.assertIn(events[1].event_id, chain)
+        self.assertNotIn(events[-1].event_id, chain)
+
+    @defer.inlineCallbacks
+    def test_unindexed_events(self):
+        events = yield self.create_room(3)
+        event_ids = [e.event_id for e in events[-2:]]
+        walked = yield self.walk_auth_chain(event_ids)
+
+        yield self.clear_index()
+
+        chain = yield self.store.get_auth_chain_ids(event_ids)
+        self.assertEquals(set(chain), walked)
+
+        # New events whose auth events aren't indexed are queued rather than
+        # walked while persisting, and then indexed in the background.
+        walk = Mock(side_effect=self.store._walk_auth_chain_ids_txn)
+        self.store._walk_auth_chain_ids_txn = walk
+        event = yield self.inject_state_event(
+            EventTypes.Topic, self.creator, "", {"topic": "hello"},
+        )
+        self.assertFalse(walk.called)
+
+        pending = yield self.get_pending()
+        self.assertEquals(pending, set([event.event_id]))
+
+        yield self.store._index_pending_auth_chains()
+
+        pending = yield self.get_pending()
+        self.assertEquals(pending, set())
+
+        event_ids = [event.event_id]
+        indexed = yield self.get_indexed()
+        self.assertIn(event.event_id, indexed)
+
+        walked = yield self.walk_auth_chain(event_ids)
+        chain = yield self.store.get_auth_chain_ids(event_ids)
+        self.assertEquals(set(chain), walked)
+
+    @defer.inlineCallbacks
+    def test_incomplete_auth_chain(self):
+        events = yield self.create_room(1)
+
+        # Pretend we never got the create event.
+        def f(txn):
+            txn.execute("DELETE FROM events WHERE event_id = ?", (events[0].event_id,))
+        yield self.store.runInteraction("delete_create", f)
+        yield self.clear_index()
+
+        event = yield self.inject_state_event(
+            EventTypes.Topic, self.creator, "", {"topic": "hello"},
+        )
+
+        # The event can't be indexed, and is dropped from the queue so that
+        # we don't keep walking its auth chain.
+        yield self.store._index_pending_auth_chains()
+        pending = yield self.get_pending()
+        self.assertEquals(pending, set())
+        indexed = yield self.get_indexed()
+        self.assertNotIn(event.event_id, indexed)
+
+        event_ids = [event.event_id]
+        walked = yield self.walk_auth_chain(event_ids)
+        chain = yield self.store.get_auth_chain_ids(event_ids)
+        self.assertEquals(set(chain), walked)
+        self.assertIn(events[0].event_id, chain)
+
+    @defer.inlineCallbacks
+    def test_background_update(self):
+        events = yield self.create_room(3)
+        event_ids = [e.event_id for e in events]
+        yield self.clear_index()
+
+        progress = {
+            "min_stream_id_inclusive": 0,
+            "max_stream_id_exclusive": events[-1].internal_metadata.stream_ordering + 1,
+        }
+        yield self.store.start_background_update("event_auth_chains", progress)
+        yield self.store._background_index_auth_chains(progress, 100)
+
+        indexed = yield self.get_indexed()
+
+        self.assertEquals(indexed, set(event_ids))
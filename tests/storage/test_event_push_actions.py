@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+from twisted.internet import defer
+
+from synapse.api.constants import EventTypes
+from synapse.types import RoomID, UserID
+
+from tests.storage.event_injector import EventInjector
+from tests.utils import setup_test_homeserver
+
+from mock import Mock
+
+
+NOTIFY = ["notify"]
+HIGHLIGHT = ["notify", {"set_tweak": "highlight"}]
+
+
+class EventPushSummaryTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.hs = yield setup_test_homeserver(
+            resource_for_federation=Mock(),
+            http_client=None,
+        )
+        self.store = self.hs.get_datastore()
+        self.event_builder_factory = self.hs.get_event_builder_factory()
+        self.message_handler = self.hs.get_handlers().message_handler
+
+        self.u_alice = UserID.from_string("@alice:test")
+        self.u_bob = UserID.from_string("@bob:test")
+        self.room = RoomID.from_string("!abc123:test")
+
+        yield EventInjector(self.hs).create_room(self.room)
+
+    @defer.inlineCallbacks
+    def inject_message(self, actions=None):
+        """Persists a message from bob, with the given push actions for alice.
+        """
+        builder = self.event_builder_factory.new({
+            "type": EventTypes.Message,
+            "sender": self.u_bob.to_string(),
+            "room_id": self.room.to_string(),
+            "content": {"body": "hello", "msgtype": u"message"},
+        })
+
+        event, context = yield self.message_handler._create_new_client_event(
+            builder
+        )
+
+        yield self.store.persist_event(event, context)
+
+        if actions is not None:
+            yield self.set_push_actions(event, actions)
+
+        defer.returnValue(event)
+
+    def set_push_actions(self, event, actions):
+        return self.store.runInteraction(
+            "set_push_actions",
+            self.store._set_push_actions_for_event_and_users_txn,
+            event, [(self.u_alice.to_string(), actions)],
+        )
+
+    def send_receipt(self, event):
+        return self.store.insert_receipt(
+            self.room.to_string(), "m.read", self.u_alice.to_string(),
+            [event.event_id], {},
+        )
+
+    def get_counts(self, event):
+        return self.store.get_unread_event_push_actions_by_room_for_user(
+            self.room.to_string(), self.u_alice.to_string(), event.event_id,
+        )
+
+    def get_summary(self):
+        return self.store._simple_select_one(
+            table="event_push_summary",
+            keyvalues={
+                "user_id": self.u_alice.to_string(),
+                "room_id": self.room.to_string(),
+            },
+            retcols=("last_read_event_id", "notif_count", "highlight_count"),
+            allow_none=True,
+        )
+
+    @defer.inlineCallbacks
+    def test_falls_back_to_counting_without_summary(self):
+        e1 = yield self.inject_message()
+        yield self.inject_message(NOTIFY)
+        yield self.inject_message(HIGHLIGHT)
+
+        summary = yield self.get_summary()
+        self.assertIsNone(summary)
+
+        counts = yield self.get_counts(e1)
+        self.assertEquals(counts, {"notify_count": 2, "highlight_count": 1})
+
+    @defer.inlineCallbacks
+    def test_receipt_creates_summary(self):
+        yield self.inject_message(NOTIFY)
+        e2 = yield self.inject_message(NOTIFY)
+        yield self.inject_message(HIGHLIGHT)
+
+        yield self.send_receipt(e2)
+
+        summary = yield self.get_summary()
+        self.assertEquals(summary, {
+            "last_read_event_id": e2.event_id,
+            "notif_count": 1,
+            "highlight_count": 1,
+        })
+
+        counts = yield self.get_counts(e2)
+        self.assertEquals(counts, {"notify_count": 1, "highlight_count": 1})
+
+    @defer.inlineCallbacks
+    def test_push_actions_bump_summary(self):
+        e1 = yield self.inject_message(NOTIFY)
+        yield self.send_receipt(e1)
+
+        counts = yield self.get_counts(e1)
+        self.assertEquals(counts, {"notify_count": 0, "highlight_count": 0})
+
+        yield self.inject_message(NOTIFY)
+        yield self.inject_message(HIGHLIGHT)
+
+        summary = yield self.get_summary()
+        self.assertEquals(summary["notif_count"], 2)
+        self.assertEquals(summary["highlight_count"], 1)
+
+        counts = yield self.get_counts(e1)
+        self.assertEquals(counts, {"notify_count": 2, "highlight_count": 1})
+
+    @defer.inlineCallbacks
+    def test_push_actions_before_receipt_do_not_bump_summary(self):
+        e1 = yield self.inject_message()
+        e2 = yield self.inject_message()
+        yield self.send_receipt(e2)
+
+        # Push actions for an event before the receipt, e.g. one that was
+        # persisted late.
+        yield self.set_push_actions(e1, NOTIFY)
+
+        counts = yield self.get_counts(e2)
+        self.assertEquals(counts, {"notify_count": 0, "highlight_count": 0})
+
+    @defer.inlineCallbacks
+    def test_new_receipt_resets_summary(self):
+        e1 = yield self.inject_message(NOTIFY)
+        yield self.send_receipt(e1)
+
+        yield self.inject_message(HIGHLIGHT)
+        e3 = yield self.inject_message(NOTIFY)
+        yield self.inject_message(NOTIFY)
+
+        counts = yield self.get_counts(e1)
+        self.assertEquals(counts, {"notify_count": 3, "highlight_count": 1})
+
+        yield self.send_receipt(e3)
+
+        summary = yield self.get_summary()
+        self.assertEquals(summary, {
+            "last_read_event_id": e3.event_id,
+            "notif_count": 1,
+            "highlight_count": 0,
+        })
+
+        counts = yield self.get_counts(e3)
+        self.assertEquals(counts, {"notify_count": 1, "highlight_count": 0})
+
+    @defer.inlineCallbacks
+    def test_removing_push_actions_drops_summary(self):
+        e1 = yield self.inject_message(NOTIFY)
+        yield self.send_receipt(e1)
+
+        e2 = yield self.inject_message(NOTIFY)
+        yield self.inject_message(NOTIFY)
+
+        yield self.store.runInteraction(
+            "remove_push_actions",
+            self.store._remove_push_actions_for_event_id_txn,
+            self.room.to_string(), e2.event_id,
+        )
+
+        summary = yield self.get_summary()
+        self.assertIsNone(summary)
+
+        counts = yield self.get_counts(e1)
+        self.assertEquals(counts, {"notify_count": 1, "highlight_count": 0})
@@ -94,6 +94,36 @@ class EventsStoreTestCase(unittest.TestCase):
         self.assertEqual(3, count)
         self._assert_stats_reporting(8, self.hs.clock.now)
 
+    @defer.inlineCallbacks
+    def test_get_rejected_event(self):
+        room = RoomID.from_string("!abc123:test")
+        user = UserID.from_string("@raccoonlover:test")
+        yield self.event_injector.create_room(room)
+
+        builder = self.hs.get_event_builder_factory().new({
+            "type": "m.room.message",
+            "sender": user.to_string(),
+            "room_id": room.to_string(),
+            "content": {"body": "Raccoons are bad", "msgtype": u"message"},
+        })
+        event, context = yield self.message_handler._create_new_client_event(
+            builder
+        )
+        context.rejected = "not a raccoon"
+        yield self.store.persist_event(event, context)
+
+        # Make sure we load the event from the database
+        self.store._invalidate_get_event_cache(event.event_id)
+
+        fetched = yield self.store.get_event(
+            event.event_id, allow_rejected=True,
+        )
+        self.assertEquals(fetched.rejected_reason, "not a raccoon")
+        self.assertEquals(fetched.content, event.content)
+
+        fetched = yield self.store.get_event(event.event_id, allow_none=True)
+        self.assertIsNone(fetched)
+
     @defer.inlineCallbacks
     def _get_last_stream_token(self):
         rows = yield self.db_pool.runQuery(
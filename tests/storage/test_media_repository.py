@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+from twisted.internet import defer
+
+from tests.utils import setup_test_homeserver
+
+
+class RemoteMediaCacheStoreTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver()
+
+        self.store = hs.get_datastore()
+
+    @defer.inlineCallbacks
+    def store_remote_media(self, media_id, length, time_now_ms, thumbnails=()):
+        yield self.store.store_cached_remote_media(
+            origin="remote",
+            media_id=media_id,
+            media_type="image/png",
+            media_length=length,
+            time_now_ms=time_now_ms,
+            upload_name=None,
+            filesystem_id="file_" + media_id,
+        )
+
+        for i, thumbnail_length in enumerate(thumbnails):
+            yield self.store.store_remote_media_thumbnail(
+                "remote", media_id, "file_" + media_id,
+                32 * (i + 1), 32 * (i + 1), "image/png", "scale",
+                thumbnail_length,
+            )
+
+    @defer.inlineCallbacks
+    def test_remote_media_cache_size(self):
+        size = yield self.store.get_remote_media_cache_size()
+        self.assertEquals(size, 0)
+
+        yield self.store_remote_media("a", 100, 1000, thumbnails=(10, 20))
+        yield self.store_remote_media("b", 200, 2000)
+
+        size = yield self.store.get_remote_media_cache_size()
+        self.assertEquals(size, 330)
+
+    @defer.inlineCallbacks
+    def test_least_recently_used(self):
+        yield self.store_remote_media("a", 100, 1000, thumbnails=(10, 20))
+        yield self.store_remote_media("b", 200, 2000)
+        yield self.store_remote_media("c", 300, 3000, thumbnails=(30,))
+
+        lru = yield self.store.get_least_recently_used_remote_media(10)
+        self.assertEquals(
+            [(m["media_id"], m["filesystem_id"], m["size"]) for m in lru],
+            [("a", "file_a", 130), ("b", "file_b", 200), ("c", "file_c", 330)],
+        )
+
+        # Accessing "a" makes it the most recently used.
+        yield self.store.update_cached_last_access_time([("remote", "a")], 4000)
+
+        lru = yield self.store.get_least_recently_used_remote_media(2)
+        self.assertEquals([m["media_id"] for m in lru], ["b", "c"])
+
+    @defer.inlineCallbacks
+    def test_delete_remote_media(self):
+        yield self.store_remote_media("a", 100, 1000, thumbnails=(10, 20))
+        yield self.store_remote_media("b", 200, 2000, thumbnails=(30,))
+
+        yield self.store.delete_remote_media("remote", "a")
+
+        media = yield self.store.get_cached_remote_media("remote", "a")
+        self.assertIsNone(media)
+        thumbnails = yield self.store.get_remote_media_thumbnails("remote", "a")
+        self.assertEquals(thumbnails, [])
+
+        lru = yield self.store.get_least_recently_used_remote_media(10)
+        self.assertEquals([m["media_id"] for m in lru], ["b"])
+
+        size = yield self.store.get_remote_media_cache_size()
+        self.assertEquals(size, 230)
@@ -119,3 +119,32 @@ class RoomMemberStoreTestCase(unittest.TestCase):
             {"test"},
             (yield self.store.get_joined_hosts_for_room(self.room.to_string()))
         )
+
+    @defer.inlineCallbacks
+    def test_membership_index(self):
+        room_id = self.room.to_string()
+        alice = self.u_alice.to_string()
+        bob = self.u_bob.to_string()
+
+        yield self.inject_room_member(self.room, self.u_alice, Membership.JOIN)
+
+        self.assertEquals(
+            {alice}, (yield self.store.get_joined_user_ids_for_room(room_id))
+        )
+        self.assertEquals(
+            {room_id}, (yield self.store.get_joined_room_ids_for_user(alice))
+        )
+        self.assertEquals(
+            set(), (yield self.store.get_joined_room_ids_for_user(bob))
+        )
+
+        # Membership changes should be applied to the index directly rather
+        # than causing the entries to be reloaded.
+        index = self.store.room_membership_index
+        yield self.inject_room_member(self.room, self.u_bob, Membership.JOIN)
+        self.assertEquals({alice, bob}, index.get_users_in_room(room_id))
+        self.assertEquals({room_id}, index.get_rooms_for_user(bob))
+
+        yield self.inject_room_member(self.room, self.u_alice, Membership.LEAVE)
+        self.assertEquals({bob}, index.get_users_in_room(room_id))
+        self.assertEquals(set(), index.get_rooms_for_user(alice))
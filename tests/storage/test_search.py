@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+from twisted.internet import defer
+
+from synapse.api.constants import EventTypes
+from synapse.api.errors import SynapseError
+from synapse.storage import search
+from synapse.types import RoomID, UserID
+
+from tests.storage.event_injector import EventInjector
+from tests.utils import setup_test_homeserver
+
+from mock import Mock, patch
+
+
+KEYS = ["content.body"]
+
+
+class SearchStoreTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.hs = yield setup_test_homeserver(
+            resource_for_federation=Mock(),
+            http_client=None,
+        )
+        self.store = self.hs.get_datastore()
+        self.event_builder_factory = self.hs.get_event_builder_factory()
+        self.message_handler = self.hs.get_handlers().message_handler
+        self.event_injector = EventInjector(self.hs)
+
+        self.u_alice = UserID.from_string("@alice:test")
+
+        self.room1 = RoomID.from_string("!abc123:test")
+        self.room2 = RoomID.from_string("!xyz456:test")
+
+        yield self.event_injector.create_room(self.room1)
+        yield self.event_injector.create_room(self.room2)
+
+    @defer.inlineCallbacks
+    def inject_messages(self, room, count):
+        event_ids = []
+        for i in range(count):
+            builder = self.event_builder_factory.new({
+                "type": EventTypes.Message,
+                "sender": self.u_alice.to_string(),
+                "room_id": room.to_string(),
+                "content": {"body": "raccoon %d" % (i,), "msgtype": u"message"},
+            })
+
+            event, context = yield self.message_handler._create_new_client_event(
+                builder
+            )
+
+            yield self.store.persist_event(event, context)
+            event_ids.append(event.event_id)
+
+        defer.returnValue(event_ids)
+
+    @defer.inlineCallbacks
+    def test_paginate_across_pages(self):
+        event_ids = yield self.inject_messages(self.room1, 5)
+
+        room_ids = [self.room1.to_string()]
+
+        seen = []
+        token = None
+        for _ in range(3):
+            result = yield self.store.search_msgs(
+                room_ids, "raccoon", KEYS, 2, pagination_token=token,
+            )
+            self.assertEquals(result["count"], 5)
+            seen.extend(r["event"].event_id for r in result["results"])
+            if not result["results"]:
+                break
+            token = result["results"][-1]["pagination_token"]
+
+        self.assertEquals(len(seen), 5)
+        self.assertEquals(set(seen), set(event_ids))
+
+        # Pagination past the end returns nothing.
+        result = yield self.store.search_msgs(
+            room_ids, "raccoon", KEYS, 2, pagination_token="5",
+        )
+        self.assertEquals(result["results"], [])
+
+    @defer.inlineCallbacks
+    def test_later_pages_use_cached_results(self):
+        yield self.inject_messages(self.room1, 3)
+
+        room_ids = [self.room1.to_string()]
+
+        result = yield self.store.search_msgs(room_ids, "raccoon", KEYS, 2)
+        token = result["results"][-1]["pagination_token"]
+
+        new_event_ids = yield self.inject_messages(self.room1, 1)
+
+        # The next page is served from the results cached by the first page,
+        # so doesn't include the new event...
+        result = yield self.store.search_msgs(
+            room_ids, "raccoon", KEYS, 2, pagination_token=token,
+        )
+        self.assertEquals(len(result["results"]), 1)
+        self.assertEquals(result["count"], 3)
+        self.assertNotIn(
+            new_event_ids[0], [r["event"].event_id for r in result["results"]]
+        )
+
+        # ... but a new search does.
+        result = yield self.store.search_msgs(room_ids, "raccoon", KEYS, 10)
+        self.assertEquals(len(result["results"]), 4)
+        self.assertEquals(result["count"], 4)
+        self.assertIn(
+            new_event_ids[0], [r["event"].event_id for r in result["results"]]
+        )
+
+    @defer.inlineCallbacks
+    def test_invalid_pagination_token(self):
+        room_ids = [self.room1.to_string()]
+
+        for token in ("foo", "-1"):
+            with self.assertRaises(SynapseError):
+                yield self.store.search_msgs(
+                    room_ids, "raccoon", KEYS, 2, pagination_token=token,
+                )
+
+    @defer.inlineCallbacks
+    def test_rooms_searched_in_chunks(self):
+        room1_event_ids = yield self.inject_messages(self.room1, 2)
+        room2_event_ids = yield self.inject_messages(self.room2, 2)
+
+        room_ids = [
+            self.room1.to_string(), self.room2.to_string(), "!other:test",
+        ]
+
+        with patch.object(search, "SEARCH_ROOMS_CHUNK_SIZE", 1):
+            result = yield self.store.search_msgs(room_ids, "raccoon", KEYS, 10)
+
+        self.assertEquals(result["count"], 4)
+        self.assertEquals(
+            set(r["event"].event_id for r in result["results"]),
+            set(room1_event_ids + room2_event_ids),
+        )
+
+    @defer.inlineCallbacks
+    def test_count_when_results_truncated(self):
+        yield self.inject_messages(self.room1, 3)
+        yield self.inject_messages(self.room2, 2)
+
+        room_ids = [self.room1.to_string(), self.room2.to_string()]
+
+        # If the ranked results hit the limit, the count comes from a separate
+        # query over every chunk of rooms.
+        with patch.object(search, "SEARCH_RESULTS_LIMIT", 2):
+            with patch.object(search, "SEARCH_ROOMS_CHUNK_SIZE", 1):
+                result = yield self.store.search_msgs(
+                    room_ids, "raccoon", KEYS, 10,
+                )
+
+        self.assertEquals(len(result["results"]), 2)
+        self.assertEquals(result["count"], 5)
+
+
+class ChunkRoomIdsTestCase(unittest.TestCase):
+
+    def test_chunk_room_ids(self):
+        with patch.object(search, "SEARCH_ROOMS_CHUNK_SIZE", 2):
+            self.assertEquals(search._chunk_room_ids([]), [])
+            self.assertEquals(search._chunk_room_ids(["a"]), [["a"]])
+            self.assertEquals(
+                search._chunk_room_ids(["a", "b", "c", "d", "e"]),
+                [["a", "b"], ["c", "d"], ["e"]],
+            )
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+from twisted.internet import defer
+
+from synapse.api.constants import EventTypes, Membership
+from synapse.storage import state as state_store
+from synapse.types import UserID, RoomID
+
+from tests.utils import setup_test_homeserver
+
+from mock import Mock
+
+
+class StateStoreTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver(
+            resource_for_federation=Mock(),
+            http_client=None,
+        )
+
+        self.store = hs.get_datastore()
+        self.event_builder_factory = hs.get_event_builder_factory()
+        self.message_handler = hs.get_handlers().message_handler
+
+        self.room = RoomID.from_string("!abc123:test")
+
+    @defer.inlineCallbacks
+    def inject_room_member(self, user, membership):
+        builder = self.event_builder_factory.new({
+            "type": EventTypes.Member,
+            "sender": user.to_string(),
+            "state_key": user.to_string(),
+            "room_id": self.room.to_string(),
+            "content": {"membership": membership},
+        })
+
+        event, context = yield self.message_handler._create_new_client_event(
+            builder
+        )
+
+        yield self.store.persist_event(event, context)
+
+        defer.returnValue(event)
+
+    def count_state_rows(self, event_id):
+        def f(txn):
+            txn.execute(
+                "SELECT count(*) FROM state_groups_state WHERE state_group = ("
+                " SELECT state_group FROM event_to_state_groups"
+                " WHERE event_id = ?"
+                ")",
+                (event_id,)
+            )
+            return txn.fetchone()[0]
+        return self.store.runInteraction("count_state_rows", f)
+
+    @defer.inlineCallbacks
+    def inject_members(self, count):
+        events = []
+        for i in range(count):
+            user = UserID.from_string("@user%d:test" % (i,))
+            event = yield self.inject_room_member(user, Membership.JOIN)
+            events.append(event)
+        defer.returnValue(events)
+
+    @defer.inlineCallbacks
+    def test_state_stored_as_delta(self):
+        events = yield self.inject_members(5)
+
+        # The first state group is a full snapshot, every later one only
+        # stores the membership event that changed.
+        rows = yield self.count_state_rows(events[0].event_id)
+        self.assertEquals(rows, 1)
+        rows = yield self.count_state_rows(events[-1].event_id)
+        self.assertEquals(rows, 1)
+
+        state = yield self.store.get_state_for_event(events[-1].event_id)
+        self.assertEquals(
+            set(e.event_id for e in state.values()),
+            set(e.event_id for e in events),
+        )
+
+        state = yield self.store.get_state_for_event(
+            events[-1].event_id, types=[(EventTypes.Member, events[1].state_key)],
+        )
+        self.assertEquals(
+            [e.event_id for e in state.values()], [events[1].event_id],
+        )
+
+    @defer.inlineCallbacks
+    def test_delta_chain_is_bounded(self):
+        self.patch(state_store, "MAX_STATE_DELTA_HOPS", 2)
+
+        events = yield self.inject_members(5)
+
+        # Chain of at most two deltas, then a full snapshot again
+        rows = [(yield self.count_state_rows(e.event_id)) for e in events]
+        self.assertEquals(rows, [1, 1, 1, 4, 1])
+
+        state = yield self.store.get_state_for_event(events[-1].event_id)
+        self.assertEquals(
+            set(e.event_id for e in state.values()),
+            set(e.event_id for e in events),
+        )
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+from twisted.internet import defer
+
+from tests.utils import setup_test_homeserver
+
+
+class FederationQueueStoreTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver()
+
+        self.clock = hs.get_clock()
+        self.store = hs.get_datastore()
+
+    @defer.inlineCallbacks
+    def get_queued_edus(self, destination):
+        pdu_rows, edu_rows = yield self.store.get_federation_queue_for_destination(
+            destination, 100, 100,
+        )
+        defer.returnValue([content["i"] for _, _, content in edu_rows])
+
+    @defer.inlineCallbacks
+    def test_prune_by_age(self):
+        yield self.store.add_edu_to_federation_queue("remote", "m.test", {"i": 0})
+        yield self.store.add_pdu_to_federation_queue("$0:test", ["remote"])
+
+        self.clock.advance_time_msec(1000)
+        yield self.store.add_edu_to_federation_queue("remote", "m.test", {"i": 1})
+
+        pruned = yield self.store.prune_federation_queue(500, 100)
+        self.assertEquals(pruned, 2)
+
+        pdu_rows, _ = yield self.store.get_federation_queue_for_destination(
+            "remote", 100, 100,
+        )
+        self.assertEquals(pdu_rows, [])
+        self.assertEquals((yield self.get_queued_edus("remote")), [1])
+
+    @defer.inlineCallbacks
+    def test_prune_by_size(self):
+        for i in range(5):
+            yield self.store.add_edu_to_federation_queue("remote", "m.test", {"i": i})
+        yield self.store.add_edu_to_federation_queue("other", "m.test", {"i": 0})
+
+        pruned = yield self.store.prune_federation_queue(1000, 2)
+        self.assertEquals(pruned, 3)
+
+        # The newest rows are kept, and other destinations are untouched.
+        self.assertEquals((yield self.get_queued_edus("remote")), [3, 4])
+        self.assertEquals((yield self.get_queued_edus("other")), [0])
+
+        destinations = yield self.store.get_destinations_with_federation_queue()
+        self.assertEquals(sorted(destinations), ["other", "remote"])
+
+    @defer.inlineCallbacks
+    def test_federation_out_pos(self):
+        position = yield self.store.get_federation_out_pos("events")
+        self.assertIsNone(position)
+
+        yield self.store.update_federation_out_pos("events", 5)
+        yield self.store.update_federation_out_pos("events", 7)
+
+        position = yield self.store.get_federation_out_pos("events")
+        self.assertEquals(position, 7)
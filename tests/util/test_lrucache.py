@@ -17,6 +17,7 @@
 from .. import unittest
 
 from synapse.util.caches.lrucache import LruCache
+from synapse.util.caches.memory_budget import MemoryBudget
 from synapse.util.caches.treecache import TreeCache
 
 
@@ -79,3 +80,67 @@ class LruCacheTestCase(unittest.TestCase):
         cache["key"] = 1
         cache.clear()
         self.assertEquals(len(cache), 0)
+
+
+class SizeAwareLruCacheTestCase(unittest.TestCase):
+
+    def test_size_in_bytes(self):
+        cache = LruCache(10, size_callback=len)
+        cache["a"] = "x" * 10
+        cache["b"] = "x" * 20
+        self.assertEquals(cache.size_in_bytes(), 30)
+
+        cache["a"] = "x" * 5
+        self.assertEquals(cache.size_in_bytes(), 25)
+
+        cache.pop("b")
+        self.assertEquals(cache.size_in_bytes(), 5)
+
+        cache.clear()
+        self.assertEquals(cache.size_in_bytes(), 0)
+
+    def test_not_size_aware(self):
+        cache = LruCache(10)
+        cache["a"] = "x" * 10
+        self.assertEquals(cache.size_in_bytes(), None)
+
+    def test_del_multi(self):
+        cache = LruCache(4, 2, cache_type=TreeCache, size_callback=len)
+        cache[("animal", "cat")] = "mew"
+        cache[("animal", "dog")] = "woof"
+        cache[("vehicles", "car")] = "vroom"
+        self.assertEquals(cache.size_in_bytes(), 12)
+
+        cache.del_multi(("animal",))
+        self.assertEquals(cache.size_in_bytes(), 5)
+
+    def test_budget_evicts_oldest(self):
+        budget = MemoryBudget(max_bytes=25)
+        cache = LruCache(10, size_callback=len, memory_budget=budget)
+
+        cache["a"] = "x" * 10
+        cache["b"] = "x" * 10
+        cache.get("a")
+        cache["c"] = "x" * 10
+
+        # "b" was the least recently used, so should have been evicted
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.get("b"), None)
+        self.assertEquals(budget.total_bytes(), 20)
+
+    def test_budget_shared_between_caches(self):
+        budget = MemoryBudget(max_bytes=30)
+        big_cache = LruCache(10, size_callback=len, memory_budget=budget)
+        small_cache = LruCache(10, size_callback=len, memory_budget=budget)
+
+        big_cache["a"] = "x" * 10
+        big_cache["b"] = "x" * 10
+        small_cache["c"] = "x" * 5
+        self.assertEquals(budget.total_bytes(), 25)
+
+        # Going over budget evicts from the cache using the most memory
+        small_cache["d"] = "x" * 10
+        self.assertEquals(len(big_cache), 1)
+        self.assertEquals(big_cache.get("a"), None)
+        self.assertEquals(len(small_cache), 2)
+        self.assertEquals(budget.total_bytes(), 25)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from .. import unittest
+
+from synapse.util.caches.room_membership_index import RoomMembershipIndex
+
+
+class RoomMembershipIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.index = RoomMembershipIndex("test")
+
+    def test_prefill(self):
+        seq = self.index.sequence
+        self.index.prefill_users_in_room(seq, "!a:test", ["@1:test", "@2:test"])
+        self.index.prefill_rooms_for_user(seq, "@1:test", ["!a:test"])
+
+        self.assertEquals(
+            {"@1:test", "@2:test"}, self.index.get_users_in_room("!a:test")
+        )
+        self.assertEquals({"!a:test"}, self.index.get_rooms_for_user("@1:test"))
+        self.assertEquals(None, self.index.get_users_in_room("!b:test"))
+        self.assertEquals(None, self.index.get_rooms_for_user("@2:test"))
+
+    def test_stale_prefill_ignored(self):
+        seq = self.index.sequence
+        self.index.membership_changed("!a:test", "@1:test", joined=True)
+
+        users = self.index.prefill_users_in_room(seq, "!a:test", ["@2:test"])
+        self.assertEquals({"@2:test"}, users)
+        self.assertEquals(None, self.index.get_users_in_room("!a:test"))
+
+    def test_membership_changed(self):
+        seq = self.index.sequence
+        self.index.prefill_users_in_room(seq, "!a:test", ["@1:test"])
+        self.index.prefill_rooms_for_user(seq, "@2:test", ["!b:test"])
+
+        self.index.membership_changed("!a:test", "@2:test", joined=True)
+        self.assertEquals(
+            {"@1:test", "@2:test"}, self.index.get_users_in_room("!a:test")
+        )
+        self.assertEquals(
+            {"!a:test", "!b:test"}, self.index.get_rooms_for_user("@2:test")
+        )
+
+        self.index.membership_changed("!a:test", "@1:test", joined=False)
+        self.assertEquals({"@2:test"}, self.index.get_users_in_room("!a:test"))
+
+        # Users that aren't in the index shouldn't be added by a change
+        self.assertEquals(None, self.index.get_rooms_for_user("@1:test"))
+
+    def test_changes_do_not_modify_returned_sets(self):
+        seq = self.index.sequence
+        self.index.prefill_users_in_room(seq, "!a:test", ["@1:test"])
+        self.index.prefill_rooms_for_user(seq, "@1:test", ["!a:test"])
+
+        users = self.index.get_users_in_room("!a:test")
+        rooms = self.index.get_rooms_for_user("@1:test")
+
+        # Callers may still be iterating over the sets they were given.
+        for _ in users:
+            self.index.membership_changed("!a:test", "@2:test", joined=True)
+        for _ in rooms:
+            self.index.membership_changed("!a:test", "@1:test", joined=False)
+
+        self.assertEquals({"@1:test"}, users)
+        self.assertEquals({"!a:test"}, rooms)
+        self.assertEquals({"@2:test"}, self.index.get_users_in_room("!a:test"))
+        self.assertEquals(set(), self.index.get_rooms_for_user("@1:test"))
+
+    def test_is_user_in_any_room(self):
+        seq = self.index.sequence
+        self.index.prefill_rooms_for_user(seq, "@1:test", ["!a:test", "!b:test"])
+
+        self.assertTrue(
+            self.index.is_user_in_any_room("@1:test", {"!b:test", "!c:test"})
+        )
+        self.assertFalse(self.index.is_user_in_any_room("@1:test", {"!c:test"}))
+        self.assertEquals(
+            None, self.index.is_user_in_any_room("@2:test", {"!a:test"})
+        )
+
+    def test_invalidate_room(self):
+        seq = self.index.sequence
+        self.index.prefill_users_in_room(seq, "!a:test", ["@1:test"])
+        self.index.prefill_users_in_room(seq, "!b:test", ["@1:test"])
+        self.index.prefill_rooms_for_user(seq, "@1:test", ["!a:test", "!b:test"])
+
+        self.index.invalidate_room("!a:test")
+
+        self.assertEquals(None, self.index.get_users_in_room("!a:test"))
+        self.assertEquals({"@1:test"}, self.index.get_users_in_room("!b:test"))
+        self.assertEquals(None, self.index.get_rooms_for_user("@1:test"))
@@ -53,6 +53,13 @@ def setup_test_homeserver(name="test", datastore=None, config=None, **kargs):
         config.server_name = name
         config.trusted_third_party_id_servers = []
         config.room_invite_state_types = []
+        config.federation_presence_flush_interval_ms = 1000
+        config.federation_presence_batch_size = 100
+        config.federation_max_pdus_per_transaction = 50
+        config.federation_max_edus_per_transaction = 100
+        config.federation_queue_max_age_ms = 3 * 24 * 60 * 60 * 1000
+        config.federation_max_queued_per_destination = 10000
+        config.send_federation = True
 
     config.database_config = {"name": "sqlite3"}
 
@@ -274,15 +281,16 @@ class MockClock(object):
 
 class SQLiteMemoryDbPool(ConnectionPool, object):
     def __init__(self):
+        self.config = Mock()
+        self.config.database_config = {"name": "sqlite3"}
+
         super(SQLiteMemoryDbPool, self).__init__(
             "sqlite3", ":memory:",
             cp_min=1,
             cp_max=1,
+            cp_openfun=self.create_engine().on_new_connection,
         )
 
-        self.config = Mock()
-        self.config.database_config = {"name": "sqlite3"}
-
     def prepare(self):
         engine = self.create_engine()
         return self.runWithConnection(